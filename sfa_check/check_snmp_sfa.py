@@ -38,14 +38,72 @@ import logging.handlers
 from optparse import OptionParser, OptionError
 import subprocess
 import re
+import time
+
+# the native SNMP backend is optional, snmpget is used without it
+try:
+    from pysnmp.entity.rfc3413.oneliner import cmdgen
+except ImportError:
+    cmdgen = None
 
 BASE_OID = ".1.3.6.1.4.1.341.49.1"
 LOGGER = None
+# Default age in seconds after which the results on the management server are stale
+MAX_AGE = 900
+# OIDs per SNMP GET. snmpget refuses more than 128 OIDs on its command line, and
+# large responses may not fit in one PDU
+MAX_OIDS = 60
+# OIDs per GETBULK (or pysnmp GETNEXT run) when walking from a starting OID
+WALK_ROWS = 50
+
+class ResponseTooBig (Exception):
+    """ The agent answered a GET with tooBig """
+    pass
 
 def stringToOID(string):
     result=".".join([ str(ord(s)) for s in string ])
     return "%s." % (len(string)) + result
 
+def OIDToString(suffix):
+    """ Reverse of stringToOID. Returns (string, rest of the OID) for an OID suffix
+        that starts with an encoded string, or (None, None) if it doesn't """
+    parts = suffix.strip('.').split('.')
+    try:
+        length = int(parts[0])
+        string = ''.join([ chr(int(part)) for part in parts[1:length + 1] ])
+    except (ValueError, IndexError):
+        return (None, None)
+    if len(string) != length:
+        return (None, None)
+    return (string, '.'.join(parts[length + 1:]))
+
+def shortName(controller):
+    """ The name the management server publishes the results of a controller under """
+    if not re.match("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}",controller):
+        # get short hostname if not in dotted quad notation
+        m = re.search("(.*?)\.",controller)
+        # if hostname can be shortened
+        if m: return m.group(1)
+    # else it already is short
+    return controller
+
+def checkAge(check_return,output,timestamp,max_age):
+    """ Flag results older than max_age seconds. Returns the (return code, output) to report """
+    if max_age > 0:
+        try:
+            age = int(time.time()) - int(timestamp)
+        except (ValueError, TypeError):
+            age = None
+        if age is None or age > max_age:
+            if age is None:
+                output = "STALE DATA (no valid timestamp). Last state: %s"%output
+            else:
+                output = "STALE DATA (%d seconds old). Last state: %s"%(age,output)
+            # upgrade from OK to WARNING since the results are old
+            if check_return == 0:
+                check_return = 1
+    return (check_return,output)
+
 def main():
     """main subroutine"""
    
@@ -57,6 +115,13 @@ def main():
     parser.add_option("--controller", help="Name of controllers to check", dest="controller")
     parser.add_option('-P', "--port", help="SNMP Port. Default is 161", default='161', dest="port")
     parser.add_option('-V', "--version", help="Chooses version number. e.g. 1, 2c, 3", default='2c', dest="version")
+    parser.add_option('-a', "--max-age", help="Seconds after which the results are reported as stale. 0 disables. Default is %d"%MAX_AGE, default=MAX_AGE, type="int", dest="max_age")
+    parser.add_option('-b', "--backend", help="SNMP backend: native (pysnmp), snmpget or auto. Default is auto", default='auto', dest="backend")
+    parser.add_option("--bulk", help="Bulk mode: report the results of the comma-separated controllers as Nagios passive checks", dest="bulk")
+    parser.add_option("--all", help="Bulk mode: report the results of all controllers on the management server as Nagios passive checks", action="store_true", default=False, dest="all")
+    parser.add_option("--service", help="Service description for passive check results. Default is SFA_CHECK", default="SFA_CHECK", dest="service")
+    parser.add_option("--command-file", help="Write passive check results to this Nagios command file instead of stdout", dest="command_file")
+    parser.add_option("--host-suffix", help="Append this to controller names found with --all to form the Nagios host name", default="", dest="host_suffix")
     # add parser.add_option() calls here
     try:
         (options, args) = parser.parse_args()
@@ -64,60 +129,311 @@ def main():
         parser.print_help()
         return 3
  
+    # store arguments in variables
+    snmp_opts=({'community': options.community, 'version': options.version, 'host':options.hostname, 'port':options.port, 'backend':options.backend, 'verbose':options.verbose})
+
+    if options.bulk or options.all:
+        return bulkCheck(options,snmp_opts)
+
     if options.controller:
-        if not re.match("\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}",options.controller):
-            # get short hostname if not in dotted quad notation
-            m = re.search("(.*?)\.",options.controller)
-            # if hostname can be shortened
-            if m: controller = m.group(1)
-            # else it already is short
-            else: controller = options.controller
-        else:
-            controller = options.controller
+        controller = shortName(options.controller)
     else:
         print "No controller to check specified"
         return 3
 
     encoded_controller = stringToOID(controller)
- 
-    # store arguments in variables
-    snmp_opts=({'community': options.community, 'version': options.version, 'host':options.hostname, 'port':options.port})
   
-    retcode_oid = "1"
-    output_oid = "2"
-    timestamp_oid = "3"
-
-    oid = "%s.%s.%s"%(BASE_OID,encoded_controller,retcode_oid)
-    check_return = getSNMPValue(snmp_opts,oid)
-    oid = "%s.%s.%s"%(BASE_OID,encoded_controller,output_oid)
-    output = getSNMPValue(snmp_opts,oid)
+    retcode_oid = "%s.%s.1"%(BASE_OID,encoded_controller)
+    output_oid = "%s.%s.2"%(BASE_OID,encoded_controller)
+    timestamp_oid = "%s.%s.3"%(BASE_OID,encoded_controller)
+
+    # get all the values in a single request
+    values = getSNMPValues(snmp_opts,[retcode_oid,output_oid,timestamp_oid])
+    (check_return,output) = checkAge(int(values[retcode_oid]),values[output_oid],values[timestamp_oid],options.max_age)
+
     print output
-    return int(check_return)
+    return check_return
+
+def bulkCheck(options,snmp_opts):
+    """ Get the results of many controllers in one SNMP request (a GET of the listed
+        controllers or a walk of BASE_OID) and write them as Nagios passive check results """
+    # Nagios host name -> results of the controller, filled from the walk or GET below
+    results = {}
+    if options.all:
+        # from BASE_OID.1, leaving out the timing of the checks the daemon publishes under
+        # BASE_OID.0 (no controller has an empty name)
+        for (oid,value) in walkSNMP(snmp_opts,BASE_OID,BASE_OID + '.1'):
+            (controller,field) = OIDToString(oid[len(BASE_OID):])
+            if controller is None or not field in ('1','2','3'):
+                continue
+            results.setdefault(controller + options.host_suffix,{})[field] = value
+    else:
+        oids = []
+        hosts = {}
+        for host in options.bulk.split(','):
+            encoded_controller = stringToOID(shortName(host))
+            for field in ('1','2','3'):
+                oid = "%s.%s.%s"%(BASE_OID,encoded_controller,field)
+                oids.append(oid)
+                hosts[oid] = (host,field)
+            results[host] = {}
+        for (oid,value) in getSNMPValues(snmp_opts,oids,False).items():
+            if oid in hosts:
+                (host,field) = hosts[oid]
+                results[host][field] = value
+
+    now = int(time.time())
+    lines = []
+    hostnames = results.keys()
+    hostnames.sort()
+    for host in hostnames:
+        values = results[host]
+        if '1' in values and '2' in values:
+            try:
+                check_return = int(values['1'])
+            except ValueError:
+                check_return = 3
+            (check_return,output) = checkAge(check_return,values['2'],values.get('3'),options.max_age)
+        else:
+            (check_return,output) = (3,"No results for this controller on the management server")
+        lines.append("[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n"%(now,host,options.service,check_return,output))
+
+    if options.command_file:
+        try:
+            f = open(options.command_file,'a')
+            f.write(''.join(lines))
+            f.close()
+        except IOError, err:
+            print "Could not write to command file %s: %s"%(options.command_file,err)
+            return 3
+    else:
+        sys.stdout.write(''.join(lines))
+    return 0
 
-def getSNMPValue(snmp_opts,oid):
-    rc, stdout, stderr = snmp(snmp_opts,'get',oid)
-    # Fail if we can't get results
+def parseSNMPOutput(stdout,exitOnMissing):
+    """ Parse the -On output of the net-snmp tools into a dictionary of oid -> value """
+    return dict(parseSNMPRows(stdout,exitOnMissing))
+
+def parseSNMPRows(stdout,exitOnMissing):
+    """ Parse the -On output of the net-snmp tools into a list of (oid, value), in
+        the order of the output """
+    values = []
+    for line in stdout.splitlines():
+        m = re.match('(\.[\d.]+) = (?:(\w+): )?(.*)', line)
+        if not m:
+            continue
+        (oid, value_type, value) = m.groups()
+        if value_type is None:
+            # No Such Instance/Object
+            if exitOnMissing:
+                print line
+                sys.exit(3)
+            continue
+        if value_type == 'STRING' and len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+        values.append((oid, value))
+    return values
+
+def useNative(snmp_opts):
+    """ Whether to use the native pysnmp backend instead of the net-snmp tools """
+    backend = snmp_opts['backend']
+    if backend == 'native' or (backend == 'auto' and cmdgen):
+        if not cmdgen:
+            print "Native SNMP backend requested but pysnmp is not installed"
+            sys.exit(3)
+        if snmp_opts['verbose']:
+            sys.stderr.write("Using native SNMP backend\n")
+        return True
+    if snmp_opts['verbose']:
+        sys.stderr.write("Using net-snmp backend\n")
+    return False
+
+def getSNMPValues(snmp_opts,oids,exitOnMissing=True):
+    """ Get the values of oids with one SNMP GET per MAX_OIDS of them. Returns a
+        dictionary of oid -> value. Exits with UNKNOWN if any of them can't be
+        retrieved, unless exitOnMissing is False, in which case they are left out """
+    native = useNative(snmp_opts)
+    values = {}
+    for start in range(0,len(oids),MAX_OIDS):
+        values.update(getSNMPBatch(snmp_opts,native,oids[start:start + MAX_OIDS],exitOnMissing))
+    if exitOnMissing:
+        for oid in oids:
+            if not oid in values:
+                print "No value returned for OID %s"%oid
+                sys.exit(3)
+    return values
+
+def getSNMPBatch(snmp_opts,native,oids,exitOnMissing):
+    """ Get the values of oids with a single SNMP GET. If the response is too big
+        for the agent, the two halves of oids are fetched separately """
+    try:
+        if native:
+            return snmpNative(snmp_opts,oids,exitOnMissing)
+        rc, stdout, stderr = snmp(snmp_opts,'get',oids)
+        if rc != 0 and 'tooBig' in stderr:
+            raise ResponseTooBig
+        # With SNMP v1 a missing OID fails the whole GET. snmpget reports it and
+        # retries without that OID, so the other values are still in stdout
+        if rc != 0 and (exitOnMissing or not 'noSuchName' in stderr):
+            print stderr
+            sys.exit(3)
+        return parseSNMPOutput(stdout,exitOnMissing)
+    except ResponseTooBig:
+        if len(oids) < 2:
+            print "Response too big for OID %s"%oids[0]
+            sys.exit(3)
+        half = len(oids) / 2
+        values = getSNMPBatch(snmp_opts,native,oids[:half],exitOnMissing)
+        values.update(getSNMPBatch(snmp_opts,native,oids[half:],exitOnMissing))
+        return values
+
+def walkSNMP(snmp_opts,oid,start=None):
+    """ Walk the subtree under oid, using GETBULK unless SNMP v1 is used. Returns a
+        list of (oid, value). With start, only the OIDs after start are fetched """
+    if start is not None:
+        return walkSNMPFrom(snmp_opts,oid,start)
+    if useNative(snmp_opts):
+        return snmpNativeWalk(snmp_opts,oid)
+    rc, stdout, stderr = snmp(snmp_opts,'walk',[oid])
     if rc != 0:
         print stderr
         sys.exit(3)
-    elif "No Such Instance currently exists at this OID" in stdout:
-        print(stdout)
+    values = parseSNMPOutput(stdout,False)
+    return values.items()
+
+def walkSNMPFrom(snmp_opts,oid,start):
+    """ Walk the subtree under oid from the OID after start, WALK_ROWS OIDs per request.
+        snmpwalk can only start at the root of the subtree """
+    native = useNative(snmp_opts)
+    prefix = oid + '.'
+    values = []
+    while True:
+        if native:
+            rows = snmpNativeNext(snmp_opts,start)
+        else:
+            rc, stdout, stderr = snmp(snmp_opts,'getnext',[start])
+            # SNMP v1 reports the end of the MIB as noSuchName
+            if rc != 0 and 'noSuchName' in stderr:
+                return values
+            if rc != 0:
+                print stderr
+                sys.exit(3)
+            rows = parseSNMPRows(stdout,False)
+        for (name,value) in rows:
+            if not name.startswith(prefix):
+                return values
+            values.append((name,value))
+        if not rows or rows[-1][0] == start:
+            return values
+        start = rows[-1][0]
+
+def nativeTarget(snmp_opts):
+    """ The pysnmp authentication and transport for the management server """
+    if snmp_opts['version'] == '1':
+        auth = cmdgen.CommunityData(snmp_opts['community'], mpModel=0)
+    else:
+        auth = cmdgen.CommunityData(snmp_opts['community'])
+    transport = cmdgen.UdpTransportTarget((snmp_opts['host'],int(snmp_opts['port'])))
+    return (auth,transport)
+
+def snmpNative(snmp_opts,oids,exitOnMissing=True):
+    """ Get the values of oids in one GET request with pysnmp """
+    (auth,transport) = nativeTarget(snmp_opts)
+    generator = cmdgen.CommandGenerator()
+    while True:
+        errorIndication, errorStatus, errorIndex, varBinds = generator.getCmd(auth, transport, *[ oid.lstrip('.') for oid in oids ])
+        if errorIndication:
+            print errorIndication
+            sys.exit(3)
+        if not errorStatus:
+            break
+        if errorStatus.prettyPrint() == 'tooBig':
+            raise ResponseTooBig
+        # SNMP v1 fails the whole GET for a missing OID, retry without it like snmpget does
+        if errorStatus.prettyPrint() == 'noSuchName' and not exitOnMissing and int(errorIndex) > 0:
+            oids = oids[:int(errorIndex) - 1] + oids[int(errorIndex):]
+            if oids:
+                continue
+            return {}
+        print errorStatus.prettyPrint()
+        sys.exit(3)
+    values = {}
+    for name, value in varBinds:
+        if value.__class__.__name__ in ('NoSuchInstance','NoSuchObject','EndOfMibView'):
+            if exitOnMissing:
+                print "No Such Instance currently exists at this OID: .%s"%name
+                sys.exit(3)
+            continue
+        values['.' + str(name)] = str(value)
+    return values
+
+def snmpNativeNext(snmp_opts,oid):
+    """ The (oid, value) of up to WALK_ROWS OIDs after oid, with pysnmp """
+    (auth,transport) = nativeTarget(snmp_opts)
+    generator = cmdgen.CommandGenerator()
+    if snmp_opts['version'] == '1':
+        errorIndication, errorStatus, errorIndex, varBindTable = generator.nextCmd(auth, transport, oid.lstrip('.'), lexicographicMode=True, maxRows=WALK_ROWS)
+    else:
+        errorIndication, errorStatus, errorIndex, varBindTable = generator.bulkCmd(auth, transport, 0, WALK_ROWS, oid.lstrip('.'), lexicographicMode=True, maxRows=WALK_ROWS)
+    if errorIndication:
+        print errorIndication
+        sys.exit(3)
+    # SNMP v1 reports the end of the MIB as noSuchName
+    if errorStatus and errorStatus.prettyPrint() != 'noSuchName':
+        print errorStatus.prettyPrint()
+        sys.exit(3)
+    values = []
+    for varBindRow in varBindTable:
+        for name, value in varBindRow:
+            if value.__class__.__name__ in ('NoSuchInstance','NoSuchObject','EndOfMibView'):
+                continue
+            values.append(('.' + str(name), str(value)))
+    return values
+
+def snmpNativeWalk(snmp_opts,oid):
+    """ Walk the subtree under oid with pysnmp """
+    (auth,transport) = nativeTarget(snmp_opts)
+    generator = cmdgen.CommandGenerator()
+    if snmp_opts['version'] == '1':
+        errorIndication, errorStatus, errorIndex, varBindTable = generator.nextCmd(auth, transport, oid.lstrip('.'))
+    else:
+        errorIndication, errorStatus, errorIndex, varBindTable = generator.bulkCmd(auth, transport, 0, 50, oid.lstrip('.'))
+    if errorIndication:
+        print errorIndication
+        sys.exit(3)
+    if errorStatus:
+        print errorStatus.prettyPrint()
         sys.exit(3)
-    value = re.match('(?:.+)::(?:.+)\.(?:\d+) \= .+?\: (.+)', stdout).groups()[0]
-    return value
+    values = []
+    prefix = oid + '.'
+    for varBindRow in varBindTable:
+        for name, value in varBindRow:
+            name = '.' + str(name)
+            # bulkCmd may return a few OIDs past the end of the subtree
+            if name.startswith(prefix):
+                values.append((name, str(value)))
+    return values
 
-def snmp(opts,type,oid):
+def snmp(opts,type,oids):
     """returns return code, stdout, and stderr"""
     if type == 'get':
-        cmd = '/usr/bin/snmpget'
+        cmd = ['/usr/bin/snmpget']
+    elif type == 'getnext' and opts['version'] == '1':
+        cmd = ['/usr/bin/snmpgetnext']
+    elif type == 'getnext':
+        cmd = ['/usr/bin/snmpbulkget','-Cn0','-Cr%d'%WALK_ROWS]
+    elif opts['version'] == '1':
+        cmd = ['/usr/bin/snmpwalk']
     else:
-        cmd = '/usr/bin/snmpwalk'
+        cmd = ['/usr/bin/snmpbulkwalk']
 
+    # numeric OIDs in the output so they can be matched to the request
     p = subprocess.Popen(
-          [cmd,'-Le','-c',opts['community'],'-v',opts['version'],opts['host']+':'+opts['port'],oid],
+          cmd + ['-Le','-On','-c',opts['community'],'-v',opts['version'],opts['host']+':'+opts['port']] + oids,
           stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    returncode=p.wait()
+    # communicate() reads both pipes until EOF, waiting first could deadlock on large output
     stdout, stderr = p.communicate()
+    returncode = p.returncode
     stdout = stdout.strip('\n') # removes trailing new line
     stderr = stderr.strip('\n') # removes trailing new line
  
@@ -27,13 +27,29 @@ health of SFA family storage controllers
 """
 
 # modules used in this script
-from ddn.sfa.api import *
-from argparse import ArgumentParser, ArgumentError
 import os
+# SFA_CHECK_SIMULATOR runs the checks against the offline simulator in sfa_check_sim.py
+if os.environ.get('SFA_CHECK_SIMULATOR'):
+    from sfa_check_sim import *
+else:
+    from ddn.sfa.api import *
+from argparse import ArgumentParser, ArgumentError
 import sys
 import multiprocessing 
+from multiprocessing.pool import ThreadPool
+import Queue
 import time
 import socket
+import threading
+import select
+import errno
+import syslog
+import json
+import operator
+import struct
+import bisect
+from array import array
+from itertools import groupby
 from traceback import print_exc
 import re
 
@@ -41,6 +57,24 @@ import re
 # This is mainly for user input verification (or snnmp extend)
 implementedModules = [ 'controller', 'internaldisk', 'virtualdisk', 'pool', 'disk', 'expander', 'ioc', 'channel', 'fan', 'power', 'sep', 'temperature', 'ups', 'voltage', 'icl_chan', 'icl_ioc', 'raid', 'host_chan' ]
 defaultConfig = "/usr/local/etc/sfa_check.conf"
+# Seconds a subsystem check may run before its worker is killed
+defaultTimeout = 300
+# Seconds a persistent worker keeps an unused API session open
+defaultSessionIdle = 900
+# Seconds to wait for a controller to answer before failing over to the other one
+defaultConnectTimeout = 10
+# Port of the API service on the controllers
+APIPort = 443
+# Seconds a resolved controller address is cached
+defaultResolveTTL = 300
+# Seconds to wait for the resolver before using the last known addresses
+defaultResolveTimeout = 10
+# Seconds the component values in the history file are kept
+defaultHistoryRetention = 7 * 86400
+# Lines of messages shown per check in the extended output
+defaultLineLimit = 20
+# Seconds the state of a subsystem that is not checked is kept in a ComponentStateStore
+defaultStateMaxAge = 86400
 
 def enum(*sequential, **named):
     """ Helper function to define the enum structures used by DDN """
@@ -101,6 +135,31 @@ SFAWarningStatus.UNKNOWN=65535
 
 SYMBOL_ERROR_THRESHOLD=20
 
+# Seconds over which the increase of the error counters is compared with the rate thresholds
+defaultRateInterval = 3600
+# Increase of an error counter within the rate interval above which the component is reported
+# WARNING. Set for a subsystem with rate.<counter>=N in the configuration file
+counterRateThresholds = { 'SymbolErrorCounter': SYMBOL_ERROR_THRESHOLD,
+                          'LinkErrorRecoveryCounter': 1,
+                          'LinkDownedCounter': 1,
+                          'BadBlockCount': 100 }
+# threshold of the counters not in counterRateThresholds
+defaultCounterRateThreshold = 20
+# the metrics recorded with APICheck.recordCounter()
+counterMetrics = ['icl_channel_errors_total','pool_bad_blocks','virtual_disk_bad_blocks']
+
+# attributes that identify a faulted component in the structured results, when the object has them
+componentIdentifiers = ['Index','ControllerIndex','EnclosureIndex','DiskSlotNumber','Position','Location','PortLocation','SerialNumber','Name']
+
+# the Nagios statuses from the least to the most severe. CRITICAL is worse than UNKNOWN
+statusSeverity = [NagiosStatus.OK, NagiosStatus.WARNING, NagiosStatus.UNKNOWN, NagiosStatus.CRITICAL]
+
+def worseStatus(status, other):
+    """ Return the more severe of two Nagios statuses. CRITICAL is worse than UNKNOWN """
+    if statusSeverity.index(other) > statusSeverity.index(status):
+        return other
+    return status
+
 # These are the common poolSettings that we will want to verify against
 defaultPoolSettings = { 'DirectProtect':1,
                         'ReACT':True,
@@ -180,6 +239,184 @@ def splitSubName(sub):
     else:
         return None
 
+class LastGoodControllers (object):
+    """ Remembers the controller of each subsystem that last answered, so it is tried
+        first on the next run. If a path is set, the cache is kept in that file so
+        that it survives restarts of the daemon. """
+    def __init__(self):
+        self.path = None
+        self.controllers = {}
+    def load(self, path):
+        """ Use path to persist the cache and read the entries already saved there """
+        self.path = path
+        try:
+            f = open(path,'r')
+        except IOError:
+            return
+        for line in f.readlines():
+            fields = line.split()
+            if len(fields) == 2:
+                self.controllers[fields[0]] = fields[1]
+        f.close()
+    def get(self, sub):
+        return self.controllers.get(sub)
+    def set(self, sub, con):
+        if self.controllers.get(sub) == con:
+            return
+        self.controllers[sub] = con
+        if self.path:
+            try:
+                tmp_path = self.path + ".tmp"
+                f = open(tmp_path,'w')
+                for (cached_sub,cached_con) in self.controllers.items():
+                    f.write("%s %s\n"%(cached_sub,cached_con))
+                f.close()
+                os.rename(tmp_path,self.path)
+            except (IOError, OSError):
+                pass
+
+# the controllers that last answered, shared by all checks started from this process
+lastGood = LastGoodControllers()
+
+class ControllerResolver (object):
+    """ Resolves controller names to IP addresses concurrently and caches them for
+        ttl seconds. The last known address of a name is used when the resolver fails
+        or does not answer in time. """
+    def __init__(self, ttl=defaultResolveTTL, timeout=defaultResolveTimeout):
+        self.ttl = ttl
+        self.timeout = timeout
+        # name -> (ip, time resolved)
+        self.cache = {}
+    def lookup(self, name, answers):
+        """ Resolve a single name in a resolver thread and put (name, ip, seconds) on answers """
+        start_time = time.time()
+        try:
+            ip = socket.getaddrinfo(name, None)[0][4][0]
+        except Exception:
+            ip = None
+        answers.put((name, ip, time.time() - start_time))
+    def resolve(self, names, verbose=False):
+        """ Returns a dictionary of name -> ip, with ip None for names that could not be resolved """
+        addresses = {}
+        toResolve = []
+        now = time.time()
+        for name in names:
+            if name in self.cache and (now - self.cache[name][1]) < self.ttl:
+                addresses[name] = self.cache[name][0]
+                if verbose:
+                    print "Resolved %s to %s (cached)"%(name,addresses[name])
+            elif not name in toResolve:
+                toResolve.append(name)
+
+        answers = Queue.Queue()
+        for name in toResolve:
+            resolverThread = threading.Thread(target=self.lookup, args=(name,answers))
+            resolverThread.daemon = True
+            resolverThread.start()
+
+        deadline = time.time() + self.timeout
+        for i in range(len(toResolve)):
+            try:
+                (name, ip, seconds) = answers.get(True, max(deadline - time.time(),0))
+            except Queue.Empty:
+                break
+            if ip:
+                self.cache[name] = (ip, time.time())
+                addresses[name] = ip
+                if verbose:
+                    print "Resolved %s to %s in %.3fs"%(name,ip,seconds)
+            elif verbose:
+                print "Could not resolve %s after %.3fs"%(name,seconds)
+
+        for name in toResolve:
+            if not name in addresses:
+                # resolver failed or too slow. fall back to the last known address
+                if name in self.cache:
+                    addresses[name] = self.cache[name][0]
+                    if verbose:
+                        print "Using last known address %s for %s"%(addresses[name],name)
+                else:
+                    addresses[name] = None
+        return addresses
+
+# resolved controller addresses, kept for the life of this process
+resolver = ControllerResolver()
+
+def probeController(ip, timeout):
+    """ Returns True if the API port of the controller accepts a connection within timeout seconds """
+    try:
+        sock = socket.create_connection((ip,APIPort),timeout)
+    except Exception:
+        return False
+    sock.close()
+    return True
+
+def raceControllers(candidates, timeout):
+    """ Probe all (name, ip) candidates at the same time and return them with the
+        first one to answer moved to the front """
+    answered = Queue.Queue()
+    for candidate in candidates:
+        probe = threading.Thread(target=lambda candidate=candidate: answered.put((candidate,probeController(candidate[1],timeout))))
+        probe.daemon = True
+        probe.start()
+    deadline = time.time() + timeout
+    for i in range(len(candidates)):
+        try:
+            (candidate,ok) = answered.get(True,max(deadline - time.time(),0))
+        except Queue.Empty:
+            break
+        if ok:
+            reordered = [candidate]
+            reordered.extend([ other for other in candidates if other != candidate ])
+            return reordered
+    return candidates
+
+def openAPI(host, auth, session=None):
+    """ Open the API context for host, or reuse the one kept by session, and
+        return the name of the storage system """
+    if session:
+        # persistent worker: reuse the session from the previous check if possible
+        reused = session.connect(host, auth)
+        try:
+            return SFAStorageSystem.get().Name
+        except Exception:
+            if not reused:
+                session.close()
+                raise
+            # the saved session has gone stale, log in again
+            session.reconnect()
+            return SFAStorageSystem.get().Name
+    else:
+        APIConnect("https://" + host, auth)
+        try:
+            return SFAStorageSystem.get().Name
+        except Exception:
+            APIDisconnect()
+            raise
+
+def connectController(controller, session=None):
+    """ Connect to the first controller of the subsystem that answers within the
+        connect timeout, trying them in the order of controller['candidates'].
+        Returns (name, ip, system name) of the controller that answered """
+    candidates = controller['candidates']
+    if controller.get('parallel_connect') and len(candidates) > 1:
+        candidates = raceControllers(candidates, controller['connect_timeout'])
+    error = None
+    for (name, ip) in candidates:
+        old_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(controller['connect_timeout'])
+        try:
+            try:
+                systemName = openAPI(ip, controller['auth'], session)
+            finally:
+                socket.setdefaulttimeout(old_timeout)
+        except Exception, err:
+            # refused, timed out or failed to log in. try the other controller
+            error = err
+            continue
+        return (name, ip, systemName)
+    raise error
+
 class SFASystem (object):
     """ Class to hold information about the SFA Subsystem """
     def __init__(self, controller ,poolSettings):
@@ -190,6 +427,11 @@ class SFASystem (object):
         self.poolSettings = poolSettings
         self.settingsString = setPoolSettingsString(self.poolSettings)
         self.systemName = ''
+        self.snapshot = SFASnapshot()
+        self.sub_name = controller.get('sub_name','')
+        # earlier samples of the error counters within the rate interval, None if no history is kept
+        self.counterHistory = controller.get('counter_history')
+        self.counterRates = controller.get('counter_rates',counterRateThresholds)
 
     def __init__(self, controller):
         """ Constructor without the poolSettings. We will set them to arbitrarily defined default is """
@@ -200,19 +442,871 @@ class SFASystem (object):
         self.poolSettings = defaultPoolSettings
         self.settingsString = setPoolSettingsString(self.poolSettings)
         self.systemName = ''
+        self.snapshot = SFASnapshot()
+        self.sub_name = controller.get('sub_name','')
+        # earlier samples of the error counters within the rate interval, None if no history is kept
+        self.counterHistory = controller.get('counter_history')
+        self.counterRates = controller.get('counter_rates',counterRateThresholds)
+
+class SFASnapshot (object):
+    """ Per-run cache of the objects fetched from a subsystem through the API
+
+        Each SFA class is fetched with getAll() at most once per run and the same
+        list is handed to every check that asks for it. The number of API fetches,
+        the number of requests served, the number of objects returned and the
+        time spent fetching are kept per class.
+
+        With useRecords, the objects of the classes in stateAttributes are kept as
+        ComponentRecords instead of API objects (see toRecords).
+    """
+    def __init__(self, useRecords=False):
+        self.useRecords = useRecords
+        self.objects = {}
+        self.fetchCount = {}
+        self.requestCount = {}
+        self.fetchTime = {}
+        # objects handed out by getAll(), counting every request
+        self.objectsReturned = 0
+    def getAll(self, SFAClass):
+        """ Return the cached list of SFAClass objects, fetching it on first use """
+        name = SFAClass.__name__
+        self.requestCount[name] = self.requestCount.get(name,0) + 1
+        if not name in self.objects:
+            start_time = time.time()
+            objects = SFAClass.getAll()
+            self.fetchTime[name] = self.fetchTime.get(name,0.0) + (time.time() - start_time)
+            self.fetchCount[name] = self.fetchCount.get(name,0) + 1
+            self.keep(name,objects)
+        self.objectsReturned += len(self.objects[name])
+        return self.objects[name]
+    def keep(self, name, objects):
+        if self.useRecords:
+            objects = toRecords(name,objects)
+        self.objects[name] = objects
+    def records(self):
+        """ The ComponentRecords fetched so far, by class name. Empty without useRecords """
+        records = {}
+        for name in self.objects:
+            if self.useRecords and name in componentRecordClasses:
+                records[name] = self.objects[name]
+        return records
+    def totals(self):
+        """ Return (getAll requests, API fetches, objects returned, seconds fetching) so far """
+        return (sum(self.requestCount.values()),sum(self.fetchCount.values()),self.objectsReturned,sum(self.fetchTime.values()))
+    def prefetch(self, SFAClasses, concurrency):
+        """ Fetch the given SFA classes in parallel using at most concurrency threads.
+
+            All requests go over the API context of this run. A class that fails to
+            fetch is left out of the cache, so the check that needs it will fetch it
+            again and report the error itself.
+        """
+        toFetch = []
+        for SFAClass in SFAClasses:
+            if not SFAClass.__name__ in self.objects and not SFAClass in toFetch:
+                toFetch.append(SFAClass)
+        if not toFetch:
+            return
+        threads = ThreadPool(min(concurrency,len(toFetch)))
+        try:
+            fetched = threads.map(timedGetAll, toFetch)
+        finally:
+            threads.close()
+            threads.join()
+        for (name,objects,seconds) in fetched:
+            if objects is None:
+                continue
+            self.keep(name,objects)
+            self.fetchTime[name] = self.fetchTime.get(name,0.0) + seconds
+            self.fetchCount[name] = self.fetchCount.get(name,0) + 1
+    def getStats(self):
+        """ Return a list of (class name, fetches, requests, objects, seconds) sorted by fetch time """
+        stats = []
+        for name in self.requestCount:
+            stats.append((name,self.fetchCount.get(name,0),self.requestCount[name],len(self.objects.get(name,[])),self.fetchTime.get(name,0.0)))
+        stats.sort(key=lambda stat: stat[4], reverse=True)
+        return stats
+    def getStatsStrings(self):
+        """ Format the per-class statistics for the extended output """
+        return statsStrings(self.getStats())
+
+def statsStrings(stats):
+    """ Format a list of SFASnapshot.getStats() tuples for the extended output """
+    statsStrings = []
+    totalTime = 0.0
+    for (name,fetches,requests,numObjects,seconds) in stats:
+        totalTime += seconds
+        statsStrings.append("{0}: {1} fetch(es) for {2} request(s), {3} objects in {4:.3f}s".format(name,fetches,requests,numObjects,seconds))
+    statsStrings.append("Total API fetch time: {0:.3f}s".format(totalTime))
+    return statsStrings
+
+def timedGetAll(SFAClass):
+    """ Fetch all objects of SFAClass. Returns (class name, objects, seconds) with
+        objects set to None if the fetch failed. Used by SFASnapshot.prefetch() """
+    start_time = time.time()
+    try:
+        objects = SFAClass.getAll()
+    except Exception:
+        objects = None
+    return (SFAClass.__name__, objects, time.time() - start_time)
+
+# The attributes of each SFA class that the checks read. An object of these classes
+# whose attributes are unchanged since the last run gets the same verdict, see
+# ComponentStateStore. Classes not listed here are always evaluated
+enclosureAttributes = ['HealthState','ChildHealthState','EnclosureIndex','Position','Location','Present','PredictFailure','SESStatus']
+stateAttributes = { 'SFAController': ['HealthState','ChildHealthState','State','Name','VendorEquipmentType','RestartPending','MIRReason','ICCState','ICCProtocolVersion'],
+                    'SFADiskChannel': ['HealthState','ChildHealthState','LinkState','ControllerIndex','PortLocation','CurrentSpeed','AvailableSpeeds',
+                                       'CurrentWidth','ExpectedWidth','IOCPort','PHYs','CurrentPosition','ExpectedPosition'],
+                    'SFAHostChannel': ['HealthState','ChildHealthState','LinkState','ControllerIndex','Speed','AvailableSpeeds'],
+                    'SFARAIDProcessor': ['HealthState','ChildHealthState','ControllerIndex','IndexOnController'],
+                    'SFAICLIOC': ['HealthState','ChildHealthState','ControllerIndex'],
+                    'SFAICLChannel': ['HealthState','ChildHealthState','LinkState','ControllerIndex','CurrentSpeed','ICLIOCType','InfinibandCurrentWidth',
+                                      'InfinibandPortState','ErrorStatisticNames','ErrorStatisticCounts'],
+                    'SFAStoragePool': ['HealthState','ChildHealthState','PoolState','HomeControllerIndex','PreferredHomeControllerIndex','HomeControllerRPIndex',
+                                       'PreferredHomeControllerRPIndex','AutoWriteLocked','Rebuilding','BadBlockCount'] + defaultPoolSettings.keys(),
+                    'SFAVirtualDisk': ['HealthState','ChildHealthState','State','BadBlockCount'],
+                    'SFAInternalDiskDrive': ['HealthState','ChildHealthState','MirrorState','EnclosureIndex','Name','Present','PredictFailure','SESStatus'],
+                    'SFADiskDrive': ['HealthState','ChildHealthState','State','EnclosureIndex','DiskSlotNumber','SerialNumber','MemberState','DiskHealthState'],
+                    'SFAExpander': enclosureAttributes,
+                    'SFASEP': enclosureAttributes,
+                    'SFAFan': enclosureAttributes + ['PoweredOn'],
+                    'SFAIOC': ['HealthState','ChildHealthState','ControllerIndex','RPIndexOnController','Slot','ChannelCount'],
+                    'SFAPowerSupply': enclosureAttributes + ['PowerState','ACFailure','DCFailure','TemperatureFailure','TemperatureWarning'],
+                    'SFAUPS': ['HealthState','ChildHealthState','EnclosureIndex','Present','Enabled','ACFailure','UPSFailure','InterfaceFailure',
+                               'PredictFailure','SESStatus','WarningStatus'],
+                    'SFATemperatureSensor': enclosureAttributes + ['TemperatureFailure','TemperatureWarning'],
+                    'SFAVoltageSensor': enclosureAttributes + ['OverVoltageFailure','OverVoltageWarning','UnderVoltageFailure','UnderVoltageWarning'] }
+
+class Unset (object):
+    """ Stands for a field of a ComponentRecord that the API object did not have, when
+        the record is pickled. The field stays unset, so reading it raises AttributeError
+        like it did on the API object """
+
+class ComponentRecord (object):
+    """ Base of the compact records that stand in for the API objects of the classes in
+        stateAttributes. A record only has __slots__ for Index, the stateAttributes and the
+        componentIdentifiers of its class, so it holds no reference to the API or its
+        session, takes a fraction of the memory of the API object and pickles as a
+        tuple of values. See componentRecordClass() """
+    __slots__ = ()
+    def values(self):
+        values = []
+        for field in self.__slots__:
+            values.append(getattr(self,field,Unset))
+        return tuple(values)
+    def __reduce__(self):
+        return (makeComponentRecord, (self.__class__.__name__, self.values()))
+
+def makeComponentRecord(className, values):
+    """ Rebuild a pickled ComponentRecord """
+    record = componentRecordClasses[className]()
+    for (field, value) in zip(record.__slots__,values):
+        if value is not Unset:
+            setattr(record,field,value)
+    return record
+
+def componentRecordClass(className):
+    """ The ComponentRecord class of the SFA class className """
+    fields = ['Index'] + stateAttributes[className]
+    identifiers = [ identifier for identifier in componentIdentifiers if not identifier in fields ]
+    # named like the SFA class, so the components are named the same from either
+    return type(className, (ComponentRecord,), { '__slots__': tuple(fields + identifiers) })
+
+# class name -> ComponentRecord class. SFASnapshot with useRecords keeps the objects of these classes as records
+componentRecordClasses = {}
+for className in stateAttributes:
+    componentRecordClasses[className] = componentRecordClass(className)
+
+def toRecords(className, objects):
+    """ The API objects of class className as ComponentRecords, if it has a record class.
+        The attributes an object lacks are left unset in its record """
+    recordClass = componentRecordClasses.get(className)
+    if recordClass is None or not objects:
+        return objects
+    records = []
+    for object in objects:
+        record = recordClass()
+        for field in recordClass.__slots__:
+            try:
+                setattr(record,field,getattr(object,field))
+            except AttributeError:
+                pass
+        records.append(record)
+    return records
+
+# classes with list valued stateAttributes
+listAttributes = ['SFADiskChannel','SFAICLChannel']
+
+indexGetter = operator.attrgetter('Index')
+
+# counters change all the time, so they invalidate verdicts but are not reported as state changes
+counterAttributes = ['BadBlockCount','ErrorStatisticCounts']
+
+# enums used to name the values of attributes in state change events. State depends on the class
+stateEnums = { 'HealthState': SFAHealthState, 'ChildHealthState': SFAHealthState, 'LinkState': SFALinkState,
+               'SESStatus': SFASESStatus, 'MemberState': SFADiskMemberState, 'DiskHealthState': SFADiskHealthState,
+               'PoolState': SFAPoolState, 'MirrorState': SFAMirrorState, 'ICCState': SFAICCState, 'MIRReason': SFAMIRReason,
+               'InfinibandPortState': SFAIBPortState, 'WarningStatus': SFAWarningStatus,
+               ('SFADiskDrive','State'): SFADiskState, ('SFAController','State'): SFAConState, ('SFAVirtualDisk','State'): SFAVDState }
+
+def stateValueName(className, attribute, value):
+    """ The enum name of value if the attribute is an enum, otherwise value """
+    enum = stateEnums.get((className,attribute))
+    if enum is None:
+        enum = stateEnums.get(attribute)
+    if enum is None:
+        return value
+    return enum.reverse_mapping.get(value,value)
+
+# operator.attrgetter() of the stateAttributes of each class
+stateGetters = {}
+
+def componentStates(name, objects):
+    """ The (Index list, stateAttributes tuple list) of a list of objects of class name.
+        Missing attributes are None, and list values are turned into tuples """
+    attributes = stateAttributes[name]
+    if not name in stateGetters:
+        stateGetters[name] = operator.attrgetter(*attributes)
+    try:
+        indexes = map(indexGetter,objects)
+        values = map(stateGetters[name],objects)
+        if len(attributes) == 1:
+            # the attrgetter of a single attribute returns its value, not a tuple
+            values = [ (value,) for value in values ]
+    except AttributeError:
+        indexes = []
+        values = []
+        for position,object in enumerate(objects):
+            indexes.append(getattr(object,'Index',position))
+            objectValues = []
+            for attribute in attributes:
+                try:
+                    objectValues.append(getattr(object,attribute))
+                except Exception:
+                    objectValues.append(None)
+            values.append(tuple(objectValues))
+    if name in listAttributes:
+        # lists may be changed in place, keep a copy
+        values = [ tuple([ tuple(value) if isinstance(value,list) else value for value in objectValues ]) for objectValues in values ]
+    return (indexes, values)
+
+def stateFingerprint(name, objects):
+    """ A hash of the state attributes of a list of objects of class name. The workers
+        compare it with the fingerprint a verdict was made with to reuse the verdict """
+    (indexes, values) = componentStates(name, objects)
+    return hash((tuple(indexes), tuple(values)))
+
+class ComponentStateStore (object):
+    """ Keeps the attributes the checks read (stateAttributes) of every object of the
+        subsystems checked, keyed by sub_name, class and Index, and the verdicts of the
+        checks.
+
+        The store lives in the process that hands the checks to an APIworkerPool, so a
+        subsystem keeps its state whichever worker or controller checks it. prepare()
+        asks the check of a subsystem for the records of its objects (see toRecords) and
+        hands it the verdicts of the last runs. update() compares the records that come
+        back with the last ones seen and returns the changes of the state attributes
+        (other than counters) as events.
+
+        The fingerprint (see stateFingerprint) of each class is kept too. A check only
+        sends back the records of the classes whose fingerprint changed, and reuses the
+        verdict of a check module instead of evaluating it again if the classes it read
+        still have the fingerprints the verdict was made with.
+
+        The state of a subsystem that has not been checked for maxAge seconds is dropped,
+        so it is not compared with a stale one. forget() drops it at once.
+    """
+    def __init__(self, maxAge=defaultStateMaxAge):
+        self.maxAge = maxAge
+        # sub_name -> { 'states': { class name: { Index: attribute values } },
+        #               'fingerprints': { class name: fingerprint of its states },
+        #               'verdicts': { key: (fingerprints, verdict) },
+        #               'updated': time of the last update }
+        self.subsystems = {}
+    def getSubsystem(self, sub_name):
+        if not sub_name in self.subsystems:
+            self.subsystems[sub_name] = { 'states': {}, 'fingerprints': {}, 'verdicts': {}, 'updated': time.time() }
+        return self.subsystems[sub_name]
+    def forget(self, sub_name):
+        self.subsystems.pop(sub_name, None)
+    def expire(self, now):
+        for sub_name in self.subsystems.keys():
+            if self.subsystems[sub_name]['updated'] < now - self.maxAge:
+                del self.subsystems[sub_name]
+    def prepare(self, controller):
+        """ Ask the check of controller for the records and fingerprints of its objects,
+            and give it the verdicts of the last runs of its subsystem """
+        self.expire(time.time())
+        subsystem = self.subsystems.get(controller['sub_name'])
+        if subsystem is None:
+            controller['fingerprints'] = {}
+            controller['verdicts'] = {}
+        else:
+            controller['fingerprints'] = subsystem['fingerprints']
+            controller['verdicts'] = subsystem['verdicts']
+    def update(self, result):
+        """ Compare the records in the result of a check prepared with prepare() with the
+            last run of its subsystem, keep its new verdicts and return the list of state
+            change events, also left in result['events'] """
+        subsystem = self.getSubsystem(result['sub_name'])
+        subsystem['updated'] = time.time()
+        records = result.get('records') or {}
+        events = []
+        for (name, fingerprint) in result.get('fingerprints',[]):
+            if fingerprint is not None and fingerprint == subsystem['fingerprints'].get(name):
+                # unchanged, the check sent no records
+                continue
+            if not name in records:
+                # a failed fetch, or records left out for a state this store no longer has
+                fingerprint = None
+            subsystem['fingerprints'][name] = fingerprint
+            if fingerprint is None:
+                # unknown state, no events until it is known again
+                subsystem['states'][name] = {}
+                continue
+            (indexes, values) = componentStates(name, records[name])
+            states = dict(zip(indexes, values))
+            old = subsystem['states'].get(name)
+            subsystem['states'][name] = states
+            # no events for the first run, or after a failed fetch
+            if old and old != states:
+                events.extend(self.diff(name,stateAttributes[name],old,states))
+        subsystem['verdicts'].update(result.get('verdicts',{}))
+        result['events'] = events
+        return events
+    def diff(self, name, attributes, old, new):
+        """ The state change events between two sets of objects of class name """
+        events = []
+        for index in sorted(set(old.keys() + new.keys())):
+            if old.get(index) == new.get(index):
+                continue
+            if not index in new:
+                events.append(self.event(name,index,attributes,old[index],'object','present','removed'))
+            elif not index in old:
+                events.append(self.event(name,index,attributes,new[index],'object','absent','added'))
+            else:
+                for (attribute,oldValue,newValue) in zip(attributes,old[index],new[index]):
+                    if oldValue != newValue and not attribute in counterAttributes:
+                        events.append(self.event(name,index,attributes,new[index],attribute,
+                                                 stateValueName(name,attribute,oldValue),stateValueName(name,attribute,newValue)))
+        return events
+    def event(self, name, index, attributes, values, attribute, old, new):
+        event = { 'class': name, 'Index': index, 'attribute': attribute, 'old': old, 'new': new }
+        identifiers = ''
+        for (identifier,value) in zip(attributes,values):
+            if identifier in componentIdentifiers:
+                event[identifier] = value
+                identifiers += " {0}: {1}".format(identifier,value)
+        event['description'] = "{0} Index: {1}{2}; {3}: {4} -> {5}".format(name,index,identifiers,attribute,old,new)
+        return event
+
+# set by long-running callers (the pass persist daemon, the exporter) to a ComponentStateStore
+# to skip the checks of unchanged objects and report state changes. Used by the APIworkerPool
+# in the process that creates it, the workers only get the verdicts of their subsystem
+stateStore = None
+
+def encodeVarint(value, out):
+    """ Append the unsigned integer value to the bytearray out, 7 bits per byte """
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decodeVarint(data, offset):
+    """ Returns (value, offset after it) for the varint at offset in the bytearray data.
+        Raises IndexError if data ends in the middle of it """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value, offset)
+        shift += 7
+
+def zigzag(value):
+    """ Map signed to unsigned integers so that small deltas of either sign stay small """
+    if value >= 0:
+        return value * 2
+    return -value * 2 - 1
+
+def unzigzag(value):
+    if value & 1:
+        return -(value + 1) / 2
+    return value / 2
+
+def isIntegral(value):
+    return value == int(value) and abs(value) < 2 ** 53
+
+class HistorySeries (object):
+    """ The samples of one component value, in time order """
+    __slots__ = ('times', 'values')
+    def __init__(self):
+        self.times = array('l')
+        self.values = array('d')
+
+class HistoryStore (object):
+    """ Append-only history of the numeric component values (APICheck.recordMetric())
+        of each run, kept in memory as array columns per series and in a file so it
+        survives restarts. A series is identified by the key (sub_name, metric name,
+        sorted label items) returned by seriesKey().
+
+        The file starts with historyMagic and is a sequence of records:
+          'S' id key       defines series id, key is JSON [sub_name, name, [[label, value], ...]]
+          'T' time count (id value)*count   the values of a run, time in seconds
+        Integers (ids, counts, lengths) are varints. The time is the zigzag delta from the
+        previous 'T' record. A value is the zigzag delta from the previous value of its
+        series shifted left by one bit, or 1 followed by a little endian double when
+        either value is not an integer. A record cut short by a crash is dropped when the
+        file is read.
+
+        Samples older than retention seconds are dropped from memory as new ones are
+        added, and the file is rewritten without them once they outnumber the samples
+        kept. A history file must only be written by a single process. """
+    historyMagic = "SFAHIST1\n"
+    def __init__(self, retention=defaultHistoryRetention):
+        self.retention = retention
+        self.path = None
+        self.file = None
+        self.series = {}
+        # on disk: key -> series id, and the last time and value written for the deltas
+        self.ids = {}
+        self.lastTime = 0
+        self.lastValues = {}
+        self.samples = 0
+        self.expired = 0
+    def load(self, path):
+        """ Use path to persist the history and read the samples already saved there """
+        self.path = path
+        try:
+            f = open(path,'rb')
+            data = bytearray(f.read())
+            f.close()
+        except IOError:
+            data = bytearray()
+        if not data:
+            good = 0
+        elif data[:len(self.historyMagic)] == bytearray(self.historyMagic):
+            good = self.parse(data)
+        else:
+            raise ValueError("%s is not an sfa_check history file"%path)
+        if good == 0:
+            self.file = open(path,'wb')
+            self.file.write(self.historyMagic)
+        else:
+            self.file = open(path,'r+b')
+            # drop a record cut short by a crash
+            self.file.truncate(good)
+            self.file.seek(good)
+        self.file.flush()
+        self.expire(int(time.time()))
+    def parse(self, data):
+        """ Read the records in data into memory. Returns the offset after the last complete record """
+        offset = len(self.historyMagic)
+        good = offset
+        keys = {}
+        try:
+            while offset < len(data):
+                recordType = chr(data[offset])
+                offset += 1
+                if recordType == 'S':
+                    (id, offset) = decodeVarint(data, offset)
+                    (length, offset) = decodeVarint(data, offset)
+                    if offset + length > len(data):
+                        break
+                    (sub_name, name, labels) = json.loads(str(data[offset:offset + length]))
+                    offset += length
+                    key = (sub_name, name, tuple([ tuple(label) for label in labels ]))
+                    keys[id] = key
+                    self.ids[key] = id
+                elif recordType == 'T':
+                    (delta, offset) = decodeVarint(data, offset)
+                    now = self.lastTime + unzigzag(delta)
+                    (count, offset) = decodeVarint(data, offset)
+                    samples = []
+                    # kept apart until the whole record has parsed, so the values of a
+                    # record cut short never become the base of later deltas
+                    lastValues = {}
+                    for i in range(count):
+                        (id, offset) = decodeVarint(data, offset)
+                        (encoded, offset) = decodeVarint(data, offset)
+                        last = lastValues.get(id, self.lastValues.get(id, 0.0))
+                        if encoded == 1:
+                            if offset + 8 > len(data):
+                                raise IndexError
+                            value = struct.unpack('<d', str(data[offset:offset + 8]))[0]
+                            offset += 8
+                        else:
+                            value = last + unzigzag(encoded >> 1)
+                        samples.append((keys[id], value))
+                        lastValues[id] = value
+                    self.lastValues.update(lastValues)
+                    self.lastTime = now
+                    for (key, value) in samples:
+                        self.append(key, now, value)
+                else:
+                    break
+                good = offset
+        except (IndexError, ValueError, KeyError):
+            pass
+        return good
+    def append(self, key, now, value):
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = HistorySeries()
+        series.times.append(now)
+        series.values.append(value)
+        self.samples += 1
+    def record(self, sub_name, metrics, now=None):
+        """ Add the values of a run of sub_name, a list of (name, labels, value) as in
+            the metrics of a result, and append them to the history file """
+        if now is None:
+            now = time.time()
+        now = int(now)
+        self.write(sub_name, metrics, now)
+        self.expire(now)
+    def write(self, sub_name, metrics, now):
+        """ Add the values to memory and append them to the history file """
+        out = bytearray()
+        run = bytearray()
+        count = 0
+        for (name, labels, value) in metrics:
+            if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                continue
+            value = float(value)
+            key = seriesKey(sub_name, name, labels)
+            self.append(key, now, value)
+            if self.file is None:
+                continue
+            if not key in self.ids:
+                id = self.ids[key] = len(self.ids)
+                out.append(ord('S'))
+                encodeVarint(id, out)
+                definition = json.dumps([key[0], key[1], key[2]])
+                encodeVarint(len(definition), out)
+                out.extend(definition)
+            id = self.ids[key]
+            encodeVarint(id, run)
+            last = self.lastValues.get(id, 0.0)
+            if isIntegral(value) and isIntegral(last):
+                encodeVarint(zigzag(int(value) - int(last)) << 1, run)
+            else:
+                encodeVarint(1, run)
+                run.extend(struct.pack('<d', value))
+            self.lastValues[id] = value
+            count += 1
+        if count and self.file is not None:
+            out.append(ord('T'))
+            encodeVarint(zigzag(now - self.lastTime), out)
+            encodeVarint(count, out)
+            out.extend(run)
+            self.lastTime = now
+            self.file.write(str(out))
+            self.file.flush()
+    def expire(self, now):
+        """ Drop the samples older than the retention, and rewrite the file once most
+            of it is expired samples """
+        oldest = now - self.retention
+        for key in self.series.keys():
+            series = self.series[key]
+            if series.times and series.times[0] < oldest:
+                drop = bisect.bisect_left(series.times, oldest)
+                del series.times[:drop]
+                del series.values[:drop]
+                self.samples -= drop
+                self.expired += drop
+                if not series.times:
+                    del self.series[key]
+        if self.file is not None and self.expired > self.samples:
+            self.compact()
+    def compact(self):
+        """ Rewrite the history file with the samples kept in memory """
+        runs = {}
+        for key in self.series:
+            series = self.series[key]
+            for (now, value) in zip(series.times, series.values):
+                if not (now, key[0]) in runs:
+                    runs[(now, key[0])] = []
+                runs[(now, key[0])].append((key[1], dict(key[2]), value))
+        self.file.close()
+        self.file = None
+        tmp_path = self.path + ".tmp"
+        compacted = HistoryStore(self.retention)
+        compacted.path = tmp_path
+        compacted.file = open(tmp_path,'wb')
+        compacted.file.write(self.historyMagic)
+        for (now, sub_name) in sorted(runs):
+            compacted.write(sub_name, runs[(now, sub_name)], now)
+        compacted.file.close()
+        os.rename(tmp_path, self.path)
+        self.ids = compacted.ids
+        self.lastTime = compacted.lastTime
+        self.lastValues = compacted.lastValues
+        self.expired = 0
+        self.file = open(self.path,'ab')
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    def find(self, sub_name, name, **labels):
+        """ The keys of the series of metric name of sub_name that have the given labels """
+        keys = []
+        for key in self.series:
+            if key[0] != sub_name or key[1] != name:
+                continue
+            keyLabels = dict(key[2])
+            for label in labels:
+                if keyLabels.get(label) != labels[label]:
+                    break
+            else:
+                keys.append(key)
+        keys.sort()
+        return keys
+    def range(self, key, start=None, end=None):
+        """ The (times, values) arrays of series key from start to end, inclusive """
+        series = self.series.get(key)
+        if series is None:
+            return (array('l'), array('d'))
+        first = 0
+        last = len(series.times)
+        if start is not None:
+            first = bisect.bisect_left(series.times, int(start))
+        if end is not None:
+            last = bisect.bisect_right(series.times, int(end))
+        return (series.times[first:last], series.values[first:last])
+    def window(self, sub_name, names, start):
+        """ The samples of the series of sub_name with a metric name in names from start
+            on, as { key: (times, values) } """
+        samples = {}
+        for key in self.series:
+            if key[0] == sub_name and key[1] in names:
+                (times, values) = self.range(key, start)
+                if times:
+                    samples[key] = (times, values)
+        return samples
+    def latest(self, key):
+        """ (time, value) of the last sample of series key, or None """
+        series = self.series.get(key)
+        if series is None or not series.times:
+            return None
+        return (series.times[-1], series.values[-1])
+    def increase(self, key, seconds, now=None):
+        """ Returns (increase, seconds covered) of the counter series key over the last
+            seconds. A value lower than the previous one is a counter reset, and the
+            counter is taken to have counted from zero since. None with fewer than two
+            samples """
+        if now is None:
+            now = time.time()
+        (times, values) = self.range(key, now - seconds, now)
+        if len(times) < 2:
+            return None
+        return (counterIncrease(values), times[-1] - times[0])
+    def rate(self, key, seconds, now=None):
+        """ Per second increase of the counter series key over the last seconds, or None """
+        increase = self.increase(key, seconds, now)
+        if increase is None or increase[1] <= 0:
+            return None
+        return increase[0] / increase[1]
+
+def counterIncrease(values):
+    """ The increase of a counter over successive values. A value lower than the previous
+        one is a counter reset, and the counter is taken to have counted from zero since """
+    increase = 0.0
+    previous = values[0]
+    for value in values[1:]:
+        if value >= previous:
+            increase += value - previous
+        else:
+            increase += value
+        previous = value
+    return increase
+
+def seriesKey(sub_name, name, labels):
+    items = labels.items()
+    items.sort()
+    return (sub_name, name, tuple(items))
+
+# lines of messages shown per check in the extended output, 0 for all. Set by
+# sfa_check.py --max-lines
+extendedLineLimit = defaultLineLimit
+
+# set by callers that keep the component values of each run (the pass persist daemon,
+# the exporter, sfa_check.py --history) to a HistoryStore
+history = None
+
+def newTiming(name):
+    """ An empty timing record for a check or a subsystem. Times are in seconds,
+        api_wait is the part of wall spent waiting for the API and eval the rest """
+    return { 'name': name, 'wall': 0.0, 'api_wait': 0.0, 'eval': 0.0,
+             'getall_calls': 0, 'api_fetches': 0, 'objects': 0 }
+
+def timingStrings(timing):
+    """ Format the timing of a subsystem and its checks for the extended output """
+    timingStrings = []
+    checks = list(timing.get('checks',[]))
+    checks.sort(key=lambda check: check['wall'], reverse=True)
+    for (name,check) in [ (check['name'],check) for check in checks ] + [('Total',timing)]:
+        timingStrings.append("{0}: {1:.3f}s (API {2:.3f}s, eval {3:.3f}s), {4} getAll call(s), {5} API fetch(es), {6} objects".format(
+            name,check['wall'],check['api_wait'],check['eval'],check['getall_calls'],check['api_fetches'],check['objects']))
+    return timingStrings
+
+# How likely a faulted component is to be the cause of the other faults of its enclosure.
+# The SES processor and the expanders report on everything behind them, a power supply
+# takes down the fans and sensors it feeds, and disk drives fail on their own
+enclosureRootRank = { 'SFASEP': 4, 'SFAExpander': 3, 'SFAPowerSupply': 2, 'SFAUPS': 2,
+                      'SFAFan': 1, 'SFATemperatureSensor': 1, 'SFAVoltageSensor': 1 }
+
+def enclosureRollups(checks):
+    """ Group the faulted components of all checks by EnclosureIndex, in one pass. Returns
+        one dict per enclosure with a fault, by EnclosureIndex: its worst rc, the number of
+        faults, the number of faults per check, the Positions with a fault, the components
+        (each with the name of its check) and the likely root component.
+
+        The root is the highest in enclosureRootRank, then the one at the Position with the
+        most faults, then the worst """
+    enclosures = {}
+    for check in checks:
+        for component in check.get('components',[]):
+            if component['rc'] == NagiosStatus.OK or component.get('EnclosureIndex') is None:
+                continue
+            index = component['EnclosureIndex']
+            if not index in enclosures:
+                enclosures[index] = { 'EnclosureIndex': index, 'rc': NagiosStatus.OK, 'faults': 0,
+                                      'checks': {}, 'positions': {}, 'components': [], 'root': None }
+            enclosure = enclosures[index]
+            enclosure['rc'] = worseStatus(enclosure['rc'],component['rc'])
+            enclosure['faults'] += 1
+            enclosure['checks'][check['name']] = enclosure['checks'].get(check['name'],0) + 1
+            if component.get('Position') is not None:
+                enclosure['positions'][component['Position']] = enclosure['positions'].get(component['Position'],0) + 1
+            enclosure['components'].append(dict(component, check=check['name']))
+
+    rollups = []
+    for index in sorted(enclosures):
+        enclosure = enclosures[index]
+        positions = enclosure['positions']
+        def rootKey(component):
+            return (enclosureRootRank.get(component['class'],0),positions.get(component.get('Position'),0),
+                    statusSeverity.index(component['rc']))
+        enclosure['root'] = max(enclosure['components'],key=rootKey)
+        enclosure['positions'] = sorted(positions)
+        rollups.append(enclosure)
+    return rollups
+
+def enclosureStrings(enclosures):
+    """ Format the enclosure rollups of enclosureRollups() for the extended output """
+    enclosureStrings = []
+    for enclosure in enclosures:
+        checks = ', '.join([ "%s %d"%(name,enclosure['checks'][name]) for name in sorted(enclosure['checks']) ])
+        positions = ''
+        if enclosure['positions']:
+            positions = " at Position %s"%','.join([ str(position) for position in enclosure['positions'] ])
+        root = enclosure['root']
+        identifiers = ''.join([ " %s: %s"%(identifier,root[identifier]) for identifier in componentIdentifiers
+                                if identifier != 'EnclosureIndex' and identifier in root ])
+        enclosureStrings.append("Enclosure %s: %s, %d fault(s) (%s)%s; likely root: %s%s"%(
+            enclosure['EnclosureIndex'],NagiosStatus.reverse_mapping[enclosure['rc']],enclosure['faults'],checks,positions,root['check'],identifiers))
+    return enclosureStrings
+
+def newResult(controller):
+    """ The structured result of the check of a subsystem that call_API fills in and
+        renderNagios() turns into the Nagios output. checks holds one dict per check
+        module with its rc, fault counts, message, output lines (messages) and the
+        components it found faulted, each with the identifiers it has (Index,
+        EnclosureIndex, SerialNumber...), rc and messages. enclosures holds the faulted
+        components grouped by enclosure (see enclosureRollups). If the controller asks for
+        records, records holds the ComponentRecords of the run by class name """
+    result = { 'sub_name': controller['sub_name'], 'system_name': '', 'controller': None,
+               'production': controller['production'], 'rc': NagiosStatus.UNKNOWN,
+               'numChecksWARNING': 0, 'numChecksUNKNOWN': 0, 'numChecksCRITICAL': 0,
+               'checks': [], 'metrics': [], 'api_stats': [], 'enclosures': [], 'timing': newTiming(controller['sub_name']) }
+    result['timing']['checks'] = []
+    return result
+
+class SubsystemResult (tuple):
+    """ The (sub_name, ret_str, rc) result of the check of a subsystem. It unpacks like
+        a plain tuple and also carries the structured result (see newResult) along with
+        its timing, checks, metrics and records, which are None if the check did not
+        complete or, for records, were not asked for """
+    def __new__(cls, sub_name, ret_str, rc, result=None):
+        self = tuple.__new__(cls, (sub_name, ret_str, rc))
+        self.result = result
+        self.timing = self.checks = self.metrics = self.records = None
+        if result:
+            self.timing = result['timing']
+            self.checks = result['checks']
+            self.metrics = result['metrics']
+            self.records = result.get('records')
+        return self
+    def asDict(self):
+        """ The structured result with the Nagios output, for JSON output """
+        (sub_name, ret_str, rc) = self
+        asDict = { 'sub_name': sub_name, 'rc': rc, 'checks': [] }
+        if self.result:
+            asDict.update(self.result)
+        asDict['rc'] = rc
+        asDict['output'] = ret_str
+        return asDict
+
+class APISession (object):
+    """ The API session of a persistent worker process.
+
+        The API keeps a single current execution context per process, so a worker
+        holds at most one open session. It is reused while the worker keeps checking
+        the same controller and is closed once it has been idle for maxIdle seconds.
+    """
+    def __init__(self, maxIdle=defaultSessionIdle):
+        self.maxIdle = maxIdle
+        self.host = None
+        self.auth = None
+        self.lastUsed = 0
+    def connect(self, host, auth):
+        """ Make sure a session to host is open. Returns True if an existing session was reused """
+        if self.host == host and self.auth == auth and (time.time() - self.lastUsed) < self.maxIdle:
+            return True
+        self.close()
+        APIConnect("https://" + host, auth)
+        self.host = host
+        self.auth = auth
+        return False
+    def reconnect(self):
+        """ Drop the current session and log in again """
+        (host, auth) = (self.host, self.auth)
+        self.close()
+        self.connect(host, auth)
+    def release(self):
+        """ Mark the end of a check, the session stays open for the next one """
+        self.lastUsed = time.time()
+    def expire(self):
+        """ Close the session if it has been idle for too long """
+        if self.host and (time.time() - self.lastUsed) >= self.maxIdle:
+            self.close()
+    def close(self):
+        if self.host:
+            try:
+                APIDisconnect()
+            except Exception:
+                pass
+        self.host = None
+        self.auth = None
 
 class APIworker (object):
-    def __init__(self, controller, modules, verbose, nagiosMode):
+    def __init__(self, controller, modules, verbose, nagiosMode, checkConcurrency=1, timeout=defaultTimeout):
         self.verbose = verbose
         self.modules = modules
         self.controller = controller
         self.nagiosMode = nagiosMode
-    def run(self):
+        self.checkConcurrency = checkConcurrency
+        self.timeout = timeout
+    def run(self, session=None):
         rc = NagiosStatus.UNKNOWN
         try:
-            (ret_str, rc) = call_API(self.controller,self.modules,self.verbose,self.nagiosMode)
+            (ret_str, rc) = call_API(self.controller,self.modules,self.verbose,self.nagiosMode,self.checkConcurrency,session)
         except Exception, err:
             # there was another error while calling the checks for this subsystem 
+            if session:
+                # don't trust the session for the next check
+                session.close()
             rc = NagiosStatus.UNKNOWN
             ret_str = "%s: %s"%(self.controller['sub_name'].split(",")[0],"UNKNOWN: Python Exception")
             if not self.nagiosMode:
@@ -261,97 +1355,223 @@ class checkList (object):
             if component == "host_chan":
                 self.checks.append(HostChannelCheck(thisSFA,verbose,nagiosMode))
 
-def call_API(controller,modules,verbose,nagiosMode):
-    rc = 1
-    ret_str = []
-    new_rc = 0
-    returnStrings = []
-    numChecksWARNING = 0
-    numChecksUNKNOWN = 0
-    numChecksCRITICAL = 0 
+def call_API(controller,modules,verbose,nagiosMode,checkConcurrency=1,session=None):
+    """ Run the checks in modules on the subsystem of controller. Returns the Nagios
+        (ret_str, rc) and leaves the structured result it was rendered from (see
+        newResult) in controller['result'] """
     if nagiosMode:
       devnull = open(os.devnull, 'w')
       sys.stderr = devnull
 
     thisSFA = SFASystem(controller)
+    # the verdicts of the last runs, if a ComponentStateStore prepared the check
+    verdicts = controller.get('verdicts')
+    # records are cheaper to send back to the state store than API objects
+    thisSFA.snapshot.useRecords = verdicts is not None or controller.get('records',False)
+    result = newResult(controller)
+
+    # wall time, API wait and getAll() counts of the subsystem and of each check
+    timing = result['timing']
+    start_time = time.time()
 
-    sfa = APIConnect("https://" + thisSFA.host, thisSFA.auth)
-    thisSFA.systemName = SFAStorageSystem.get().Name
+    # fail over to the other controller if the first one does not answer, and
+    # let the caller know which one did
+    (controller['answered'], thisSFA.host, thisSFA.systemName) = connectController(controller,session)
+    timing['connect'] = time.time() - start_time
+    result['controller'] = controller['answered']
+    result['system_name'] = thisSFA.systemName
+
+    checks = checkList(thisSFA,modules,verbose,nagiosMode).checks
+
+    # optionally fetch everything the checks need in parallel. The checks below then
+    # run in order against the snapshot, so the output does not depend on fetch order
+    if checkConcurrency > 1:
+        SFAClasses = []
+        for check in checks:
+            SFAClasses.extend(check.SFAClasses)
+        prefetch_start = time.time()
+        thisSFA.snapshot.prefetch(SFAClasses,checkConcurrency)
+        timing['prefetch'] = time.time() - prefetch_start
+
+    # fingerprint the objects, so the checks of unchanged objects can reuse their
+    # verdicts. The state store compares the records with the last run for the events
+    result['events'] = []
+    fingerprints = {}
+    if verdicts is not None:
+        result['fingerprints'] = []
+        result['verdicts'] = {}
+        before = thisSFA.snapshot.totals()
+        diff_start = time.time()
+        for check in checks:
+            for SFAClass in check.SFAClasses:
+                name = SFAClass.__name__
+                if not name in stateAttributes or name in fingerprints:
+                    continue
+                try:
+                    fingerprints[name] = stateFingerprint(name,thisSFA.snapshot.getAll(SFAClass))
+                except Exception:
+                    # unknown state, the check will fetch it again and report the error
+                    fingerprints[name] = None
+                result['fingerprints'].append((name,fingerprints[name]))
+        timing['diff'] = time.time() - diff_start
+        timing['diff_api_wait'] = thisSFA.snapshot.totals()[3] - before[3]
 
     # run the checks
-    for check in checkList(thisSFA,modules,verbose,nagiosMode).checks:
-        check_return_string = []
+    for check in checks:
+        check_timing = newTiming(check.description)
+        timing['checks'].append(check_timing)
+        # a check that raises is reported as a single UNKNOWN
+        check_result = { 'name': check.description, 'rc': NagiosStatus.UNKNOWN,
+                         'numChecksWARNING': 0, 'numChecksUNKNOWN': 1, 'numChecksCRITICAL': 0,
+                         'message': '', 'messages': [], 'components': [], 'exception': None, 'cached': False }
+        result['checks'].append(check_result)
+        before = thisSFA.snapshot.totals()
+        check_start = time.time()
         try:
-            check_results = check.doCheck()
-            grammar = "Checks"
-            # if check rc is higher than overall rc, change it
-            if check_results['rc'] > new_rc:
-                new_rc = check_results['rc']
-         
-            # update overall check counts
-            numChecksWARNING += check_results['numChecksWARNING']
-            numChecksUNKNOWN += check_results['numChecksUNKNOWN']
-            numChecksCRITICAL += check_results['numChecksCRITICAL']
-
-            # print check return value counts. If we are in Nagios mode, then only print out the count with
-            # the highest severity
-
-            if nagiosMode:
-                extra = ''
-                if check_results['message']:
-                    # If we have extra message and are in nagiosMode then add it.
-                    # if not in nagiosMode, this information is probably already part of output
-                    extra = " - %s"%check_results['message']
-                if check_results['numChecksCRITICAL'] > 0:
-                    if check_results['numChecksCRITICAL'] == 1:
-                        grammar = "Check"
-                        check_return_string.append("CRITICAL%s"%extra)
-                    else:
-                        check_return_string.append("%s %s CRITICAL%s"%(check_results['numChecksCRITICAL'],grammar,extra))
-                elif check_results['numChecksUNKNOWN'] > 0:
-                    if check_results['numChecksUNKNOWN'] == 1:
-                        grammar = "Check"
-                        check_return_string.append("UNKNOWN%s"%extra)
-                    else:
-                        check_return_string.append("%s %s UNKNOWN%s"%(check_results['numChecksUNKNOWN'],grammar,extra))
-                elif check_results['numChecksWARNING'] > 0:
-                    if check_results['numChecksWARNING'] == 1:
-                        grammar = "Check"
-                        check_return_string.append("WARNING%s"%extra)
-                    else:
-                        check_return_string.append("%s %s WARNING%s"%(check_results['numChecksWARNING'],grammar,extra))
-            else:
-                if check_results['numChecksCRITICAL'] > 0:
-                    if check_results['numChecksCRITICAL'] == 1:
-                        grammar = "Check"
-                    check_return_string.append("%s %s CRITICAL"%(check_results['numChecksCRITICAL'],grammar))
-                if check_results['numChecksUNKNOWN'] > 0:
-                    if check_results['numChecksUNKNOWN'] == 1:
-                        grammar = "Check"
-                    check_return_string.append("%s %s UNKNOWN"%(check_results['numChecksUNKNOWN'],grammar))
-                if check_results['numChecksWARNING'] > 0:
-                    if check_results['numChecksWARNING'] == 1:
-                        grammar = "Check"
-                    check_return_string.append("%s %s WARNING"%(check_results['numChecksWARNING'],grammar))
-
-            # if there are warning, critical, or unknown checks, print them
-            if check_results['rc'] > 0:
-                returnStrings.append("%s: %s"%(check.description,'; '.join(check_return_string)))
-            if len(check_results['ret_str']) > 0:
-                for string in check_results['ret_str']:
-                    returnStrings.append(string)
-                if not nagiosMode:
-                    returnStrings.insert(0,"Messages from check %s"%check.description)
-                    returnStrings.append("\n")
+            try:
+                verdictKey = (check.description,nagiosMode,verbose,thisSFA.production)
+                checkFingerprints = None
+                # the verdict of a check of counter rates changes as samples leave the rate interval
+                if verdicts is not None and not (check.usesCounterHistory and thisSFA.counterHistory is not None):
+                    checkFingerprints = tuple([ fingerprints.get(SFAClass.__name__) for SFAClass in check.SFAClasses ])
+                    if None in checkFingerprints:
+                        checkFingerprints = None
+                if checkFingerprints and verdictKey in verdicts and verdicts[verdictKey][0] == checkFingerprints:
+                    (check_results, check.metrics) = verdicts[verdictKey][1]
+                    check_result['cached'] = True
+                else:
+                    check_results = check.doCheck()
+                    if checkFingerprints:
+                        result['verdicts'][verdictKey] = (checkFingerprints,(check_results,check.metrics))
+            finally:
+                after = thisSFA.snapshot.totals()
+                check_timing['wall'] = time.time() - check_start
+                check_timing['getall_calls'] = after[0] - before[0]
+                check_timing['api_fetches'] = after[1] - before[1]
+                check_timing['objects'] = after[2] - before[2]
+                check_timing['api_wait'] = after[3] - before[3]
+                check_timing['eval'] = max(check_timing['wall'] - check_timing['api_wait'],0.0)
+                result['metrics'].extend(check.metrics)
+            for key in ('rc','numChecksWARNING','numChecksUNKNOWN','numChecksCRITICAL','message'):
+                check_result[key] = check_results[key]
+            check_result['messages'] = check_results['ret_str']
+            check_result['components'] = check_results.get('components',[])
         except Exception, err:
-            numChecksUNKNOWN += 1
-            returnStrings.append("%s: %s"%(check.description,"UNKNOWN: Python Exception"))
+            check_result['exception'] = "%s: %s"%(err.__class__.__name__, err)
             if not nagiosMode:
                 print "Exception %s: %s"%(err.__class__.__name__, err)
                 print_exc()
- 
+        # update overall check counts
+        for key in ('numChecksWARNING','numChecksUNKNOWN','numChecksCRITICAL'):
+            result[key] += check_result[key]
+
+    (timing['getall_calls'], timing['api_fetches'], timing['objects'], fetch_time) = thisSFA.snapshot.totals()
+    timing['api_wait'] = timing['connect'] + timing.get('prefetch',0.0) + timing.get('diff_api_wait',0.0)
+    for check_timing in timing['checks']:
+        timing['api_wait'] += check_timing['api_wait']
+    timing['wall'] = time.time() - start_time
+    timing['eval'] = max(timing['wall'] - timing['api_wait'],0.0)
+    result['api_stats'] = thisSFA.snapshot.getStats()
+
+    result['enclosures'] = enclosureRollups(result['checks'])
+    if controller.get('records'):
+        result['records'] = thisSFA.snapshot.records()
+    elif verdicts is not None:
+        # the state store already has the records of the classes that did not change
+        result['records'] = thisSFA.snapshot.records()
+        lastFingerprints = controller.get('fingerprints',{})
+        for name in result['records'].keys():
+            if fingerprints.get(name) is not None and fingerprints[name] == lastFingerprints.get(name):
+                del result['records'][name]
+
+    (ret_str, rc) = renderNagios(result,nagiosMode,verbose)
+    result['rc'] = rc
+    controller['result'] = result
+
+    # clean up. disconnect execution context unless a persistent worker keeps it
+    if session:
+        session.release()
+    else:
+        APIDisconnect()
+    return ((ret_str,rc))
+
+def renderNagios(result,nagiosMode,verbose=False):
+    """ Render the structured result of a subsystem as Nagios output. In nagiosMode the
+        output is a single line, otherwise it is the extended console output.
+        Returns (ret_str, rc) """
+    rc = 1
+    ret_str = []
+    new_rc = 0
+    returnStrings = []
+
+    for check in result['checks']:
+        check_return_string = []
+        if check['exception']:
+            returnStrings.append("%s: %s"%(check['name'],"UNKNOWN: Python Exception"))
+            continue
+        grammar = "Checks"
+        # if check rc is higher than overall rc, change it
+        if check['rc'] > new_rc:
+            new_rc = check['rc']
+
+        # print check return value counts. If we are in Nagios mode, then only print out the count with
+        # the highest severity
+
+        if nagiosMode:
+            extra = ''
+            if check['message']:
+                # If we have extra message and are in nagiosMode then add it.
+                # if not in nagiosMode, this information is probably already part of output
+                extra = " - %s"%check['message']
+            if check['numChecksCRITICAL'] > 0:
+                if check['numChecksCRITICAL'] == 1:
+                    grammar = "Check"
+                    check_return_string.append("CRITICAL%s"%extra)
+                else:
+                    check_return_string.append("%s %s CRITICAL%s"%(check['numChecksCRITICAL'],grammar,extra))
+            elif check['numChecksUNKNOWN'] > 0:
+                if check['numChecksUNKNOWN'] == 1:
+                    grammar = "Check"
+                    check_return_string.append("UNKNOWN%s"%extra)
+                else:
+                    check_return_string.append("%s %s UNKNOWN%s"%(check['numChecksUNKNOWN'],grammar,extra))
+            elif check['numChecksWARNING'] > 0:
+                if check['numChecksWARNING'] == 1:
+                    grammar = "Check"
+                    check_return_string.append("WARNING%s"%extra)
+                else:
+                    check_return_string.append("%s %s WARNING%s"%(check['numChecksWARNING'],grammar,extra))
+        else:
+            if check['numChecksCRITICAL'] > 0:
+                if check['numChecksCRITICAL'] == 1:
+                    grammar = "Check"
+                check_return_string.append("%s %s CRITICAL"%(check['numChecksCRITICAL'],grammar))
+            if check['numChecksUNKNOWN'] > 0:
+                if check['numChecksUNKNOWN'] == 1:
+                    grammar = "Check"
+                check_return_string.append("%s %s UNKNOWN"%(check['numChecksUNKNOWN'],grammar))
+            if check['numChecksWARNING'] > 0:
+                if check['numChecksWARNING'] == 1:
+                    grammar = "Check"
+                check_return_string.append("%s %s WARNING"%(check['numChecksWARNING'],grammar))
+
+        # if there are warning, critical, or unknown checks, print them
+        if check['rc'] > 0:
+            returnStrings.append("%s: %s"%(check['name'],'; '.join(check_return_string)))
+        if len(check['messages']) > 0:
+            messages = check['messages']
+            if not nagiosMode and extendedLineLimit and len(messages) > extendedLineLimit:
+                # the rest are in the components of the structured result
+                messages = messages[:extendedLineLimit] + ["... %d more from check %s (--max-lines 0 shows all)"%(
+                    len(messages) - extendedLineLimit,check['name'])]
+            for string in messages:
+                returnStrings.append(string)
+            if not nagiosMode:
+                returnStrings.insert(0,"Messages from check %s"%check['name'])
+                returnStrings.append("\n")
+
     # if this is a non-production system, downgrade return status to WARNING
-    if not thisSFA.production:
+    if not result['production']:
         if new_rc > 1:
             rc = 1
 
@@ -367,22 +1587,38 @@ def call_API(controller,modules,verbose,nagiosMode):
         ret_str = ' ;; '.join(returnStrings)
         # if return status is not OK, then prepend NON-PROD 
         if new_rc != NagiosStatus.OK:
-            if not thisSFA.production:
+            if not result['production']:
                 ret_str = "NON-PROD - " + ret_str
     else:
         # if running from the CLI in extended mode, make it pretty
+        if verbose:
+            returnStrings.append("API fetches for %s:"%result['system_name'])
+            returnStrings.extend(statsStrings(result['api_stats']))
+        if result.get('enclosures'):
+            returnStrings.append("Faults by enclosure for %s:"%result['system_name'])
+            returnStrings.extend(enclosureStrings(result['enclosures']))
+        if result.get('events'):
+            returnStrings.append("State changes since the last check of %s:"%result['system_name'])
+            for event in result['events']:
+                returnStrings.append(event['description'])
+        returnStrings.append("Check timing for %s:"%result['system_name'])
+        returnStrings.extend(timingStrings(result['timing']))
         returnStrings.insert(0,"-------------------------")
-        returnStrings.insert(0,"\n%s Check Summary:"%thisSFA.systemName)
+        returnStrings.insert(0,"\n%s Check Summary:"%result['system_name'])
         ret_str = "\n".join(returnStrings)
         # if return status is not OK, then prepend NON-PROD
-        if new_rc != NagiosStatus.OK and not thisSFA.production:
-            ret_str = "%s is NON-PRODUCTION\n"%thisSFA.systemName + ret_str
-    # clean up. disconnect execution context
-    APIDisconnect()
+        if new_rc != NagiosStatus.OK and not result['production']:
+            ret_str = "%s is NON-PRODUCTION\n"%result['system_name'] + ret_str
     return ((ret_str,rc))
 
 class APICheck(object):
     """ Abstract class for SFA checks """
+    # The SFA classes read by the check. Subclasses list them so they can be prefetched
+    SFAClasses = []
+    # set by the checks that compare error counters with their earlier samples
+    usesCounterHistory = False
+    # set by the checks that report the state of a CRITICAL object in Nagios mode too
+    criticalStateInNagiosMode = False
     def __init__(self, thisSFA, description, verbose,nagiosMode):
         self.description = description
         self.verbose = verbose
@@ -396,6 +1632,39 @@ class APICheck(object):
         self.message = ''
         # this was added to capture output in non-nagios mode for printing later
         self.ret_str = []
+        # numeric component values read by the check, as (name, labels, value)
+        self.metrics = []
+        # the components with faults or messages, see addComponent()
+        self.components = []
+        self.componentIndex = {}
+        # worst status set while looking at the current component
+        self.objectFault = NagiosStatus.OK
+    def recordMetric(self, name, value, **labels):
+        """ Keep a numeric value the check has read so it can be exported as a metric """
+        self.metrics.append((name, labels, value))
+    def recordCounter(self, name, value, **labels):
+        """ Record an error counter like recordMetric(), and return its increase within the
+            rate interval as (increase, seconds since the earliest sample), or None when there
+            is no earlier sample to compare with """
+        self.recordMetric(name, value, **labels)
+        if self.thisSFA.counterHistory is None:
+            return None
+        samples = self.thisSFA.counterHistory.get(seriesKey(self.thisSFA.sub_name, name, labels))
+        if not samples:
+            return None
+        (times, values) = samples
+        return (counterIncrease(list(values) + [value]), int(time.time()) - times[0])
+    def counterRateExceeded(self, counter, increase):
+        """ True if the increase returned by recordCounter() is above the rate threshold of counter """
+        if increase is None:
+            return False
+        return increase[0] > self.thisSFA.counterRates.get(counter, defaultCounterRateThreshold)
+    def healthCheckObjects(self, SFAClass):
+        """ The objects of SFAClass checked by doHealthCheck(). Subclasses override it to leave some out """
+        return self.getAll(SFAClass)
+    def getAll(self, SFAClass):
+        """ Get all objects of SFAClass from the snapshot shared by the checks of this run """
+        return self.thisSFA.snapshot.getAll(SFAClass)
     def printIfHealthy(self):
         """ Print a standard "healthy" message to stdout """
         if self.fault == NagiosStatus.OK:
@@ -405,15 +1674,41 @@ class APICheck(object):
         if self.fault == NagiosStatus.OK:
             self.fault = NagiosStatus.WARNING
         self.numChecksWARNING += 1
+        self.objectFault = worseStatus(self.objectFault,NagiosStatus.WARNING)
     def setFaultCRITICAL(self):
         """ Set the fault return status to CRITICAL unconditionally """
         self.fault = NagiosStatus.CRITICAL
         self.numChecksCRITICAL += 1
+        self.objectFault = NagiosStatus.CRITICAL
     def setFaultUNKNOWN(self):
         """ Set the fault return status to UNKNOWN if not overriding CRITICAL """
         if not self.fault == NagiosStatus.CRITICAL:
             self.fault = NagiosStatus.UNKNOWN
         self.numChecksUNKNOWN += 1
+        self.objectFault = worseStatus(self.objectFault,NagiosStatus.UNKNOWN)
+    def addComponent(self, object, messages):
+        """ Called once for each object a check looks at. Records the object with its
+            identifiers, worst status and messages if it faulted or has messages. The
+            same object seen again (e.g. by doHealthCheck and then the check) is merged """
+        fault = self.objectFault
+        self.objectFault = NagiosStatus.OK
+        if fault == NagiosStatus.OK and not messages:
+            return
+        key = (object.__class__.__name__, getattr(object,'Index',None))
+        if not key in self.componentIndex:
+            component = { 'class': key[0], 'rc': NagiosStatus.OK, 'messages': [] }
+            for identifier in componentIdentifiers:
+                try:
+                    component[identifier] = getattr(object,identifier)
+                except Exception:
+                    pass
+            self.componentIndex[key] = component
+            self.components.append(component)
+        component = self.componentIndex[key]
+        component['rc'] = worseStatus(component['rc'],fault)
+        for message in messages:
+            if not message in component['messages']:
+                component['messages'].append(message)
     def createCheckReturnValues(self):
         returnDict = {}
         returnDict['rc'] = self.fault
@@ -422,16 +1717,18 @@ class APICheck(object):
         returnDict['numChecksCRITICAL'] = self.numChecksCRITICAL
         returnDict['message'] = self.message
         returnDict['ret_str'] = self.ret_str
+        returnDict['components'] = self.components
         return returnDict
 
     def doHealthCheck(self,SFAClass,objectStatePropertyStr,objectStateEnum,objectStateValueStr,extraIdentifiers,ignoreChildHealth):
         """ This method is the workhorse for the script. Since we can't capture every unique property to check
             for the different SFA components, just capture the checks of HealthState, ChildHealthState, and one
             other to display along with HealthState when not OK.
-            
-            ******* Remember when updating this function also update channelCheck.doHealthCheck() ***********
+
+            The objects are the ones healthCheckObjects() returns. The state of a CRITICAL object is
+            only added to its messages in Nagios mode if criticalStateInNagiosMode is set
         """
-        for object in SFAClass.getAll():
+        for object in self.healthCheckObjects(SFAClass):
             messages = []
             # Capture the HealthState even if its OK. If there is another fault with ChildHealthState or
             # object.objectStatePropertyStr, we will still want to print it out
@@ -440,7 +1737,7 @@ class APICheck(object):
                 if object.HealthState == SFAHealthState.CRITICAL:
                     # this object has a critical state, if not in nagiosMode, print this on the console
                     if objectStatePropertyStr and objectStateEnum:
-                        if self.nagiosMode == False:
+                        if self.nagiosMode == False or self.criticalStateInNagiosMode:
                             messages.append("{0}: {1}".format(objectStatePropertyStr,objectStateEnum.reverse_mapping[getattr(object,objectStatePropertyStr)]))
                     self.setFaultCRITICAL()
                 elif object.HealthState == SFAHealthState.NON_CRITICAL:
@@ -454,6 +1751,10 @@ class APICheck(object):
                 if object.ChildHealthState != SFAHealthState.OK:
                     messages.append("Child Health: {0}".format(SFAHealthState.reverse_mapping[object.ChildHealthState]))
                     self.setFaultWARNING()
+            if object.HealthState != SFAHealthState.OK:
+                self.addComponent(object,[healthStateMessage] + messages)
+            else:
+                self.addComponent(object,messages)
             # Anything to print out?
             if messages or object.HealthState != SFAHealthState.OK:
                 # anything to print after HealthState?
@@ -473,6 +1774,7 @@ class APICheck(object):
 
 class controllerCheck(APICheck):
     """ Class for checking the controller units """
+    SFAClasses = [SFAController]
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'CONTROLLER',verbose,nagiosMode)
     def doCheck(self):
@@ -486,7 +1788,8 @@ class controllerCheck(APICheck):
               1. RestartPending == False
               2. MIR state == NON
         """
-        SFAType = SFAController.getAll()[0].VendorEquipmentType.rstrip()
+        SFAType = self.getAll(SFAController)[0].VendorEquipmentType.rstrip()
+        self.SFAType = SFAType
         #if "SFA 10000" in SFAType or self.nagiosMode:
         #    ignoreChildHealth = True
         #else:
@@ -499,7 +1802,7 @@ class controllerCheck(APICheck):
         self.fault = self.doHealthCheck(SFAController,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAController.getAll():
+        for object in self.getAll(SFAController):
             messages = []
             if object.RestartPending:
                 messages.append("Restart Pending")
@@ -510,6 +1813,7 @@ class controllerCheck(APICheck):
             if object.ICCState != SFAICCState.UP:
                 messages.append("ICC State:{0} ICCProtocolVersion:{1}".format(SFAICCState.reverse_mapping[object.ICCState],object.ICCProtocolVersion))
                 self.setFaultWARNING()
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     roomLeftInNagiosOutput -= 1
@@ -522,6 +1826,8 @@ class channelCheck(APICheck):
         These are redundant components, so should return WARNING
  
     """
+    SFAClasses = [SFAController, SFADiskChannel]
+    criticalStateInNagiosMode = True
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'DISK CHANNEL',verbose,nagiosMode)
     def checkDiskChannelSpeed(self,SFAType,channelObject):
@@ -551,16 +1857,21 @@ class channelCheck(APICheck):
             return True
         else:
             return False
+    def healthCheckObjects(self,SFAClass):
+        """ doHealthCheck() leaves out the disk channels skipDiskChannel() ignores """
+        return [ object for object in self.getAll(SFAClass) if not self.skipDiskChannel(self.SFAType,object) ]
     def doCheck(self):
         """ Function implementing the channel check 
-            Perform custom health checks for SFA10K and SFA12K controllers using channelCheck.doHealthCheck()
+            Perform the health checks with APICheck.doHealthCheck(), leaving out the channels
+            skipDiskChannel() ignores for SFA10K and SFA12K controllers
 
             Also Check:
               1 CurrentSpeed = 6 Gbs (3 for 10k)
               2. CurrentWidth == ExpectedWidth (4)
               3. CurrentPosition == ExpectedPosition (useful or not?)
         """
-        SFAType = SFAController.getAll()[0].VendorEquipmentType.rstrip()
+        SFAType = self.getAll(SFAController)[0].VendorEquipmentType.rstrip()
+        self.SFAType = SFAType
         
         # do our own health check
         if self.nagiosMode:
@@ -573,14 +1884,19 @@ class channelCheck(APICheck):
         extraCheckPropertyValues = SFALinkState
         extraIdentifiers = ['ControllerIndex','PortLocation']
         # do our own health check
-        self.fault = self.doHealthCheck(SFAType,SFADiskChannel,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
+        self.doHealthCheck(SFADiskChannel,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
+        # the status and counts are the ones of the health checks, the checks below only add messages
+        returnValues = self.createCheckReturnValues()
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
         # Do the other checks
-        for object in SFADiskChannel.getAll():
+        for object in self.getAll(SFADiskChannel):
             messages = []
             if self.skipDiskChannel(SFAType,object):
                 continue
+            self.recordMetric('disk_channel_speed',object.CurrentSpeed,controller=object.ControllerIndex,port=object.PortLocation)
+            self.recordMetric('disk_channel_width',object.CurrentWidth,controller=object.ControllerIndex,port=object.PortLocation)
+            self.recordMetric('disk_channel_expected_width',object.ExpectedWidth,controller=object.ControllerIndex,port=object.PortLocation)
             # only run these checks if channel is UP, otherwise Speed and Width tell us nothing
             if object.LinkState == SFALinkState.UP:
                 if self.checkDiskChannelSpeed(SFAType,object) != NagiosStatus.OK:
@@ -607,84 +1923,34 @@ class channelCheck(APICheck):
                # it's not clear this is an actual problem, so only set to warning when not run in nagios mode.
                if self.nagiosMode == False:
                    self.setFaultWARNING()
-            if messages and self.fault != 0:
+            self.addComponent(object,messages)
+            if messages:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     roomLeftInNagiosOutput -= 1
                     self.ret_str.append("{0} Controller: {1} Port {2}; {3}".format(self.description,object.ControllerIndex, object.PortLocation,'; '.join(messages)))
-        return self.fault
-
-
-    def doHealthCheck(self,SFAType,SFAClass,objectStatePropertyStr,objectStateEnum,objectStateValueStr,extraIdentifiers,ignoreChildHealth):
-        """ We need to use a slight modification of APICheck.doHealthCheck() that skips certain
-            disk channels for SFA10K and SFA12K systems. This is handled by the channelCheck.skipDiskChannel()
-            method and has specific locations for both hardware platforms. It would be ideal to get rid of
-            this method since it has specific knowledge inside it. Hopefully this is fixed in a future
-            SFAOS release.
-             
-            Other than checking if the channel should be skipped, this function is identical to APICheck.doHealthCheck()
-        """
-        for object in SFAClass.getAll():
-            if self.skipDiskChannel(SFAType,object):
-                continue
-            messages = []
-            # Capture the HealthState even if its OK. If there is another fault with ChildHealthState or
-            # object.objectStatePropertyStr, we will still want to print it out
-            healthStateMessage = "Health: {0}".format(SFAHealthState.reverse_mapping[object.HealthState])
-            if object.HealthState != SFAHealthState.OK:
-                if object.HealthState == SFAHealthState.CRITICAL:
-                    if objectStatePropertyStr and objectStateEnum:
-                        messages.append("{0}: {1}".format(objectStatePropertyStr,objectStateEnum.reverse_mapping[getattr(object,objectStatePropertyStr)]))
-                    self.setFaultCRITICAL()
-                elif object.HealthState == SFAHealthState.NON_CRITICAL:
-                    self.setFaultWARNING()
-                else:
-                    self.setFaultUNKNOWN()
-            elif objectStatePropertyStr and objectStateEnum and objectStateValueStr and getattr(object,objectStatePropertyStr) != getattr(objectStateEnum,objectStateValueStr):
-                messages.append("{0}: {1}".format(objectStatePropertyStr,objectStateEnum.reverse_mapping[getattr(object,objectStatePropertyStr)]))
-                self.setFaultWARNING()
-            if (self.nagiosMode == False) and (ignoreChildHealth == False):
-                if object.ChildHealthState != SFAHealthState.OK:
-                    messages.append("Child Health: {0}".format(SFAHealthState.reverse_mapping[object.ChildHealthState]))
-                    self.setFaultWARNING()
-
-            # Anything to print out?
-            if messages or object.HealthState != SFAHealthState.OK:
-                # anything to print after HealthState?
-                if messages:
-                    separator = ';'
-                else:
-                    separator = ''
-                extraIdentStr = ''
-                if extraIdentifiers:
-                    for extraIdent in extraIdentifiers:
-                        extraIdentStr += " {0}: {1}".format(extraIdent,getattr(object,extraIdent))
-                if (self.nagiosMode == False):
-                    self.ret_str.append("{0} {1} {2} Index: {3}{4} {5}".format(self.description,healthStateMessage,extraIdentStr,object.Index,separator,'; '.join(messages)))
-                #else:
-                #    self.ret_str.append("{0}{1} Index: {2}; {3}{4} {5}".format(self.description,extraIdentStr,object.Index,healthStateMessage,separator,'; '.join(messages)))
-
-        if self.verbose == True:
-            self.printIfHealthy()
-        returnValues = self.createCheckReturnValues()
         return returnValues
 
+
 class HostChannelCheck(APICheck):
     """ Check the HOST Channels on the SFA
         Check only (no Health):
           1. LinkState
           2. Speed
     """
+    SFAClasses = [SFAHostChannel]
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'HOST CHANNEL',verbose,nagiosMode)
     def doCheck(self):
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAHostChannel.getAll():
+        for object in self.getAll(SFAHostChannel):
             messages = []
+            self.recordMetric('host_channel_speed',object.Speed,index=object.Index,controller=object.ControllerIndex)
             if object.LinkState == SFALinkState.UP:
                 if object.Speed != object.AvailableSpeeds:
                     messages.append("Host Channel Index:{0} has speed:{1} cabable of {2}".format(object.Index,object.Speed,object.AvailableSpeeds))
                     self.setFaultWARNING()
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     self.ret_str.append("{0} Host Channel Index:{1} Controller:{2}; {3}".format(self.description,object.Index,object.ControllerIndex,'; '.join(messages)))
@@ -696,6 +1962,7 @@ class RAIDProcessorCheck(APICheck):
     """ Check the RAID Processors on the SFA
         Do the basic health checks
     """
+    SFAClasses = [SFARAIDProcessor]
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'RAID PROCS',verbose,nagiosMode)
     def doCheck(self):  
@@ -706,11 +1973,12 @@ class RAIDProcessorCheck(APICheck):
         self.fault = self.doHealthCheck(SFARAIDProcessor,None,None,None,['ControllerIndex','IndexOnController'],ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFARAIDProcessor.getAll():
+        for object in self.getAll(SFARAIDProcessor):
             messages = []
             if object.HealthState == SFAHealthState.OK:
                 # do nothing yet
                 pass
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     roomLeftInNagiosOutput -= 1
@@ -722,6 +1990,7 @@ class ICLIOCCheck(APICheck):
     """ Check the ICL links IO controller on the SFA
         Do the basic health
     """
+    SFAClasses = [SFAICLIOC]
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'ICL IOC',verbose,nagiosMode)
     def doCheck(self):
@@ -732,11 +2001,12 @@ class ICLIOCCheck(APICheck):
         self.fault = self.doHealthCheck(SFAICLIOC,None,None,None,['ControllerIndex'],ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAICLIOC.getAll():
+        for object in self.getAll(SFAICLIOC):
             messages = []
             if object.HealthState == SFAHealthState.OK:
                 # do nothing yet
                 pass
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     roomLeftInNagiosOutput -= 1
@@ -752,7 +2022,12 @@ class ICLChannelCheck(APICheck):
             2. InfinibandPortState == ACTIVE
             3. InfinibandCurrentWidth == 4
             4. ErrorStatisticCounts for SymbolErrors is below a threshold
+          5. None of the ErrorStatisticCounts increased by more than its rate threshold
+             within the rate interval. When a history of the counters is kept, this
+             replaces 4.
     """
+    SFAClasses = [SFAICLChannel]
+    usesCounterHistory = True
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'ICL CHANNEL',verbose,nagiosMode)
     def doCheck(self):
@@ -767,8 +2042,16 @@ class ICLChannelCheck(APICheck):
         self.fault = self.doHealthCheck(SFAICLChannel,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAICLChannel.getAll():
+        for object in self.getAll(SFAICLChannel):
             messages = []
+            self.recordMetric('icl_channel_speed',object.CurrentSpeed,index=object.Index,controller=object.ControllerIndex)
+            if object.ICLIOCType == SFAIOCType.IB_HCA:
+                self.recordMetric('icl_channel_width',object.InfinibandCurrentWidth,index=object.Index,controller=object.ControllerIndex)
+            rateMessages = []
+            for (counter,count) in zip(object.ErrorStatisticNames,object.ErrorStatisticCounts):
+                increase = self.recordCounter('icl_channel_errors_total',count,index=object.Index,controller=object.ControllerIndex,counter=counter)
+                if self.counterRateExceeded(counter,increase):
+                    rateMessages.append("ICL Index:{0} {1}:+{2} in {3}s".format(object.Index,counter,int(increase[0]),increase[1]))
             if object.LinkState == SFALinkState.UP:
                 if object.CurrentSpeed != 10000:
                     messages.append("ICL Index:{0} has speed:{1}".format(object.Index,object.CurrentSpeed))
@@ -780,9 +2063,14 @@ class ICLChannelCheck(APICheck):
                     if object.InfinibandPortState != SFAIBPortState.ACTIVE:
                         messages.append("ICL Index:{0} is state:{1}".format(object.Index,SFAIBPortState.reverse_mapping[object.InfinibandPortState]))
                         self.setFaultWARNING()
-                    if (object.ErrorStatisticNames[0] == "SymbolErrorCounter") and (object.ErrorStatisticCounts[0] > SYMBOL_ERROR_THRESHOLD):
+                    # without a history of the counters only their absolute value can be checked
+                    if self.thisSFA.counterHistory is None and (object.ErrorStatisticNames[0] == "SymbolErrorCounter") and (object.ErrorStatisticCounts[0] > SYMBOL_ERROR_THRESHOLD):
                         messages.append("ICL Index:{0} SymbolErrorCounter:{1}".format(object.Index,object.ErrorStatisticCounts[0]))
                         self.setFaultWARNING()
+            if rateMessages:
+                messages.extend(rateMessages)
+                self.setFaultWARNING()
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     self.ret_str.append("{0} ICL Index:{1} Controller:{2}; {3}".format(self.description,object.Index,object.ControllerIndex,'; '.join(messages)))
@@ -792,6 +2080,8 @@ class ICLChannelCheck(APICheck):
 
 class poolCheck(APICheck):
     """ Check the storage pools """
+    SFAClasses = [SFAStoragePool]
+    usesCounterHistory = True
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'POOL',verbose,nagiosMode)
     def doCheck(self):
@@ -804,6 +2094,7 @@ class poolCheck(APICheck):
               2. ChildHealthState
               3. PoolState == NORMAL
               4. Pool settings (cache,verify,DirectProtect) if nonproduction
+              5. BadBlockCount did not increase by more than its rate threshold
         """
         if self.nagiosMode:
             ignoreChildHealth = True
@@ -817,8 +2108,9 @@ class poolCheck(APICheck):
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
         self.fault = self.doHealthCheck(SFAStoragePool,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
-        for pool in SFAStoragePool.getAll():
+        for pool in self.getAll(SFAStoragePool):
             messages = []
+            badBlockIncrease = self.recordCounter('pool_bad_blocks',pool.BadBlockCount,index=pool.Index)
             if pool.PoolState == SFAPoolState.NORED:
                 extraMessage = "Index %s NORED"%pool.Index
             if pool.PoolState == SFAPoolState.DEGRADED:
@@ -831,6 +2123,7 @@ class poolCheck(APICheck):
                 messages.append("Auto-write locked")
                 extraMessage = "Index %s auto-write locked"%pool.Index
                 self.fault = NagiosStatus.CRITICAL
+                self.objectFault = NagiosStatus.CRITICAL
             if pool.Rebuilding:
                 messages.append("Rebuilding")
                 if pool.PoolState != SFAPoolState.NORMAL:
@@ -843,6 +2136,10 @@ class poolCheck(APICheck):
                 # when this script is run from the CLI in "extended" (-x) mode
                 if self.nagiosMode == False:
                     self.setFaultWARNING()
+            # but bad blocks appearing quickly are worth a warning
+            if self.counterRateExceeded('BadBlockCount',badBlockIncrease):
+                messages.append("BadBlocks: +{0} in {1}s".format(int(badBlockIncrease[0]),badBlockIncrease[1]))
+                self.setFaultWARNING()
             # These are probably just useful for development and testing environments, turn off for production
             if self.thisSFA.production == False:
                 SFAPoolSettings = getPoolSettings(pool)
@@ -850,6 +2147,7 @@ class poolCheck(APICheck):
                     SFASettingsString = setPoolSettingsString(SFAPoolSettings)
                     messages.append("Settings: {0} Expected: {1}".format(SFASettingsString,self.thisSFA.settingsString))
                     self.setFaultWARNING()
+            self.addComponent(pool,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     self.ret_str.append("Pool Index: {0}; {1}".format(pool.Index,'; '.join(messages)))
@@ -863,8 +2161,11 @@ class virtualDiskCheck(APICheck):
     """ Check the virtual disks on the SFA
         Do the basic health check plus:
           1. Check BadBlockCount
+          2. BadBlockCount did not increase by more than its rate threshold
     """
 
+    SFAClasses = [SFAVirtualDisk]
+    usesCounterHistory = True
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'VIRTUAL DISK',verbose,nagiosMode)
     def doCheck(self):
@@ -880,8 +2181,9 @@ class virtualDiskCheck(APICheck):
         self.fault = self.doHealthCheck(SFAVirtualDisk,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAVirtualDisk.getAll():
+        for object in self.getAll(SFAVirtualDisk):
             messages = []
+            badBlockIncrease = self.recordCounter('virtual_disk_bad_blocks',object.BadBlockCount,index=object.Index)
 	    if object.BadBlockCount > 0:
                 messages.append("BadBlocks: {0}".format(object.BadBlockCount))
                 # Increasing bad blocks is normal as drive sectors get remapped. Don't trigger a warning
@@ -889,6 +2191,11 @@ class virtualDiskCheck(APICheck):
                 # when this script is run from the CLI in "extended" (-x) mode
                 if self.nagiosMode == False:
                     self.setFaultWARNING()
+            # but bad blocks appearing quickly are worth a warning
+            if self.counterRateExceeded('BadBlockCount',badBlockIncrease):
+                messages.append("BadBlocks: +{0} in {1}s".format(int(badBlockIncrease[0]),badBlockIncrease[1]))
+                self.setFaultWARNING()
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     self.ret_str.append("{0} Index: {1}; {2}".format(self.description,object.Index,'; '.join(messages)))
@@ -910,6 +2217,7 @@ class internalDiskCheck(APICheck):
           2. PredictFailure
           3. SESStatus
     """
+    SFAClasses = [SFAInternalDiskDrive, SFAController]
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'INTERNAL DISK',verbose,nagiosMode)
     def doCheck(self):
@@ -924,7 +2232,7 @@ class internalDiskCheck(APICheck):
         self.fault = self.doHealthCheck(SFAInternalDiskDrive,extraCheckProperty,extraCheckPropertyValues,extraCheckPropertyDesiredValue,extraIdentifiers,ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAInternalDiskDrive.getAll():
+        for object in self.getAll(SFAInternalDiskDrive):
             messages = []
             # Deal with the special case where the internal disks are in a NOTMIR state. We don't rely on the generic
             # doHealthCheck call above because is has no way of checking that SFAHealthState is NON_CRITICAL and 
@@ -934,7 +2242,7 @@ class internalDiskCheck(APICheck):
             if object.HealthState == SFAHealthState.NON_CRITICAL and object.MirrorState != SFAMirrorState.MEMBER:
                 messages.append("NOT MIRRORED")
             if object.HealthState == SFAHealthState.OK:
-                if "SFA 10000" in SFAController.getAll()[0].VendorEquipmentType.rstrip():
+                if "SFA 10000" in self.getAll(SFAController)[0].VendorEquipmentType.rstrip():
                     if object.Name == 'DISK C':
                         continue
                 if not object.Present:
@@ -946,6 +2254,7 @@ class internalDiskCheck(APICheck):
                 if object.SESStatus != SFASESStatus.OK:
                     messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
                     self.setFaultWARNING()
+            self.addComponent(object,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     self.ret_str.append("{0} EnclosureIndex: {1} Name: {2}; {3}".format(self.description,object.EnclosureIndex,object.Name,'; '.join(messages)))
@@ -953,6 +2262,59 @@ class internalDiskCheck(APICheck):
         returnValues = self.createCheckReturnValues()
         return returnValues
 
+def intColumn(values):
+    """ values as an array of integers, or as they are if one is not an integer (e.g. None
+        for an attribute the API could not read) """
+    try:
+        return array('l',values)
+    except (TypeError, OverflowError):
+        return values
+
+class DiskColumns (object):
+    """ The attributes of the disk drives read by the disk check, converted once into
+        one array per attribute. The faulted disks and the counts per enclosure are found
+        with whole-column operations (array.count(), sorted()), so Python code only runs
+        for the faulted disks
+    """
+    def __init__(self, disks):
+        self.disks = disks
+        # the attributes are read inline, which is several times faster than attrgetter
+        self.columns = { 'HealthState': intColumn([ disk.HealthState for disk in disks ]),
+                         'ChildHealthState': intColumn([ disk.ChildHealthState for disk in disks ]),
+                         'State': intColumn([ disk.State for disk in disks ]),
+                         'MemberState': intColumn([ disk.MemberState for disk in disks ]),
+                         'DiskHealthState': intColumn([ disk.DiskHealthState for disk in disks ]),
+                         'EnclosureIndex': intColumn([ disk.EnclosureIndex for disk in disks ]) }
+    def differs(self, name, values):
+        """ Indices of the disks whose attribute name is none of values """
+        column = self.columns[name]
+        if sum([ column.count(value) for value in values ]) == len(column):
+            return []
+        return [ index for (index, value) in enumerate(column) if not value in values ]
+    def faulted(self, ignoreChildHealth):
+        """ Indices of the disks the disk check reports, in order: any of HealthState, State
+            and DiskHealthState not as expected, a MemberState other than NORMAL or UNASSIGNED,
+            or a ChildHealthState other than OK unless ignoreChildHealth """
+        indices = set(self.differs('HealthState',(SFAHealthState.OK,)))
+        indices.update(self.differs('State',(SFADiskState.READY,)))
+        indices.update(self.differs('DiskHealthState',(SFADiskHealthState.GOOD,)))
+        indices.update(self.differs('MemberState',(SFADiskMemberState.NORMAL,SFADiskMemberState.UNASSIGNED)))
+        if not ignoreChildHealth:
+            indices.update(self.differs('ChildHealthState',(SFAHealthState.OK,)))
+        return sorted(indices)
+    def select(self, indices):
+        return [ self.disks[index] for index in indices ]
+    def enclosureCounts(self, indices):
+        """ (EnclosureIndex, disks, disks in indices) of each enclosure, by EnclosureIndex """
+        column = self.columns['EnclosureIndex']
+        faulted = {}
+        for index in indices:
+            faulted[column[index]] = faulted.get(column[index],0) + 1
+        counts = []
+        for (enclosure, group) in groupby(sorted(column)):
+            counts.append((enclosure, len(list(group)), faulted.get(enclosure,0)))
+        return counts
+
 class diskCheck(APICheck):
     """ Check the disk drives 
 
@@ -960,8 +2322,12 @@ class diskCheck(APICheck):
         Print Index, SerialNumber, EnclosureIndex, DiskSlotNumber to help identify failed drive
         Also check that MemberState is NORMAL or UNASSIGNED (relative to pool)
     """
+    SFAClasses = [SFADiskDrive]
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'DISK DRIVE',verbose,nagiosMode)
+    def healthCheckObjects(self, SFAClass):
+        """ doHealthCheck() only looks at the disks in the fault mask """
+        return self.faultedDisks
     def doCheck(self):
         if self.nagiosMode:
             ignoreChildHealth = True
@@ -972,10 +2338,18 @@ class diskCheck(APICheck):
         extraCheckPropertyValues = SFADiskState
         extraIdentifiers = ['EnclosureIndex','DiskSlotNumber','SerialNumber']
         extraMessage = ''
+        # only the disks in the fault mask have anything to report, so the health check
+        # and the checks below look at those alone
+        columns = DiskColumns(self.getAll(SFADiskDrive))
+        faulted = columns.faulted(ignoreChildHealth)
+        self.faultedDisks = columns.select(faulted)
+        for (enclosure, disks, faultedDisks) in columns.enclosureCounts(faulted):
+            self.recordMetric('enclosure_disks',disks,enclosure=enclosure)
+            self.recordMetric('enclosure_faulted_disks',faultedDisks,enclosure=enclosure)
         self.fault = self.doHealthCheck(SFADiskDrive,'State',SFADiskState,'READY',['EnclosureIndex','DiskSlotNumber','SerialNumber'],ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for disk in SFADiskDrive.getAll():
+        for disk in self.faultedDisks:
             messages = []
             if disk.MemberState != SFADiskMemberState.NORMAL and disk.MemberState != SFADiskMemberState.UNASSIGNED:
                 messages.append("MemberState: {0}".format(SFADiskMemberState.reverse_mapping[disk.MemberState]))
@@ -993,6 +2367,7 @@ class diskCheck(APICheck):
                 # if its already critical, don't need to make this a warning
                 if disk.HealthState == SFAHealthState.OK:
                     self.setFaultWARNING()
+            self.addComponent(disk,messages)
             if messages and self.fault != 0:
                 if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
                     self.ret_str.append("{0} Enclosure: {1} Slot: {2} Index: {3} SerialNumber: {4}; {5}".format(self.description,disk.EnclosureIndex, disk.DiskSlotNumber,disk.Index,disk.SerialNumber,'; '.join(messages)))
@@ -1002,46 +2377,132 @@ class diskCheck(APICheck):
         returnValues = self.createCheckReturnValues()
         return returnValues
 
-
-class expanderCheck(APICheck):
-    """ Check the SFA expanders
-        
-        Just check the HealthState as part of doCheck
-        Also check:
-          1. Present
-          2. Not predicted failure
-          3. SES Status == OK
+def rulePredicate(test, healthy):
+    """ A rule predicate: test(value) is true when the component has the fault, and must
+        be false for the healthy value, which componentRules compares with first """
+    test.healthy = healthy
+    return test
+
+# the predicates of the component rules
+isFalse = rulePredicate(lambda value: not value, True)
+isTrue = rulePredicate(lambda value: bool(value), False)
+def isNot(expected):
+    return rulePredicate(lambda value: value != expected, expected)
+
+def sesStatusMessage(value):
+    return "SES Status: {0}".format(SFASESStatus.reverse_mapping[value])
+
+class componentRules (object):
+    """ A list of (attribute, predicate, severity, message) rules compiled into one evaluator
+
+        A rule fires when predicate(value of attribute) is true. message is a format string
+        given the value, or a function of the value. severity is the NagiosStatus the check
+        sets, or None to only add the message. The rules only apply to components with a
+        HealthState of OK, as doHealthCheck() reports the others.
+
+        The rules are compiled into the source of one evaluate() function, reading the
+        attributes inline into a tuple. A healthy component is told apart by comparing the
+        tuple with the healthy values in one go, so only the faulted components have their
+        rules tested one by one.
     """
-    def __init__(self, thisSFA, verbose, nagiosMode):
-        APICheck.__init__(self,thisSFA,'EXPANDER',verbose,nagiosMode)
+    def __init__(self, rules):
+        self.rules = rules
+        attributes = ['HealthState']
+        namespace = { 'OK': SFAHealthState.OK }
+        healthy = [SFAHealthState.OK]
+        tests = []
+        for (attribute, predicate, severity, message) in rules:
+            if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', attribute):
+                raise ValueError("Invalid attribute name %r in component rule"%attribute)
+            if not callable(message):
+                message = message.format
+            index = len(attributes)
+            namespace['predicate%d'%index] = predicate
+            namespace['severity%d'%index] = severity
+            namespace['message%d'%index] = message
+            tests.append("        if predicate{0}(values[{0}]):\n"
+                         "            findings.append((severity{0}, message{0}(values[{0}])))\n".format(index))
+            attributes.append(attribute)
+            healthy.append(predicate.healthy)
+        namespace['healthy'] = tuple(healthy)
+        source = ("def evaluate(objects):\n"
+                  "    faults = []\n"
+                  "    for object in objects:\n"
+                  "        values = (" + ''.join([ "object.%s, "%attribute for attribute in attributes ]) + ")\n"
+                  "        if values == healthy or values[0] != OK:\n"
+                  "            continue\n"
+                  "        findings = []\n" + ''.join(tests) +
+                  "        if findings:\n"
+                  "            faults.append((object, findings))\n"
+                  "    return faults\n")
+        exec source in namespace
+        # one pass over a list of objects, returning (object, [(severity, message), ...]) for
+        # each object a rule fired for, in the order of the objects and of the rules
+        self.evaluate = namespace['evaluate']
+
+class RuleCheck(APICheck):
+    """ Abstract class for the checks of components that doHealthCheck() and a
+        componentRules cover completely. Subclasses set the class attributes """
+    # the SFA class checked by doHealthCheck(), with its (objectStatePropertyStr, objectStateEnum, objectStateValueStr)
+    healthClass = None
+    healthProperty = (None, None, None)
+    # identifiers printed by doHealthCheck()
+    extraIdentifiers = ['EnclosureIndex','Position','Location']
+    # the SFA class the rules are applied to, and the componentRules
+    ruleClass = None
+    rules = None
+    # output line of a component a rule fired for, given the description, the object and the messages
+    outputFormat = "{0} EnclosureIndex: {1.EnclosureIndex} Position: {1.Position} Location: {1.Location} Index: {1.Index}; {2}"
+    # the temperature check has always set WARNING when printing a line rather than for each rule
+    warnOnOutput = False
     def doCheck(self):
         if self.nagiosMode:
             ignoreChildHealth = True
         else:
             ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFAExpander,None,None,None,['EnclosureIndex','Position','Location'],ignoreChildHealth)
+        (objectStatePropertyStr, objectStateEnum, objectStateValueStr) = self.healthProperty
+        self.fault = self.doHealthCheck(self.healthClass,objectStatePropertyStr,objectStateEnum,objectStateValueStr,self.extraIdentifiers,ignoreChildHealth)
         # allow one messages line in nagios output
         roomLeftInNagiosOutput = 2
-        for object in SFAExpander.getAll():
+        # the components no rule fired for have nothing to add
+        for (object, findings) in self.rules.evaluate(self.getAll(self.ruleClass)):
             messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if object.PredictFailure:
-                    messages.append("PREDICTED FAILURE")
+            for (severity, message) in findings:
+                messages.append(message)
+                if severity == NagiosStatus.WARNING:
                     self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0:
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} EnclosureIndex: {1} Position: {2} Location: {3} Index: {4}; {5}".format(self.description,object.EnclosureIndex,object.Position,object.Location,object.Index,'; '.join(messages)))
+                elif severity == NagiosStatus.CRITICAL:
+                    self.setFaultCRITICAL()
+                elif severity == NagiosStatus.UNKNOWN:
+                    self.setFaultUNKNOWN()
+            printed = self.fault != 0 and (self.nagiosMode == False or roomLeftInNagiosOutput > 0)
+            if printed and self.warnOnOutput:
+                self.setFaultWARNING()
+            self.addComponent(object,messages)
+            if printed:
+                roomLeftInNagiosOutput -= 1
+                self.ret_str.append(self.outputFormat.format(self.description,object,'; '.join(messages)))
         returnValues = self.createCheckReturnValues()
         return returnValues
 
-class fanCheck(APICheck):
+class expanderCheck(RuleCheck):
+    """ Check the SFA expanders
+        
+        Just check the HealthState as part of doCheck
+        Also check:
+          1. Present
+          2. Not predicted failure
+          3. SES Status == OK
+    """
+    SFAClasses = [SFAExpander]
+    healthClass = ruleClass = SFAExpander
+    rules = componentRules([ ('Present', isFalse, NagiosStatus.WARNING, "NOT PRESENT"),
+                             ('PredictFailure', isTrue, NagiosStatus.WARNING, "PREDICTED FAILURE"),
+                             ('SESStatus', isNot(SFASESStatus.OK), NagiosStatus.WARNING, sesStatusMessage) ])
+    def __init__(self, thisSFA, verbose, nagiosMode):
+        APICheck.__init__(self,thisSFA,'EXPANDER',verbose,nagiosMode)
+
+class fanCheck(RuleCheck):
     """ Check all fan units in the SFA 
         
         Just check the HealthState as part of doCheck
@@ -1050,417 +2511,576 @@ class fanCheck(APICheck):
           2. Powered on
           3. SES Status == OK
     """
+    SFAClasses = [SFAFan]
+    healthClass = ruleClass = SFAFan
+    rules = componentRules([ ('Present', isFalse, NagiosStatus.WARNING, "NOT PRESENT"),
+                             ('PoweredOn', isFalse, NagiosStatus.WARNING, "NOT POWERED ON"),
+                             ('SESStatus', isNot(SFASESStatus.OK), NagiosStatus.WARNING, sesStatusMessage) ])
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'FAN',verbose,nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFAFan,None,None,None,['EnclosureIndex','Position','Location'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFAFan.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if not object.PoweredOn:
-                    messages.append("NOT POWERED ON")
-                    self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0:
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} EnclosureIndex: {1} Position: {2} Location: {3} Index: {4}; {5}".format(self.description,object.EnclosureIndex,object.Position,object.Location,object.Index,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
 
-class iocCheck(APICheck):
+class iocCheck(RuleCheck):
     """ Check the SFA IOC modules """
+    SFAClasses = [SFAIOC]
+    healthClass = ruleClass = SFAIOC
+    extraIdentifiers = ['ControllerIndex','RPIndexOnController','Slot']
+    rules = componentRules([ ('ChannelCount', isNot(2), NagiosStatus.WARNING, "ChannelCount: {0}") ])
+    outputFormat = "{0} ControllerIndex: {1.ControllerIndex} RP: {1.RPIndexOnController} Slot: {1.Slot} Index: {1.Index}; {2}"
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'IOC', verbose,nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFAIOC,None,None,None,['ControllerIndex','RPIndexOnController','Slot'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFAIOC.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if object.ChannelCount != 2:
-                    messages.append("ChannelCount: {0}".format(object.ChannelCount))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0:
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} ControllerIndex: {1} RP: {2} Slot: {3} Index: {4}; {5}".format(self.description,object.ControllerIndex,object.RPIndexOnController,object.Slot,object.Index,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
-class powerCheck(APICheck):
+class powerCheck(RuleCheck):
     """ Check the SFA power supplies """
+    SFAClasses = [SFAPowerSupply]
+    healthClass = ruleClass = SFAPowerSupply
+    extraIdentifiers = ['EnclosureIndex','Location']
+    rules = componentRules([ ('Present', isFalse, NagiosStatus.WARNING, "NOT PRESENT"),
+                             ('PowerState', isFalse, NagiosStatus.WARNING, "NOT POWERED ON"),
+                             ('ACFailure', isTrue, NagiosStatus.WARNING, "AC POWER FAILURE"),
+                             ('DCFailure', isTrue, NagiosStatus.WARNING, "DC POWER FAILURE"),
+                             ('TemperatureFailure', isTrue, NagiosStatus.WARNING, "TEMPERATURE CRITICAL"),
+                             ('TemperatureWarning', isTrue, NagiosStatus.WARNING, "TEMPERATURE WARNING"),
+                             ('PredictFailure', isTrue, NagiosStatus.WARNING, "FAILURE PREDICTED"),
+                             ('SESStatus', isNot(SFASESStatus.OK), NagiosStatus.WARNING, sesStatusMessage) ])
+    outputFormat = "{0} EnclosureIndex: {1.EnclosureIndex} Position: {1.Position} Location: {1.Location}; {2}"
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'POWER SUPPLY', verbose,nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFAPowerSupply,None,None,None,['EnclosureIndex','Location'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFAPowerSupply.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if not object.PowerState:
-                    messages.append("NOT POWERED ON")
-                    self.setFaultWARNING()
-                if object.ACFailure:
-                    messages.append("AC POWER FAILURE")
-                    self.setFaultWARNING()
-                if object.DCFailure:
-                    messages.append("DC POWER FAILURE")
-                    self.setFaultWARNING()
-                if object.TemperatureFailure:
-                    messages.append("TEMPERATURE CRITICAL")
-                    self.setFaultWARNING()
-                if object.TemperatureWarning:
-                    messages.append("TEMPERATURE WARNING")
-                    self.setFaultWARNING()
-                if object.PredictFailure:
-                    messages.append("FAILURE PREDICTED")
-                    self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0: 
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} EnclosureIndex: {1} Position: {2} Location: {3}; {4}".format(self.description,object.EnclosureIndex,object.Position,object.Location,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
-class upsCheck(APICheck):
+class upsCheck(RuleCheck):
     """ Check the UPS units """
+    SFAClasses = [SFAUPS]
+    healthClass = ruleClass = SFAUPS
+    healthProperty = ('WarningStatus', SFAWarningStatus, 'NONE')
+    extraIdentifiers = ['EnclosureIndex']
+    rules = componentRules([ ('Present', isFalse, NagiosStatus.WARNING, "NOT PRESENT"),
+                             ('Enabled', isFalse, NagiosStatus.WARNING, "NOT ENABLED"),
+                             ('ACFailure', isTrue, NagiosStatus.WARNING, "AC FAILURE"),
+                             ('UPSFailure', isTrue, NagiosStatus.WARNING, "UPS FAILURE"),
+                             ('InterfaceFailure', isTrue, NagiosStatus.WARNING, "INTERFACE FAILURE"),
+                             ('PredictFailure', isTrue, NagiosStatus.WARNING, "FAILURE PREDICTED"),
+                             ('SESStatus', isNot(SFASESStatus.OK), NagiosStatus.WARNING, sesStatusMessage) ])
+    outputFormat = "{0} EnclosureIndex: {1.EnclosureIndex}; {2}"
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'UPS',verbose,nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFAUPS,'WarningStatus',SFAWarningStatus,'NONE',['EnclosureIndex'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFAUPS.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if not object.Enabled:
-                    messages.append("NOT ENABLED")
-                    self.setFaultWARNING()
-                if object.ACFailure:
-                    messages.append("AC FAILURE")
-                    self.setFaultWARNING()
-                if object.UPSFailure:
-                    messages.append("UPS FAILURE")
-                    self.setFaultWARNING()
-                if object.InterfaceFailure:
-                    messages.append("INTERFACE FAILURE")
-                    self.setFaultWARNING()
-                if object.PredictFailure:
-                    messages.append("FAILURE PREDICTED")
-                    self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0: 
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} EnclosureIndex: {1}; {2}".format(self.description,object.EnclosureIndex,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
-class sepCheck(APICheck):
+class sepCheck(RuleCheck):
     """
     Check the SFA Enclosure Services Controller Electronics
     This includes indicator LEDs for Failure and Locate   
     """
+    SFAClasses = [SFASEP, SFAExpander]
+    healthClass = SFASEP
+    ruleClass = SFAExpander
+    rules = expanderCheck.rules
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'SEP',verbose,nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFASEP,None,None,None,['EnclosureIndex','Position','Location'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFAExpander.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if object.PredictFailure:
-                    messages.append("PREDICTED FAILURE")
-                    self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0: 
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} EnclosureIndex: {1} Position: {2} Location: {3} Index: {4}; {5}".format(self.description,object.EnclosureIndex,object.Position,object.Location,object.Index,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
-class temperatureCheck(APICheck):
+class temperatureCheck(RuleCheck):
     """ Check the SFA temperature sensors """
+    SFAClasses = [SFATemperatureSensor]
+    healthClass = ruleClass = SFATemperatureSensor
+    rules = componentRules([ ('Present', isFalse, NagiosStatus.WARNING, "NOT PRESENT"),
+                             ('PredictFailure', isTrue, NagiosStatus.WARNING, "PREDICTED FAILURE"),
+                             ('TemperatureFailure', isTrue, NagiosStatus.WARNING, "TEMPERATURE FAILURE"),
+                             ('TemperatureWarning', isTrue, NagiosStatus.WARNING, "TEMPERATURE WARNING"),
+                             ('SESStatus', isNot(SFASESStatus.OK), None, sesStatusMessage) ])
+    warnOnOutput = True
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'TEMPERATURE',verbose,nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFATemperatureSensor,None,None,None,['EnclosureIndex','Position','Location'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFATemperatureSensor.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if object.PredictFailure:
-                    messages.append("PREDICTED FAILURE")
-                    self.setFaultWARNING()
-                if object.TemperatureFailure:
-                    messages.append("TEMPERATURE FAILURE")
-                    self.setFaultWARNING()
-                if object.TemperatureWarning:
-                    messages.append("TEMPERATURE WARNING")
-                    self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-            if messages and self.fault != 0: 
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.setFaultWARNING()
-                    self.ret_str.append("{0} EnclosureIndex: {1} Position: {2} Location: {3} Index: {4}; {5}".format(self.description,object.EnclosureIndex,object.Position,object.Location,object.Index,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
-class voltageCheck(APICheck):
+class voltageCheck(RuleCheck):
     """ Check the SFA Voltage Sensors """
+    SFAClasses = [SFAVoltageSensor]
+    healthClass = ruleClass = SFAVoltageSensor
+    rules = componentRules([ ('Present', isFalse, NagiosStatus.WARNING, "NOT PRESENT"),
+                             ('PredictFailure', isTrue, NagiosStatus.WARNING, "PREDICTED FAILURE"),
+                             ('OverVoltageFailure', isTrue, NagiosStatus.WARNING, "OVER VOLTAGE FAILURE"),
+                             ('OverVoltageWarning', isTrue, NagiosStatus.WARNING, "OVER VOLTAGE WARNING"),
+                             ('UnderVoltageFailure', isTrue, NagiosStatus.WARNING, "UNDER VOLTAGE FAILURE"),
+                             ('UnderVoltageWarning', isTrue, NagiosStatus.WARNING, "UNDER VOLTAGE WARNING"),
+                             ('SESStatus', isNot(SFASESStatus.OK), NagiosStatus.WARNING, sesStatusMessage) ])
+    outputFormat = "{0} EnclosureIndex: {1.EnclosureIndex} Position: {1.Position} Location: {1.Location} Index: {1.Index} {2}"
     def __init__(self, thisSFA, verbose, nagiosMode):
         APICheck.__init__(self,thisSFA,'VOLTAGE',verbose, nagiosMode)
-    def doCheck(self):
-        if self.nagiosMode:
-            ignoreChildHealth = True
-        else:
-            ignoreChildHealth = False
-        self.fault = self.doHealthCheck(SFAVoltageSensor,None,None,None,['EnclosureIndex','Position','Location'],ignoreChildHealth)
-        # allow one messages line in nagios output
-        roomLeftInNagiosOutput = 2
-        for object in SFAVoltageSensor.getAll():
-            messages = []
-            if object.HealthState == SFAHealthState.OK:
-                if not object.Present:
-                    messages.append("NOT PRESENT")
-                    self.setFaultWARNING()
-                if object.PredictFailure:
-                    messages.append("PREDICTED FAILURE")
-                    self.setFaultWARNING()
-                if object.OverVoltageFailure:
-                    messages.append("OVER VOLTAGE FAILURE")
-                    self.setFaultWARNING()
-                if object.OverVoltageWarning:
-                    messages.append("OVER VOLTAGE WARNING")
-                    self.setFaultWARNING()
-                if object.UnderVoltageFailure:
-                    messages.append("UNDER VOLTAGE FAILURE")
-                    self.setFaultWARNING()
-                if object.UnderVoltageWarning:
-                    messages.append("UNDER VOLTAGE WARNING")
-                    self.setFaultWARNING()
-                if object.SESStatus != SFASESStatus.OK:
-                    messages.append("SES Status: {0}".format(SFASESStatus.reverse_mapping[object.SESStatus]))
-                    self.setFaultWARNING()
-            if messages and self.fault != 0:
-                if (self.nagiosMode == False or roomLeftInNagiosOutput > 0):
-                    roomLeftInNagiosOutput -= 1
-                    self.ret_str.append("{0} EnclosureIndex: {1} Position: {2} Location: {3} Index: {4} {5}".format(self.description,object.EnclosureIndex,object.Position,object.Location,object.Index,'; '.join(messages)))
-        returnValues = self.createCheckReturnValues()
-        return returnValues
 
-def readConfig(config_file):
-  config = []
-
-  if not os.path.exists(config_file):
-      sys.stderr.write("Configuration file %s could not be found\n"%config_file)
-      return None
+class SubsystemConfig (tuple):
+    """ The configuration of a subsystem: a (oid, sub_name, production, auth, options)
+        tuple, with the fields and the list of controllers also as attributes """
+    def __new__(cls, oid, sub_name, production, auth, options):
+        self = tuple.__new__(cls, (oid, sub_name, production, auth, options))
+        self.oid = oid
+        self.sub_name = sub_name
+        self.production = production
+        self.auth = auth
+        self.options = options
+        self.controllers = splitSubName(sub_name)
+        return self
+
+class Config (list):
+    """ The subsystems of a configuration file as a list of SubsystemConfig, indexed by
+        subsystem id (bySubsystem), subsystem name (bySubName) and controller name
+        (byController). errors lists the problems found while reading the file """
+    def __init__(self, entries=[], errors=[]):
+        list.__init__(self)
+        self.errors = list(errors)
+        self.bySubsystem = {}
+        self.bySubName = {}
+        self.byController = {}
+        for entry in entries:
+            self.add(entry)
+    def add(self, entry):
+        """ Add entry unless its id or one of its controllers is already configured.
+            Returns the reason it was not added, or None """
+        if entry.oid in self.bySubsystem:
+            return "subsystem id %s is already used by %s"%(entry.oid,self.bySubsystem[entry.oid].sub_name)
+        for con in entry.controllers:
+            if con in self.byController:
+                return "controller %s is already in subsystem %s"%(con,self.byController[con].sub_name)
+        self.append(entry)
+        self.bySubsystem[entry.oid] = entry
+        self.bySubName[entry.sub_name] = entry
+        for con in entry.controllers:
+            self.byController[con] = entry
+        return None
 
-  f = open(config_file,'r')
-  lines = f.readlines()
+# per-subsystem options of the configuration file that are positive integers
+intOptions = ['timeout','interval','rate_interval']
 
-  for line in lines:
-    # remove comments and split so accept lines with comments at end
-    if "#" in line:
-        if re.match("^[ \t]*#",line):
-          continue
-        else:
-          line = line.split('#')[0]
-    if re.match("^[ \t]*$",line):
-        # blank line
-        continue
+def parseConfigLine(line):
+    """ Parse a line of the configuration file into a SubsystemConfig. Returns None for
+        blank and comment lines and raises ValueError for malformed ones """
+    line = line.split('#')[0].strip()
+    if not line:
+        return None
     config_list = line.split(':')
+    if len(config_list) < 3:
+        raise ValueError("expected index:controllers:production")
     sub_oid = config_list[0].strip()
-    controllers =  config_list[1].strip()
-    prod_int = int(config_list[2].strip())
-    if prod_int == 1:
-        production = True
-    else:
-        production = False
+    if not sub_oid:
+        raise ValueError("missing subsystem index")
+    controllers = config_list[1].strip()
+    if not controllers or re.search("[ \t]",controllers) or re.search("(^,|,,|,$)",controllers):
+        raise ValueError("bad controller pair %s"%controllers)
+    prod_str = config_list[2].strip()
+    if not prod_str in ('0','1'):
+        raise ValueError("production must be 0 or 1, not %s"%prod_str)
+    production = (prod_str == '1')
 
     auth = ("user","user")
-    if len(config_list) > 3:
-        if "," in config_list[3]:
-            auth = config_list[3].strip().split(',')
-    
-    if re.search("[ \t]",controllers) or re.search(",{2,}",controllers):
-        syslog.syslog(syslog.LOG_WARNING,"Bad controller pair %s"%controllers)
-        continue
-
-    # add a tuple to the config list
-    config.append((sub_oid, controllers, production, auth))
-  return config
-
-
-def run(foo):
-    """ Very dumb function that is just used to pickle an APIworker method for the 
-        pool.apply_async() call. Returns APIworker.run() """
-    return foo.run()
-
-
+    options = {}
+    for field in config_list[3:]:
+        field = field.strip()
+        if "=" in field:
+            # per-subsystem option (e.g. timeout=120)
+            (key,value) = field.split('=',1)
+            options[key.strip()] = value.strip()
+        elif "," in field:
+            credentials = field.split(',')
+            if len(credentials) != 2:
+                raise ValueError("credentials must be username,password")
+            auth = tuple(credentials)
+        elif field:
+            raise ValueError("unknown field %s"%field)
+    for key in options.keys():
+        value = options[key]
+        if key in intOptions:
+            try:
+                options[key] = int(value)
+            except ValueError:
+                raise ValueError("%s must be a number of seconds, not %s"%(key,value))
+            if options[key] <= 0:
+                raise ValueError("%s must be positive"%key)
+        elif key.startswith('rate.'):
+            try:
+                options[key] = float(value)
+            except ValueError:
+                raise ValueError("%s must be a number, not %s"%(key,value))
+        elif key == 'modules':
+            options[key] = value.split(',')
+            for module in options[key]:
+                if not module in implementedModules:
+                    raise ValueError("unknown module %s"%module)
+        elif key in ('username','password'):
+            pass
+        else:
+            raise ValueError("unknown option %s"%key)
+    # credentials given as options override the username,password field
+    auth = (options.pop('username',auth[0]), options.pop('password',auth[1]))
+
+    return SubsystemConfig(sub_oid, controllers, production, auth, options)
+
+def parseConfig(config_file):
+    """ Read config_file into a Config. Malformed lines are logged and skipped """
+    config = Config()
+    f = open(config_file,'r')
+    lines = f.readlines()
+    f.close()
+    for (number,line) in enumerate(lines):
+        try:
+            entry = parseConfigLine(line)
+            if entry is None:
+                continue
+            error = config.add(entry)
+        except ValueError, err:
+            error = str(err)
+        if error:
+            config.errors.append("%s line %d: %s"%(config_file,number + 1,error))
+            syslog.syslog(syslog.LOG_WARNING,"Ignoring %s line %d: %s"%(config_file,number + 1,error))
+    return config
+
+class ConfigFile (object):
+    """ A configuration file and the Config read from it. The file is read again only
+        when it was replaced or modified (its inode, size or mtime changed), or after
+        reload(). If the file disappears, the last Config read is kept """
+    def __init__(self, path):
+        self.path = path
+        self.signature = None
+        self.config = None
+        self.forced = False
+    def reload(self):
+        """ Read the file again on the next get(). Safe to call from a signal handler """
+        self.forced = True
+    def get(self):
+        try:
+            st = os.stat(self.path)
+            signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            if self.config is None:
+                sys.stderr.write("Configuration file %s could not be found\n"%self.path)
+                self.config = Config(errors=["Configuration file %s could not be found"%self.path])
+            return self.config
+        if self.config is not None and signature == self.signature and not self.forced:
+            return self.config
+        self.forced = False
+        try:
+            config = parseConfig(self.path)
+        except IOError, err:
+            syslog.syslog(syslog.LOG_WARNING,"Could not read %s: %s"%(self.path,err))
+            if self.config is None:
+                self.config = Config(errors=["Could not read %s: %s"%(self.path,err)])
+            return self.config
+        self.signature = signature
+        self.config = config
+        return self.config
+
+# the configuration files read from this process, by path
+configFiles = {}
+
+def getConfigFile(config_file):
+    if not config_file in configFiles:
+        configFiles[config_file] = ConfigFile(config_file)
+    return configFiles[config_file]
 
-def sfaAPICheck(config,modules,verbose,nagiosMode,nprocs):
-    """ Creates the API check tasks as part of a process pool """
+def readConfig(config_file):
+    """ The Config of config_file, read again only if the file changed since the last call """
+    return getConfigFile(config_file).get()
+
+def workerLoop(conn,sessionIdle):
+    """ Main loop of a persistent worker process. Receives (taskId, APIworker) tasks on
+        conn and sends back (taskId, ret_str, rc, name of the controller that answered,
+        structured result).
+        The API session of the last checked controller stays open between tasks until it has
+        been idle for sessionIdle seconds """
+    session = APISession(sessionIdle)
+    try:
+        while True:
+            if not conn.poll(sessionIdle):
+                session.expire()
+                continue
+            task = conn.recv()
+            if task is None:
+                break
+            (taskId, worker) = task
+            (ret_str, rc) = worker.run(session)
+            conn.send((taskId, ret_str, rc, worker.controller.get('answered'), worker.controller.get('result')))
+    except (EOFError, IOError, KeyboardInterrupt):
+        # the parent went away
+        pass
+    session.close()
+
+class APIworkerSlot (object):
+    """ A persistent worker process of an APIworkerPool and the task it is running """
+    def __init__(self, sessionIdle):
+        self.sessionIdle = sessionIdle
+        self.start()
+    def start(self):
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=workerLoop, args=(child_conn,self.sessionIdle))
+        self.process.daemon = True
+        self.process.start()
+        # only the worker holds the other end, so we see EOF if it dies
+        child_conn.close()
+        # (taskId, APIworker, start time) of the running task
+        self.task = None
+        # the subsystem the worker last checked, and (probably) still has a session open to
+        self.subsystem = None
+        self.lastUsed = time.time()
+    def send(self, taskId, worker):
+        self.task = (taskId, worker, time.time())
+        self.subsystem = worker.controller['sub_name']
+        self.conn.send((taskId, worker))
+    def kill(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+    def restart(self):
+        self.kill()
+        self.start()
+    def stop(self):
+        """ Ask an idle worker to exit, kill it if it is busy or does not listen """
+        if self.task is None:
+            try:
+                self.conn.send(None)
+            except (IOError, EOFError):
+                pass
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
+
+class APIworkerPool (object):
+    """ A pool of long-lived worker processes that run APIworker checks.
+
+        At most nprocs checks run at once, but up to maxWorkers worker processes are
+        kept around. Each worker keeps the API session of the controller it last
+        checked, and a check is handed to the worker that last checked its subsystem
+        when possible, so with maxWorkers at least the number of subsystems every
+        subsystem keeps its own session between runs.
+
+        If stateStore is set, the checks are prepared by it when submitted and their
+        results compared with the last run of their subsystem when they come back.
+
+        A check that runs longer than the timeout of its APIworker gets its worker
+        killed and replaced, and is reported UNKNOWN.
+    """
+    def __init__(self, nprocs, maxWorkers=None, sessionIdle=defaultSessionIdle):
+        self.nprocs = nprocs
+        if maxWorkers is None or maxWorkers < nprocs:
+            maxWorkers = nprocs
+        self.maxWorkers = maxWorkers
+        self.sessionIdle = sessionIdle
+        self.slots = []
+        # (taskId, APIworker) waiting for a worker
+        self.pending = []
+        self.nextTaskId = 0
+    def submit(self, worker):
+        """ Queue a check. Returns the task id that poll() reports its result with """
+        if stateStore is not None:
+            stateStore.prepare(worker.controller)
+        taskId = self.nextTaskId
+        self.nextTaskId += 1
+        self.pending.append((taskId, worker))
+        return taskId
+    def cancel(self, taskIds):
+        """ Drop the given tasks if they have not started yet """
+        self.pending = [ (taskId, worker) for (taskId, worker) in self.pending if not taskId in taskIds ]
+    def running(self):
+        return [ slot for slot in self.slots if slot.task ]
+    def busy(self):
+        return len(self.pending) > 0 or len(self.running()) > 0
+    def getSlot(self, sub_name):
+        """ Pick the worker for a check of subsystem sub_name: the one that last checked
+            it, a new one, or else the idle worker that has been unused the longest """
+        idle = [ slot for slot in self.slots if slot.task is None ]
+        for slot in idle:
+            if slot.subsystem == sub_name:
+                return slot
+        if len(self.slots) < self.maxWorkers:
+            slot = APIworkerSlot(self.sessionIdle)
+            self.slots.append(slot)
+            return slot
+        if idle:
+            idle.sort(key=lambda slot: slot.lastUsed)
+            return idle[0]
+        return None
+    def dispatch(self):
+        """ Start pending checks while there are free slots """
+        while self.pending and len(self.running()) < self.nprocs:
+            (taskId, worker) = self.pending[0]
+            slot = self.getSlot(worker.controller['sub_name'])
+            if slot is None:
+                break
+            self.pending.pop(0)
+            try:
+                slot.send(taskId, worker)
+            except (IOError, EOFError):
+                # the worker died while idle, replace it and try again
+                slot.restart()
+                slot.send(taskId, worker)
+    def poll(self, timeout):
+        """ Start pending checks and wait up to timeout seconds for results. Returns a list
+            of (taskId, SubsystemResult) for the checks that completed or timed out """
+        results = []
+        self.dispatch()
+        running = self.running()
+        if not running:
+            return results
+
+        # wake up by the earliest deadline
+        now = time.time()
+        wait = timeout
+        for slot in running:
+            (taskId, worker, start_time) = slot.task
+            wait = min(wait, start_time + worker.timeout - now)
+        try:
+            (readable, writable, exceptional) = select.select([ slot.conn for slot in running ], [], [], max(wait,0))
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            readable = []
+
+        now = time.time()
+        for slot in running:
+            (taskId, worker, start_time) = slot.task
+            sub_name = worker.controller['sub_name']
+            elapsed = now - start_time
+            if slot.conn in readable:
+                try:
+                    (resultId, ret_str, rc, answered, result) = slot.conn.recv()
+                except (EOFError, IOError):
+                    slot.restart()
+                    results.append((taskId, SubsystemResult(sub_name, "%s: UNKNOWN: SFA check exited after %d seconds without a result"%(sub_name.split(",")[0],elapsed), NagiosStatus.UNKNOWN)))
+                    continue
+                slot.task = None
+                slot.lastUsed = now
+                if answered:
+                    lastGood.set(sub_name, answered)
+                if stateStore is not None and result:
+                    if stateStore.update(result) and not worker.nagiosMode:
+                        # the extended output lists the state changes
+                        (ret_str, rc) = renderNagios(result, worker.nagiosMode, worker.verbose)
+                    if not worker.controller.get('records'):
+                        # only the store asked for them
+                        result.pop('records',None)
+                results.append((taskId, SubsystemResult(sub_name, ret_str, rc, result)))
+            elif elapsed >= worker.timeout:
+                # kill only the hung worker, a new one takes its place
+                slot.restart()
+                results.append((taskId, SubsystemResult(sub_name, "%s: UNKNOWN: SFA check timed out after %d seconds"%(sub_name.split(",")[0],elapsed), NagiosStatus.UNKNOWN)))
+
+        # give the freed slots to pending checks right away
+        self.dispatch()
+        return results
+    def close(self):
+        """ Stop all workers. Running checks are killed """
+        self.pending = []
+        for slot in self.slots:
+            slot.stop()
+        self.slots = []
+
+def prepareWorkers(config,modules,verbose,nagiosMode,checkConcurrency=1,timeout=defaultTimeout,connectTimeout=defaultConnectTimeout,parallelConnect=False,records=False):
+    """ Resolve the controllers of each subsystem in config and create an APIworker
+        for each subsystem with at least one controller that resolves. The controller
+        that answered last time is tried first """
 
     # a list to keep track of the APIworker objects to call the run() method on
     worker_objects = []
 
-    # store the results
-    return_results = []
-
-    # set to warning if something goes wrong
-    rc = NagiosStatus.WARNING
-
-    # Use a queue to keep track of the results
-    queue = multiprocessing.Queue()
+    # resolve the controllers of all subsystems at once
+    all_names = []
+    for (oid,sub,production,auth,options) in config:
+        all_names.extend(splitSubName(sub))
+    addresses = resolver.resolve(all_names,verbose)
 
     # Each tuple in the config list is for a single subsystem
-    for subIndex,(oid,sub,production,auth) in enumerate(config):
-        controller_names = []
-
+    for (oid,sub,production,auth,options) in config:
         # split the subsystem string to controller names
         controller_names = splitSubName(sub)
 
+        preferred = lastGood.get(sub)
+        if preferred in controller_names:
+            controller_names.remove(preferred)
+            controller_names.insert(0,preferred)
+
+        candidates = []
         for con in controller_names:
-            # check that we haven't prepped a worker on this subsystem already
-            try:
-                if worker_objects[subIndex]:
-                    break
-            except IndexError:
-                pass
-            
             # get the IP for this controller
-            try:
-                ip = socket.getaddrinfo(con, None)[0][4][0]
-            except socket.gaierror:
+            ip = addresses.get(con)
+            if not ip:
                 # if that fails continue to the next controller
                 if not nagiosMode:
                   sys.stdout.write("Could not resolve host name: %s\n"%con)
                 continue
-
-            # This is the dictionary struct that holds necessary information
-            # for starting the API context
-            controller = {}
-            controller['sub_name'] = sub
-            controller['production'] = production
-            controller['ip'] = ip
-            controller['auth'] = auth
+            candidates.append((con,ip))
+
+        if not candidates:
+            continue
+
+        # This is the dictionary struct that holds necessary information
+        # for starting the API context
+        controller = {}
+        controller['sub_name'] = sub
+        controller['production'] = production
+        controller['ip'] = candidates[0][1]
+        controller['candidates'] = candidates
+        controller['auth'] = auth
+        controller['connect_timeout'] = connectTimeout
+        controller['parallel_connect'] = parallelConnect
+        controller['records'] = records
+        counterRates = dict(counterRateThresholds)
+        for key in options:
+            if key.startswith('rate.'):
+                counterRates[key[len('rate.'):]] = options[key]
+        controller['counter_rates'] = counterRates
+        if history is not None:
+            # the earlier samples the checks compare the error counters with
+            controller['counter_history'] = history.window(sub,counterMetrics,time.time() - options.get('rate_interval',defaultRateInterval))
             
-            if verbose:
-                print "Calling SFA API check for %s"%ip
+        if verbose:
+            print "Calling SFA API check for %s"%controller['ip']
+
+        worker_objects.append(APIworker(controller,options.get('modules',modules),verbose,nagiosMode,checkConcurrency,options.get('timeout',timeout)))
+
+    return worker_objects
+
+def sfaAPICheckStream(config,modules,verbose,nagiosMode,nprocs,checkConcurrency=1,timeout=defaultTimeout,pool=None,connectTimeout=defaultConnectTimeout,parallelConnect=False,records=False):
+    """ Runs the API check of each subsystem in a worker process, at most nprocs at a
+        time, and yields a (sub_name, ret_str, rc) SubsystemResult for each subsystem as
+        soon as its check completes.
+
+        Each check has a deadline of timeout seconds, unless overridden for the
+        subsystem in config. A worker that misses its deadline is killed, its
+        subsystem is reported UNKNOWN and the slot is given to the next pending check.
+
+        If pool is given, the checks run on that APIworkerPool, which is left running
+        for the next call. Otherwise a pool is started for this call only.
 
-            worker_objects.append(APIworker(controller,modules,verbose,nagiosMode))
-  
+        With records, each result also carries the ComponentRecords of the objects
+        its check fetched (SubsystemResult.records).
+    """
+
+    worker_objects = prepareWorkers(config,modules,verbose,nagiosMode,checkConcurrency,timeout,connectTimeout,parallelConnect,records)
     if len(worker_objects) == 0:
-        # pack return results
-        name = "None"
-        ret_str = "No valid hosts to check"
-        rc = NagiosStatus.UNKNOWN
-        return_results.append((name,ret_str,rc))
-        return return_results
+        yield SubsystemResult("None","No valid hosts to check",NagiosStatus.UNKNOWN)
+        return
 
-    # A worker pool of at most nprocs workers
-    # if the number of subsystems in config is less, then only start the needed number
-    pool = multiprocessing.Pool(min(nprocs,len(worker_objects)))
+    ownPool = pool is None
+    if ownPool:
+        pool = APIworkerPool(min(nprocs,len(worker_objects)))
 
-    # start processes
-    results = [ (w.controller['sub_name'],pool.apply_async(run, args=(w,), callback = queue.put)) for w in worker_objects ]
-    # implement a timeout for all threads
-    start_time = time.time()
-    timeout_expired = False
-    timeout=300
-    start_idx = 0
-
-    while (len(results) > 0):
-        current_time = time.time()
-        if (current_time > (start_time + timeout)):
-            timeout_expired = True
-
-        for idx,(name,r) in enumerate(results):
-            current_idx = idx + start_idx
-            if r.ready():
-                # this worker has data ready. we are relying on the
-                # callback method to put the data in the queue.
-                # assuming successful, we can now stop checking for this one
-                ( worker_ret_str, worker_rc ) = r.get()
-
-
-                # before using the resuls in the return from this function, parse out the first
-                # controller name
-                return_results.append((name,worker_ret_str, worker_rc))
-                results.remove((name,r))
-                continue
-            elif timeout_expired:
-                return_results.append((name, "SFA check of controller timed out", 3))
-                r.terminate()
-                results.remove((name,r))
-        if timeout_expired:
-            #print "times up!"
-            break
-        if results:
-            time.sleep(10)
+    taskIds = set()
+    for w in worker_objects:
+        taskIds.add(pool.submit(w))
 
-    # return the highest value
-    return return_results
+    try:
+        while taskIds:
+            for (taskId, result) in pool.poll(1.0):
+                if taskId in taskIds:
+                    taskIds.remove(taskId)
+                    yield result
+    finally:
+        if ownPool:
+            # kills the workers that are still running if the consumer went away
+            pool.close()
+        elif taskIds:
+            pool.cancel(taskIds)
+
+def sfaAPICheck(config,modules,verbose,nagiosMode,nprocs,checkConcurrency=1,timeout=defaultTimeout,pool=None,connectTimeout=defaultConnectTimeout,parallelConnect=False,records=False):
+    """ Runs the API checks for all subsystems in config and returns a list of
+        (sub_name, ret_str, rc) SubsystemResults in the order the checks completed """
+    return list(sfaAPICheckStream(config,modules,verbose,nagiosMode,nprocs,checkConcurrency,timeout,pool,connectTimeout,parallelConnect,records))
 
 def verifyModules(moduleList):
     """ Make sure the users input contains valid (implemented) modules """
@@ -1472,6 +3092,56 @@ def verifyModules(moduleList):
             return 1
     return 0
 
+# Nagios output in the fleet summary of a subsystem none of whose controllers resolved
+unresolvedOutput = "none of the controllers could be resolved"
+
+def fleetSummaryRows(results, config, width=100):
+    """ The rows of the fleet summary of a round of checks, the most severe first: one
+        (rc, sub_name, system name, check duration, slowest check module, first width
+        characters of the Nagios output) per subsystem. Subsystems of config without a
+        result (none of their controllers resolved) are listed as UNKNOWN """
+    rows = []
+    checked = {}
+    for result in results:
+        (sub_name, ret_str, rc) = result
+        if not sub_name in config.bySubName:
+            continue
+        checked[sub_name] = True
+        duration = slowest = '-'
+        if result.timing:
+            duration = "%.2fs"%result.timing['wall']
+            if result.timing.get('checks'):
+                check = max(result.timing['checks'],key=lambda check: check['wall'])
+                slowest = "%s %.2fs"%(check['name'],check['wall'])
+        systemName = '-'
+        if result.result and result.result.get('system_name'):
+            systemName = result.result['system_name']
+        rows.append((rc,sub_name,systemName,duration,slowest,ret_str.split("\n")[0][:width]))
+    for entry in config:
+        if not entry.sub_name in checked:
+            rows.append((NagiosStatus.UNKNOWN,entry.sub_name,'-','-','-',unresolvedOutput))
+    rows.sort(key=lambda row: (-statusSeverity.index(row[0]),row[1]))
+    return rows
+
+def fleetSummaryStrings(rows, wall):
+    """ Format the rows from fleetSummaryRows as a fleet summary: the count of
+        subsystems by status, then the table of rows """
+    counts = {}
+    for row in rows:
+        counts[row[0]] = counts.get(row[0],0) + 1
+    summary = "%d/%d OK"%(counts.get(NagiosStatus.OK,0),len(rows))
+    for status in reversed(statusSeverity[1:]):
+        if counts.get(status):
+            summary += ", %d %s"%(counts[status],NagiosStatus.reverse_mapping[status])
+    summaryStrings = ["Fleet summary: %s, checked in %.1fs"%(summary,wall)]
+
+    header = ('STATUS','SUBSYSTEM','SYSTEM','DURATION','SLOWEST CHECK','OUTPUT')
+    table = [ header ] + [ (NagiosStatus.reverse_mapping.get(row[0],str(row[0])),) + row[1:] for row in rows ]
+    widths = [ max([ len(str(line[column])) for line in table ]) for column in range(len(header) - 1) ]
+    for line in table:
+        summaryStrings.append('  '.join([ str(value).ljust(widths[column]) for (column,value) in enumerate(line[:-1]) ] + [line[-1]]))
+    return summaryStrings
+
 def main():
     """ Main routine:
 
@@ -1488,12 +3158,21 @@ def main():
                       help="list check modules to run on the hosts")
     parser.add_argument('--production', help="Specific production subsystems to run all pool settings checks", default = True)
     parser.add_argument('-n', '--nprocs', help="Max number of worker processes (for each subsystem)", default = 8)
+    parser.add_argument('--check-concurrency', metavar='N', help="Fetch the SFA objects needed by the checks of a subsystem with up to N parallel API requests", default = 1)
+    parser.add_argument('-t', '--timeout', help="Seconds before the check of a subsystem is killed and reported UNKNOWN", default = defaultTimeout)
+    parser.add_argument('--connect-timeout', help="Seconds to wait for a controller to answer before trying the other one", default = defaultConnectTimeout)
+    parser.add_argument('--parallel-connect', help="Probe both controllers of a subsystem at once and use the first to answer", action="store_true",default=False)
     parser.add_argument('-c', '--config', help="Path to configuration file", default=defaultConfig)
     parser.add_argument('-p', '--password', help="API password", default="user")
     parser.add_argument('-u', '--username', help="API username", default="user")
     parser.add_argument('-x', '--extended', help="Extended output mode for running from console (implies -q)", action="store_true",default=False)
     parser.add_argument('-v', '--verbose', help="Be verbose", action="store_true",default=False)
     parser.add_argument('-q', '--quiet', help="Redirect stderr to /dev/null", action="store_true",default=False)
+    parser.add_argument('--max-lines', metavar='N', help="Lines of messages shown per check in extended output, 0 for all (default %d)"%defaultLineLimit, default = defaultLineLimit)
+    parser.add_argument('--format', help="Output format: nagios (default), json, one JSON object per subsystem per line, or summary, a progress line per subsystem and a table of all sorted by status", choices=['nagios','json','summary'], default='nagios')
+    parser.add_argument('--timings', metavar='FILE', help="Append the timing of each subsystem and its checks to FILE as one JSON object per line ('-' for stdout)")
+    parser.add_argument('--history', metavar='FILE', help="Keep the component values (error counters, bad blocks, speeds) of each run in the history file FILE")
+    parser.add_argument('--history-retention', metavar='DAYS', help="Days the values in the history file are kept", default = defaultHistoryRetention / 86400)
 
     try:
         args = parser.parse_args()
@@ -1508,10 +3187,11 @@ def main():
 
         auth = (args.username,args.password)
 
-        config = [] 
+        config = Config()
         for idx,sub in enumerate(args.subsystems):
-            config_line = ( idx, sub, args.production, auth )
-            config.append(config_line)
+            error = config.add(SubsystemConfig(str(idx), sub, args.production, auth, {}))
+            if error:
+                sys.stderr.write("Ignoring %s: %s\n"%(sub,error))
 
     else:
         config = readConfig(args.config)
@@ -1525,7 +3205,7 @@ def main():
        parser.print_help()
        return rc
  
-    if args.extended:
+    if args.extended and args.format != 'summary':
         nagiosMode = False
     else:
         args.quiet = True
@@ -1537,14 +3217,61 @@ def main():
         sys.stderr = devnull
 
     nprocs = int(args.nprocs)
-    return_results = sfaAPICheck(config,modules,args.verbose,nagiosMode,nprocs)
+    checkConcurrency = int(args.check_concurrency)
+    timeout = int(args.timeout)
+    connectTimeout = float(args.connect_timeout)
+    timingFile = None
+    if args.timings == '-':
+        timingFile = sys.stdout
+    elif args.timings:
+        timingFile = open(args.timings, 'a')
+    global history, extendedLineLimit
+    extendedLineLimit = int(args.max_lines)
+    if args.history:
+        history = HistoryStore(int(float(args.history_retention) * 86400))
+        history.load(args.history)
     # the results we get back are a tuple with the controller name that returned the results
-    # the output as a list, and the numeric return code
-    for con_name,con_ret_str,con_rc in return_results:
-        print con_ret_str
+    # the output as a list, and the numeric return code. Print them as they complete
+    results = []
+    start_time = time.time()
+    for result in sfaAPICheckStream(config,modules,args.verbose,nagiosMode,nprocs,checkConcurrency,timeout,None,connectTimeout,args.parallel_connect):
+        (con_name,con_ret_str,con_rc) = result
+        if args.format == 'json':
+            print json.dumps(result.asDict(), default=str)
+        elif args.format == 'summary':
+            # not the placeholder result of a round in which no subsystem resolved
+            if con_name in config.bySubName:
+                results.append(result)
+                print "[%d/%d] %s: %s after %.1fs"%(len(results),len(config),con_name,
+                                                   NagiosStatus.reverse_mapping.get(con_rc,con_rc),time.time() - start_time)
+                sys.stdout.flush()
+        else:
+            print con_ret_str
         if con_rc > rc:
             rc = con_rc
-
+        if timingFile:
+            timingFile.write(json.dumps({ 'time': int(time.time()), 'sub_name': con_name, 'rc': con_rc, 'timing': result.timing }) + "\n")
+            timingFile.flush()
+        if history is not None and result.metrics:
+            history.record(con_name, result.metrics)
+
+    if args.format == 'summary':
+        # subsystems none of whose controllers resolved have no result in the stream
+        checked = dict([ (result[0], True) for result in results ])
+        done = len(results)
+        for entry in config:
+            if not entry.sub_name in checked:
+                done += 1
+                print "[%d/%d] %s: UNKNOWN, %s"%(done,len(config),entry.sub_name,unresolvedOutput)
+        rows = fleetSummaryRows(results,config)
+        rc = NagiosStatus.OK
+        for row in rows:
+            rc = worseStatus(rc,row[0])
+        print "\n".join(fleetSummaryStrings(rows,time.time() - start_time))
+    if history is not None:
+        history.close()
+    if timingFile and timingFile != sys.stdout:
+        timingFile.close()
     return rc
 
 if __name__ == "__main__":
@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+sfa_check_agentx.py
+
+An AgentX (RFC 2741) subagent that serves the tree of sfa_check_pp_daemon.py from
+memory, as an alternative to the pass_persist protocol of snmpd. Subagent has the
+add_int()/add_str()/commit()/start() interface of snmp_passpersist.PassPersist, so
+the daemon publishes to either one the same way.
+
+Run as a script, this is a minimal AgentX master agent to test the subagent
+without snmpd: it waits for a subagent to connect and walks its tree with GETBULK.
+
+  ./sfa_check_agentx.py --listen /tmp/agentx.sock
+"""
+
+import socket
+import struct
+import threading
+import bisect
+import time
+import os
+import sys
+from argparse import ArgumentParser
+
+defaultMaster = "/var/agentx/master"
+AgentXPort = 705
+
+# PDU types
+OPEN = 1
+CLOSE = 2
+REGISTER = 3
+UNREGISTER = 4
+GET = 5
+GETNEXT = 6
+GETBULK = 7
+TESTSET = 8
+COMMITSET = 9
+UNDOSET = 10
+CLEANUPSET = 11
+NOTIFY = 12
+PING = 13
+RESPONSE = 18
+
+# header flags
+INSTANCE_REGISTRATION = 0x01
+NON_DEFAULT_CONTEXT = 0x08
+NETWORK_BYTE_ORDER = 0x10
+
+# varbind types
+INTEGER = 2
+OCTET_STRING = 4
+NULL = 5
+OBJECT_IDENTIFIER = 6
+COUNTER32 = 65
+GAUGE32 = 66
+TIMETICKS = 67
+NO_SUCH_OBJECT = 128
+NO_SUCH_INSTANCE = 129
+END_OF_MIB_VIEW = 130
+
+# Response errors
+NO_ERROR = 0
+NOT_WRITABLE = 17
+PROCESSING_ERROR = 268
+
+# Close reasons
+REASON_SHUTDOWN = 5
+
+headerLength = 20
+internetPrefix = (1, 3, 6, 1)
+
+class AgentXError (Exception):
+    pass
+
+def parseOID(oid):
+    """ '.1.3.6.1.4' -> (1, 3, 6, 1, 4) """
+    return tuple([ int(subid) for subid in oid.strip('.').split('.') if subid ])
+
+def formatOID(oid):
+    return '.' + '.'.join([ str(subid) for subid in oid ])
+
+def encodeOID(oid, order, include=0):
+    """ An OID, compressed with the prefix field when it starts with 1.3.6.1.<n> """
+    prefix = 0
+    if len(oid) > 4 and oid[:4] == internetPrefix and 0 < oid[4] < 256:
+        prefix = oid[4]
+        oid = oid[5:]
+    return struct.pack(order + 'BBBB', len(oid), prefix, include, 0) + struct.pack(order + '%dI'%len(oid), *oid)
+
+def decodeOID(data, offset, order):
+    """ Returns (oid, include, offset after it) """
+    (count, prefix, include) = struct.unpack_from(order + 'BBB', data, offset)
+    offset += 4
+    oid = struct.unpack_from(order + '%dI'%count, data, offset)
+    offset += 4 * count
+    if prefix:
+        oid = internetPrefix + (prefix,) + oid
+    return (oid, include, offset)
+
+def encodeOctets(value, order):
+    return struct.pack(order + 'I', len(value)) + value + '\0' * (-len(value) % 4)
+
+def decodeOctets(data, offset, order):
+    (length,) = struct.unpack_from(order + 'I', data, offset)
+    offset += 4
+    return (data[offset:offset + length], offset + length + (-length % 4))
+
+def encodeVarBind(oid, type, value, order):
+    data = struct.pack(order + 'HH', type, 0) + encodeOID(oid, order)
+    if type == INTEGER:
+        data += struct.pack(order + 'i', value)
+    elif type in (COUNTER32, GAUGE32, TIMETICKS):
+        data += struct.pack(order + 'I', value)
+    elif type == OCTET_STRING:
+        data += encodeOctets(value, order)
+    elif type == OBJECT_IDENTIFIER:
+        data += encodeOID(value, order)
+    return data
+
+def decodeVarBind(data, offset, order):
+    """ Returns ((oid, type, value), offset after it) """
+    (type,) = struct.unpack_from(order + 'H', data, offset)
+    (oid, include, offset) = decodeOID(data, offset + 4, order)
+    value = None
+    if type == INTEGER:
+        (value,) = struct.unpack_from(order + 'i', data, offset)
+        offset += 4
+    elif type in (COUNTER32, GAUGE32, TIMETICKS):
+        (value,) = struct.unpack_from(order + 'I', data, offset)
+        offset += 4
+    elif type == OCTET_STRING:
+        (value, offset) = decodeOctets(data, offset, order)
+    elif type == OBJECT_IDENTIFIER:
+        (value, include, offset) = decodeOID(data, offset, order)
+    elif not type in (NULL, NO_SUCH_OBJECT, NO_SUCH_INSTANCE, END_OF_MIB_VIEW):
+        raise AgentXError("unsupported varbind type %d"%type)
+    return ((oid, type, value), offset)
+
+class PDU (object):
+    """ A decoded AgentX PDU. payload is the part after the header and the context """
+    def __init__(self, type, sessionID=0, transactionID=0, packetID=0, payload='', flags=NETWORK_BYTE_ORDER):
+        self.type = type
+        self.flags = flags
+        self.sessionID = sessionID
+        self.transactionID = transactionID
+        self.packetID = packetID
+        self.payload = payload
+        self.order = '!'
+        if not flags & NETWORK_BYTE_ORDER:
+            self.order = '<'
+    def encode(self):
+        return struct.pack(self.order + 'BBBBIIII', 1, self.type, self.flags, 0, self.sessionID,
+                           self.transactionID, self.packetID, len(self.payload)) + self.payload
+
+def receivePDU(sock):
+    """ Read a PDU from sock. Raises AgentXError when the peer closes the connection """
+    header = receiveExactly(sock, headerLength)
+    (version, type, flags) = struct.unpack('BBB', header[:3])
+    if version != 1:
+        raise AgentXError("unsupported AgentX version %d"%version)
+    order = '!'
+    if not flags & NETWORK_BYTE_ORDER:
+        order = '<'
+    (sessionID, transactionID, packetID, length) = struct.unpack(order + 'IIII', header[4:])
+    payload = receiveExactly(sock, length)
+    if flags & NON_DEFAULT_CONTEXT:
+        # only the default context is served, the context is skipped
+        (context, offset) = decodeOctets(payload, 0, order)
+        payload = payload[offset:]
+    return PDU(type, sessionID, transactionID, packetID, payload, flags & ~NON_DEFAULT_CONTEXT)
+
+def receiveExactly(sock, length):
+    data = ''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise AgentXError("connection closed by the peer")
+        data += chunk
+    return data
+
+def decodeSearchRanges(data, offset, order):
+    """ The (start, include, end) search ranges of a Get, GetNext or GetBulk PDU """
+    ranges = []
+    while offset < len(data):
+        (start, include, offset) = decodeOID(data, offset, order)
+        (end, endInclude, offset) = decodeOID(data, offset, order)
+        ranges.append((start, include, end))
+    return ranges
+
+def connectMaster(address, timeout=None):
+    """ A socket connected to the master agent at address, a unix socket path or host:port """
+    if ':' in address:
+        (host, port) = address.rsplit(':', 1)
+        sock = socket.create_connection((host, int(port)), timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    sock.settimeout(None)
+    return sock
+
+class MIBView (object):
+    """ A sorted, read-only snapshot of the served values. Lookups are bisections of the
+        sorted OID list, and a GETBULK walks the list from the first match """
+    def __init__(self, values):
+        # values: { oid tuple: (type, value) }
+        self.oids = sorted(values)
+        self.values = [ values[oid] for oid in self.oids ]
+    def get(self, oid):
+        index = bisect.bisect_left(self.oids, oid)
+        if index < len(self.oids) and self.oids[index] == oid:
+            return self.values[index]
+        return None
+    def nextIndex(self, oid, include):
+        """ Index of the first OID after oid (or at it, if include) """
+        if include:
+            return bisect.bisect_left(self.oids, oid)
+        return bisect.bisect_right(self.oids, oid)
+    def varBind(self, index, start, end):
+        """ The (oid, type, value) at index, or endOfMibView if past the end of the range """
+        if index >= len(self.oids) or (end and self.oids[index] >= end):
+            return (start, END_OF_MIB_VIEW, None)
+        (type, value) = self.values[index]
+        return (self.oids[index], type, value)
+
+class Subagent (object):
+    """ An AgentX subagent serving the values added with add_int()/add_str() under base.
+        The values added since the last commit() replace the served ones at the next
+        commit(), like snmp_passpersist.PassPersist """
+    def __init__(self, base, master=defaultMaster, description="sfa_check"):
+        self.base = parseOID(base)
+        self.master = master
+        self.description = description
+        self.pending = {}
+        self.view = MIBView({})
+        self.sock = None
+        self.sessionID = 0
+        self.packetID = 0
+        self.started = time.time()
+        self.error = None
+        self.lock = threading.Lock()
+    def add_int(self, oid, value, label=None):
+        self.pending[self.base + parseOID(oid)] = (INTEGER, int(value))
+    def add_str(self, oid, value, label=None):
+        self.pending[self.base + parseOID(oid)] = (OCTET_STRING, str(value))
+    def commit(self):
+        """ Serve the values added since the last commit. The view is swapped in one
+            assignment, so requests being answered see either the old or the new one """
+        self.view = MIBView(self.pending)
+        self.pending = {}
+    def uptime(self):
+        return int((time.time() - self.started) * 100) & 0xffffffff
+    def send(self, type, payload, transactionID=0, packetID=None):
+        if packetID is None:
+            self.packetID += 1
+            packetID = self.packetID
+        pdu = PDU(type, self.sessionID, transactionID, packetID, payload)
+        self.lock.acquire()
+        try:
+            self.sock.sendall(pdu.encode())
+        finally:
+            self.lock.release()
+        return packetID
+    def request(self, type, payload):
+        """ Send a PDU to the master and wait for its response. Used before serving starts """
+        packetID = self.send(type, payload)
+        while True:
+            pdu = receivePDU(self.sock)
+            if pdu.type == RESPONSE and pdu.packetID == packetID:
+                (sysUpTime, error, index) = struct.unpack_from(pdu.order + 'IHH', pdu.payload)
+                if error != NO_ERROR:
+                    raise AgentXError("master agent answered %s with error %d"%(type, error))
+                return pdu
+    def connect(self):
+        """ Open a session with the master and register the base subtree """
+        self.sock = connectMaster(self.master, 10)
+        order = '!'
+        response = self.request(OPEN, struct.pack(order + 'B3x', 0) + encodeOID((), order) + encodeOctets(self.description, order))
+        self.sessionID = response.sessionID
+        self.request(REGISTER, struct.pack(order + 'BBBx', 0, 127, 0) + encodeOID(self.base, order))
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.send(CLOSE, struct.pack('!B3x', REASON_SHUTDOWN))
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+    def respond(self, pdu, varBinds, error=NO_ERROR, index=0):
+        payload = struct.pack(pdu.order + 'IHH', self.uptime(), error, index)
+        payload += ''.join([ encodeVarBind(oid, type, value, pdu.order) for (oid, type, value) in varBinds ])
+        response = PDU(RESPONSE, pdu.sessionID, pdu.transactionID, pdu.packetID, payload, pdu.flags & NETWORK_BYTE_ORDER)
+        self.lock.acquire()
+        try:
+            self.sock.sendall(response.encode())
+        finally:
+            self.lock.release()
+    def getVarBinds(self, view, ranges):
+        varBinds = []
+        for (start, include, end) in ranges:
+            value = view.get(start)
+            if value is not None:
+                varBinds.append((start, value[0], value[1]))
+            elif start[:len(self.base)] == self.base:
+                varBinds.append((start, NO_SUCH_INSTANCE, None))
+            else:
+                varBinds.append((start, NO_SUCH_OBJECT, None))
+        return varBinds
+    def getNextVarBinds(self, view, ranges):
+        return [ view.varBind(view.nextIndex(start, include), start, end) for (start, include, end) in ranges ]
+    def getBulkVarBinds(self, view, nonRepeaters, maxRepetitions, ranges):
+        """ The non repeaters like a GETNEXT, then up to maxRepetitions rows of the
+            repeaters, walking the sorted OIDs from where each repeater started """
+        varBinds = self.getNextVarBinds(view, ranges[:nonRepeaters])
+        repeaters = ranges[nonRepeaters:]
+        indexes = [ view.nextIndex(start, include) for (start, include, end) in repeaters ]
+        for repetition in range(maxRepetitions):
+            row = [ view.varBind(index, start, end) for (index, (start, include, end)) in zip(indexes, repeaters) ]
+            varBinds.extend(row)
+            if not [ varBind for varBind in row if varBind[1] != END_OF_MIB_VIEW ]:
+                break
+            indexes = [ index + 1 for index in indexes ]
+        return varBinds
+    def handle(self, pdu):
+        """ Answer a PDU from the master """
+        view = self.view
+        if pdu.type == GET:
+            self.respond(pdu, self.getVarBinds(view, decodeSearchRanges(pdu.payload, 0, pdu.order)))
+        elif pdu.type == GETNEXT:
+            self.respond(pdu, self.getNextVarBinds(view, decodeSearchRanges(pdu.payload, 0, pdu.order)))
+        elif pdu.type == GETBULK:
+            (nonRepeaters, maxRepetitions) = struct.unpack_from(pdu.order + 'HH', pdu.payload)
+            ranges = decodeSearchRanges(pdu.payload, 4, pdu.order)
+            self.respond(pdu, self.getBulkVarBinds(view, nonRepeaters, maxRepetitions, ranges))
+        elif pdu.type == TESTSET:
+            self.respond(pdu, [], NOT_WRITABLE, 1)
+        elif pdu.type in (COMMITSET, UNDOSET):
+            self.respond(pdu, [], PROCESSING_ERROR, 1)
+        elif pdu.type == CLOSE:
+            raise AgentXError("session closed by the master agent")
+        # responses to our own PDUs and CleanupSet need no answer
+    def serve(self, timeout=None):
+        """ Answer the requests of the master for up to timeout seconds """
+        self.sock.settimeout(timeout)
+        try:
+            pdu = receivePDU(self.sock)
+        except socket.timeout:
+            return
+        finally:
+            self.sock.settimeout(None)
+        self.handle(pdu)
+    def updateLoop(self, update, refresh, stopped):
+        try:
+            while not stopped.isSet():
+                update()
+                if stopped.isSet():
+                    break
+                self.commit()
+                stopped.wait(refresh)
+        except Exception, err:
+            self.error = "%s: %s"%(err.__class__.__name__, err)
+    def start(self, update, refresh):
+        """ Call update and commit the values it added every refresh seconds in a thread,
+            and answer the master in this one. Returns if the updater dies, and raises
+            AgentXError or socket.error if the session with the master is lost. The
+            updater is stopped before start() returns or raises, so it can be called
+            again to reconnect """
+        self.connect()
+        stopped = threading.Event()
+        updater = threading.Thread(target=self.updateLoop, args=(update, refresh, stopped))
+        updater.daemon = True
+        try:
+            updater.start()
+            while updater.isAlive():
+                self.serve(1)
+        finally:
+            self.close()
+            # let the update in progress finish, so no two updaters share its state
+            stopped.set()
+            while updater.isAlive():
+                updater.join(1)
+
+class Master (object):
+    """ A minimal AgentX master agent, to test a Subagent without snmpd. It accepts a
+        single subagent and sends it Get, GetNext and GetBulk requests """
+    def __init__(self, address):
+        if ':' in address:
+            (host, port) = address.rsplit(':', 1)
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind((host, int(port)))
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(address)
+        self.listener.listen(1)
+        self.sock = None
+        self.sessionID = 0
+        self.packetID = 0
+        self.registered = []
+    def respond(self, pdu, error=NO_ERROR):
+        payload = struct.pack(pdu.order + 'IHH', 0, error, 0)
+        response = PDU(RESPONSE, pdu.sessionID, pdu.transactionID, pdu.packetID, payload, pdu.flags & NETWORK_BYTE_ORDER)
+        self.sock.sendall(response.encode())
+    def accept(self, timeout=None):
+        """ Wait for a subagent to open a session and register a subtree """
+        self.listener.settimeout(timeout)
+        (self.sock, address) = self.listener.accept()
+        self.sock.settimeout(timeout)
+        while not self.registered:
+            pdu = receivePDU(self.sock)
+            if pdu.type == OPEN:
+                self.sessionID += 1
+                pdu.sessionID = self.sessionID
+                self.respond(pdu)
+            elif pdu.type == REGISTER:
+                (subtree, include, offset) = decodeOID(pdu.payload, 4, pdu.order)
+                self.registered.append(subtree)
+                self.respond(pdu)
+            else:
+                self.respond(pdu, PROCESSING_ERROR)
+    def request(self, type, payload):
+        """ Send a request to the subagent and return the (error, index, varbinds) of its response """
+        self.packetID += 1
+        pdu = PDU(type, self.sessionID, self.packetID, self.packetID, payload)
+        self.sock.sendall(pdu.encode())
+        while True:
+            response = receivePDU(self.sock)
+            if response.type == RESPONSE and response.packetID == self.packetID:
+                break
+            if response.type == PING:
+                self.respond(response)
+        (sysUpTime, error, index) = struct.unpack_from(response.order + 'IHH', response.payload)
+        varBinds = []
+        offset = 8
+        while offset < len(response.payload):
+            (varBind, offset) = decodeVarBind(response.payload, offset, response.order)
+            varBinds.append(varBind)
+        return (error, index, varBinds)
+    def searchRanges(self, oids, include):
+        return ''.join([ encodeOID(parseOID(oid), '!', include) + encodeOID((), '!') for oid in oids ])
+    def get(self, oids):
+        return self.request(GET, self.searchRanges(oids, 0))[2]
+    def getNext(self, oids):
+        return self.request(GETNEXT, self.searchRanges(oids, 0))[2]
+    def getBulk(self, nonRepeaters, maxRepetitions, oids):
+        return self.request(GETBULK, struct.pack('!HH', nonRepeaters, maxRepetitions) + self.searchRanges(oids, 0))[2]
+    def walk(self, oid, maxRepetitions=50):
+        """ Yield the (oid, type, value) under oid, fetched with GETBULK """
+        root = parseOID(oid)
+        last = oid
+        while True:
+            varBinds = self.getBulk(0, maxRepetitions, [last])
+            for (name, type, value) in varBinds:
+                if type == END_OF_MIB_VIEW or name[:len(root)] != root:
+                    return
+                yield (name, type, value)
+            if not varBinds:
+                return
+            last = formatOID(varBinds[-1][0])
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.listener.close()
+
+def main():
+    parser = ArgumentParser(description="Minimal AgentX master agent: wait for a subagent and walk its tree with GETBULK")
+    parser.add_argument('--listen', help="Unix socket path or host:port to listen on (default %s)"%defaultMaster, default=defaultMaster)
+    parser.add_argument('--oid', help="OID to walk (default: the subtree the subagent registers)")
+    parser.add_argument('-r', '--max-repetitions', type=int, default=50, help="max-repetitions of each GETBULK (default 50)")
+    parser.add_argument('-i', '--interval', type=float, default=0, help="walk again every INTERVAL seconds (default once)")
+    parser.add_argument('-t', '--timeout', type=float, default=60, help="seconds to wait for the subagent (default 60)")
+    args = parser.parse_args()
+
+    master = Master(args.listen)
+    master.accept(args.timeout)
+    oid = args.oid or formatOID(master.registered[0])
+    try:
+        while True:
+            start = time.time()
+            count = 0
+            for (name, type, value) in master.walk(oid, args.max_repetitions):
+                print "%s = %s"%(formatOID(name), value)
+                count += 1
+            sys.stderr.write("%d values in %.3fs\n"%(count, time.time() - start))
+            if not args.interval:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    master.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
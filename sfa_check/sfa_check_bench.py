@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+sfa_check_bench.py
+
+Benchmarks sfa_check.py against the offline simulator in sfa_check_sim.py.
+call_API is timed in this process for a single subsystem of each size, and
+sfaAPICheck for each number of couplets, reporting wall time, API calls per
+class, peak RSS and throughput. --checks, --records and --history benchmark the
+checks, the component records and the history file alone instead.
+"""
+
+import os
+# must be set before sfa_check is imported
+os.environ['SFA_CHECK_SIMULATOR'] = '1'
+
+import sys
+import time
+import resource
+import pickle
+from argparse import ArgumentParser
+import sfa_check_sim as sim
+import sfa_check as sfaCheck
+
+def intList(string):
+    return [ int(i) for i in string.split(',') ]
+
+def peakRSS():
+    """ Peak resident set size in KB of this process and of its largest child """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def simConfig(couplets):
+    """ A Config like readConfig() returns for the given number of simulated
+        couplets. The controllers are addresses on the loopback network, so they
+        resolve without DNS and never collide with a real array """
+    config = sfaCheck.Config()
+    for idx in range(couplets):
+        sub = "127.77.%d.%d,127.77.%d.%d"%(idx / 100,(idx % 100) * 2 + 1,idx / 100,(idx % 100) * 2 + 2)
+        config.add(sfaCheck.SubsystemConfig(str(idx),sub,True,('user','password'),{}))
+    return config
+
+def benchCallAPI(disks,repeat,modules,checkConcurrency):
+    """ Time call_API against a single simulated subsystem """
+    sim.configure(disks=disks)
+    controller = sfaCheck.prepareWorkers(simConfig(1),modules,False,True)[0].controller
+
+    sim.resetCalls()
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        run = dict(controller)
+        if sfaCheck.stateStore is not None:
+            # as the APIworkerPool does around each check
+            sfaCheck.stateStore.prepare(run)
+        (ret_str,rc) = sfaCheck.call_API(run,modules,False,True,checkConcurrency)
+        if sfaCheck.stateStore is not None:
+            sfaCheck.stateStore.update(run['result'])
+        times.append(time.time() - start)
+    calls = dict(sim.calls)
+
+    best = min(times)
+    print "call_API: %d disks, rc %d, best %.4fs, mean %.4fs over %d runs, %.0f disks/s"%(
+        disks,rc,best,sum(times) / len(times),repeat,disks / best if best > 0 else 0)
+    print "  API calls per class per run: %s"%', '.join([ "%s %d"%(name,calls[name] / repeat) for name in sorted(calls) ])
+    print "  output: %s"%ret_str[:200]
+
+def benchAPICheck(couplets,disks,nprocs,modules,checkConcurrency):
+    """ Time sfaAPICheck over a number of simulated couplets """
+    sim.configure(disks=disks)
+    config = simConfig(couplets)
+    start = time.time()
+    results = sfaCheck.sfaAPICheck(config,modules,False,True,nprocs,checkConcurrency)
+    wall = time.time() - start
+
+    counts = {}
+    # the API calls are made in the worker processes, so they are taken from the
+    # api_stats of the results instead of sim.calls
+    fetches = {}
+    for result in results:
+        (sub_name,ret_str,rc) = result
+        counts[rc] = counts.get(rc,0) + 1
+        if result.result:
+            for (name,classFetches,requests,numObjects,seconds) in result.result.get('api_stats',[]):
+                fetches[name] = fetches.get(name,0) + classFetches
+    (selfRSS,childRSS) = peakRSS()
+    print "sfaAPICheck: %d couplets x %d disks, %d procs: %.3fs, %.1f subsystems/s, %.0f disks/s, rc counts %s, peak RSS %d KB (worker %d KB)"%(
+        couplets,disks,nprocs,wall,couplets / wall,couplets * disks / wall,
+        ','.join([ "%d:%d"%(rc,counts[rc]) for rc in sorted(counts) ]),selfRSS,childRSS)
+    print "  API calls per class per subsystem: %s"%', '.join([ "%s %.1f"%(name,float(fetches[name]) / couplets) for name in sorted(fetches) ])
+
+def benchChecks(objects,disks,repeat,modules):
+    """ Time the doCheck() of each check alone against the cached objects of a simulated
+        subsystem with disks disks and enough enclosures for about objects enclosure components """
+    # 24 components per simulated enclosure
+    sim.configure(enclosures=max(objects / 24,1),disks=disks)
+    controller = sfaCheck.prepareWorkers(simConfig(1),modules,False,True)[0].controller
+    thisSFA = sfaCheck.SFASystem(controller)
+    sim.APIConnect(controller['ip'])
+    checks = sfaCheck.checkList(thisSFA,modules,False,False).checks
+    for check in checks:
+        for SFAClass in check.SFAClasses:
+            thisSFA.snapshot.getAll(SFAClass)
+
+    total = 0.0
+    for check in checks:
+        numObjects = sum([ len(thisSFA.snapshot.objects[SFAClass.__name__]) for SFAClass in check.SFAClasses ])
+        times = []
+        for i in range(repeat):
+            # a fresh check each run, the cached objects are shared
+            check = check.__class__(thisSFA,False,False)
+            start = time.time()
+            check.doCheck()
+            times.append(time.time() - start)
+        best = min(times)
+        total += best
+        print "doCheck %s: %d objects, best %.6fs, %.0f objects/s"%(
+            check.description,numObjects,best,numObjects / best if best > 0 else 0)
+    print "doCheck total: %.6fs"%total
+    sim.APIDisconnect()
+
+def objectSize(object):
+    """ Bytes of an object and of its attribute dict, not counting the values """
+    size = sys.getsizeof(object)
+    if hasattr(object,'__dict__'):
+        size += sys.getsizeof(object.__dict__)
+    return size
+
+def benchRecords(disks,repeat):
+    """ Compare the memory, pickled size and conversion time of the API objects of the
+        classes in stateAttributes with their ComponentRecords """
+    sim.configure(disks=disks)
+    controller = sfaCheck.prepareWorkers(simConfig(1),sfaCheck.implementedModules,False,True)[0].controller
+    sim.APIConnect(controller['ip'])
+    objects = []
+    records = []
+    convert = 0.0
+    for name in sorted(sfaCheck.stateAttributes):
+        classObjects = getattr(sim,name).getAll()
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            classRecords = sfaCheck.toRecords(name,classObjects)
+            times.append(time.time() - start)
+        convert += min(times)
+        objects.extend(classObjects)
+        records.extend(classRecords)
+    sim.APIDisconnect()
+
+    perThousand = 1000.0 / len(objects)
+    print "records: %d disks, %d components, converted in %.6fs, %.0f components/s"%(
+        disks,len(objects),convert,len(objects) / convert if convert > 0 else 0)
+    print "  memory per 1000 components: objects %.0f KB, records %.0f KB"%(
+        sum(map(objectSize,objects)) * perThousand / 1024,sum(map(objectSize,records)) * perThousand / 1024)
+    print "  pickled per 1000 components: objects %.0f KB, records %.0f KB"%(
+        len(pickle.dumps(objects,2)) * perThousand / 1024,len(pickle.dumps(records,2)) * perThousand / 1024)
+
+def benchHistory(series,runs,path):
+    """ Time writing, reading and querying a history of runs samples of series counters """
+    if os.path.exists(path):
+        os.remove(path)
+    history = sfaCheck.HistoryStore(runs * 300)
+    history.load(path)
+    now = int(time.time()) - runs * 300
+    metrics = [ ('icl_channel_errors_total',{ 'index': idx, 'counter': 'SymbolErrors' },0) for idx in range(series) ]
+    start = time.time()
+    for run in range(runs):
+        metrics = [ (name,labels,value + (run % 7 == 0)) for (name,labels,value) in metrics ]
+        history.record('127.77.0.1,127.77.0.2',metrics,now + run * 300)
+    write = time.time() - start
+    history.close()
+    size = os.path.getsize(path)
+
+    start = time.time()
+    history = sfaCheck.HistoryStore(runs * 300)
+    history.load(path)
+    load = time.time() - start
+    keys = history.find('127.77.0.1,127.77.0.2','icl_channel_errors_total')
+    start = time.time()
+    for key in keys:
+        history.rate(key,3600,now + runs * 300)
+    rate = time.time() - start
+    history.close()
+    os.remove(path)
+    print "history: %d series x %d runs, %.0f samples/s written, %.2f bytes/sample, loaded in %.3fs, %.0f rate queries/s"%(
+        series,runs,series * runs / write,float(size) / (series * runs),load,len(keys) / rate if rate > 0 else 0)
+
+def main():
+    parser = ArgumentParser(description='Benchmark sfa_check against the offline SFA API simulator')
+    parser.add_argument('--couplets',type=intList,default=[1,10,100],help='comma-separated numbers of subsystems to check with sfaAPICheck (default 1,10,100)')
+    parser.add_argument('--disks',type=intList,default=[60,600,2000],help='comma-separated numbers of disks per subsystem (default 60,600,2000)')
+    parser.add_argument('-n','--nprocs',type=int,default=8,help='worker processes for sfaAPICheck (default 8)')
+    parser.add_argument('-r','--repeat',type=int,default=5,help='runs of call_API per size (default 5)')
+    parser.add_argument('-m','--modules',default=','.join(sfaCheck.implementedModules),help='comma-separated modules to run (default all)')
+    parser.add_argument('--check-concurrency',type=int,default=1,help='API fetches in flight per subsystem (default 1)')
+    parser.add_argument('--latency',type=float,default=0,help='simulated seconds per API call (default 0)')
+    parser.add_argument('--object-latency',type=float,default=0,help='simulated seconds per object returned (default 0)')
+    parser.add_argument('--history',type=intList,default=None,metavar='SERIES,RUNS',help='benchmark a history file of SERIES counters over RUNS runs instead')
+    parser.add_argument('--checks',type=int,default=None,metavar='OBJECTS',help='time the doCheck() of each module against about OBJECTS enclosure components and each number of disks instead')
+    parser.add_argument('--records',action='store_true',default=False,help='compare the memory and pickled size of the API objects with their records instead')
+    parser.add_argument('--fault-rate',type=float,default=0,help='probability that a simulated component is faulted (default 0)')
+    parser.add_argument('--state-store',action='store_true',default=False,help='skip the checks of unchanged components in repeated call_API runs')
+    args = parser.parse_args()
+
+    modules = args.modules.split(',')
+    if sfaCheck.verifyModules(modules):
+        sys.exit(1)
+
+    if args.history:
+        benchHistory(args.history[0],args.history[1],'/tmp/sfa_check_bench_history.%d'%os.getpid())
+        return
+
+    sim.configure(latency=args.latency,object_latency=args.object_latency,fault_rate=args.fault_rate)
+    if args.records:
+        for disks in args.disks:
+            benchRecords(disks,args.repeat)
+        return
+    if args.checks:
+        for disks in args.disks:
+            benchChecks(args.checks,disks,args.repeat,modules)
+        return
+    if args.state_store:
+        sfaCheck.stateStore = sfaCheck.ComponentStateStore()
+
+    for disks in args.disks:
+        benchCallAPI(disks,args.repeat,modules,args.check_concurrency)
+    for couplets in args.couplets:
+        for disks in args.disks:
+            benchAPICheck(couplets,disks,args.nprocs,modules,args.check_concurrency)
+
+if __name__ == "__main__":
+    main()
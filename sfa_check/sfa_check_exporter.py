@@ -0,0 +1,245 @@
+#!/usr/bin/python -u
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+  sfa_check_exporter.py
+
+  Checks the subsystems in the configuration file every interval and serves the
+  latest results on an HTTP /metrics endpoint in the Prometheus text format.
+  Scrapes are answered from the cached results and never call the API.
+"""
+
+import sfa_check as sfaCheck
+from argparse import ArgumentParser, ArgumentError
+import BaseHTTPServer
+import SocketServer
+import threading
+import syslog, sys, time, signal
+
+# General stuff
+POLLING_INTERVAL=300	# Interval between checks of all subsystems, in second
+LISTEN_PORT=9341	# Port the /metrics endpoint is served on
+NPROCS=8	# Max number of subsystems checked at the same time
+MAX_WORKERS=64	# Max number of worker processes (and API sessions) kept between rounds
+SESSION_IDLE=900	# Seconds an unused API session is kept open
+LAST_GOOD_FILE="/var/tmp/sfa_check_last_good"	# Controller of each subsystem that last answered
+HISTORY_FILE="/var/tmp/sfa_check_exporter_history"	# Component values of each check, see sfaCheck.HistoryStore
+PREFIX="sfa_check_"
+
+# (type, help) of the component values recorded by the checks with APICheck.recordMetric()
+componentMetrics = { 'disk_channel_speed': ('gauge','Current speed of the disk channel in Gb/s'),
+                     'disk_channel_width': ('gauge','Current width of the disk channel'),
+                     'disk_channel_expected_width': ('gauge','Expected width of the disk channel'),
+                     'host_channel_speed': ('gauge','Speed of the host channel'),
+                     'icl_channel_speed': ('gauge','Current speed of the ICL channel'),
+                     'icl_channel_width': ('gauge','Current width of the Infiniband ICL channel'),
+                     'icl_channel_errors_total': ('counter','Error statistic counters of the ICL channel'),
+                     'pool_bad_blocks': ('gauge','Bad block count of the storage pool'),
+                     'virtual_disk_bad_blocks': ('gauge','Bad block count of the virtual disk'),
+                     'enclosure_disks': ('gauge','Disk drives in the enclosure'),
+                     'enclosure_faulted_disks': ('gauge','Disk drives in the enclosure reported by the disk check') }
+
+class MetricsCache (object):
+    """ The latest result of each subsystem and the /metrics page rendered from them.
+        The page is rendered when a result arrives, so a scrape only copies a string """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.completed = {}
+        self.stateChanges = {}
+        self.rounds = 0
+        self.roundSeconds = 0.0
+        self.page = ''
+    def update(self, result):
+        self.lock.acquire()
+        try:
+            self.results[result[0]] = result
+            self.completed[result[0]] = time.time()
+            if result.result:
+                self.stateChanges[result[0]] = self.stateChanges.get(result[0],0) + len(result.result.get('events',[]))
+            self.render()
+        finally:
+            self.lock.release()
+    def endRound(self, subsystems, seconds):
+        """ Count a finished round and drop the subsystems no longer configured """
+        self.lock.acquire()
+        try:
+            for sub in self.results.keys():
+                if not sub in subsystems:
+                    del self.results[sub]
+                    del self.completed[sub]
+                    self.stateChanges.pop(sub,None)
+                    if sfaCheck.stateStore is not None:
+                        sfaCheck.stateStore.forget(sub)
+            self.rounds += 1
+            self.roundSeconds = seconds
+            self.render()
+        finally:
+            self.lock.release()
+    def getPage(self):
+        self.lock.acquire()
+        try:
+            return self.page
+        finally:
+            self.lock.release()
+    def render(self):
+        """ Render the page from the cached results. Called with the lock held """
+        families = {}
+        def add(name, type, help, labels, value):
+            if not name in families:
+                families[name] = (type, help, [])
+            families[name][2].append((labels, value))
+
+        for sub in sorted(self.results):
+            result = self.results[sub]
+            rc = result[2]
+            add('status','gauge','Return code of the last check of the subsystem (0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN)',{'subsystem': sub},rc)
+            add('last_check_timestamp_seconds','gauge','Time the last check of the subsystem completed',{'subsystem': sub},self.completed[sub])
+            add('state_changes_total','counter','Component state changes seen in the subsystem',{'subsystem': sub},self.stateChanges.get(sub,0))
+            if result.timing:
+                add('check_duration_seconds','gauge','Wall time of the last check of the subsystem',{'subsystem': sub},result.timing['wall'])
+                add('api_wait_seconds','gauge','Time the last check of the subsystem waited for the API',{'subsystem': sub},result.timing['api_wait'])
+                add('api_fetches','gauge','API fetches made by the last check of the subsystem',{'subsystem': sub},result.timing['api_fetches'])
+            for check in result.checks or []:
+                labels = {'subsystem': sub, 'check': check['name']}
+                add('check_status','gauge','Return code of a check module in the last check of the subsystem',labels,check['rc'])
+                for severity in ('WARNING','CRITICAL','UNKNOWN'):
+                    faultLabels = dict(labels)
+                    faultLabels['severity'] = severity.lower()
+                    add('check_faults','gauge','Number of faults found by a check module, by severity',faultLabels,check['numChecks' + severity])
+            for (name, labels, value) in result.metrics or []:
+                (type, help) = componentMetrics.get(name, ('gauge','Component value read by sfa_check'))
+                labels = dict(labels)
+                labels['subsystem'] = sub
+                add(name,type,help,labels,value)
+        add('rounds_total','counter','Completed rounds of checks of all subsystems',{},self.rounds)
+        add('round_duration_seconds','gauge','Wall time of the last completed round of checks',{},self.roundSeconds)
+
+        lines = []
+        for name in sorted(families):
+            (type, help, samples) = families[name]
+            lines.append("# HELP %s%s %s"%(PREFIX,name,help))
+            lines.append("# TYPE %s%s %s"%(PREFIX,name,type))
+            for (labels, value) in samples:
+                lines.append("%s%s%s %s"%(PREFIX,name,formatLabels(labels),formatValue(value)))
+        self.page = "\n".join(lines) + "\n"
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key in sorted(labels):
+        value = str(labels[key]).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+        pairs.append('%s="%s"'%(key,value))
+    return '{' + ','.join(pairs) + '}'
+
+def formatValue(value):
+    if isinstance(value, bool):
+        return str(int(value))
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class MetricsHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serves the cached page on /metrics """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        page = self.server.cache.getPage()
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4')
+        self.send_header('Content-Length',str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+    def log_message(self, format, *args):
+        # scrapes are too frequent to log
+        pass
+
+class MetricsServer (SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def checkLoop(cache, config_file, interval, nprocs, pool):
+    """ Check all configured subsystems every interval seconds, caching each result as
+        soon as it arrives """
+    modules = sfaCheck.implementedModules
+    while True:
+        start_time = time.time()
+        config = sfaCheck.readConfig(config_file)
+        try:
+            for result in sfaCheck.sfaAPICheckStream(config,modules,False,True,nprocs,pool=pool):
+                cache.update(result)
+                if sfaCheck.history is not None and result.metrics:
+                    sfaCheck.history.record(result[0],result.metrics)
+        except Exception, err:
+            syslog.syslog(syslog.LOG_WARNING,"Round of checks failed: %s: %s"%(err.__class__.__name__, err))
+        cache.endRound(config.bySubName, time.time() - start_time)
+        time.sleep(max(interval - (time.time() - start_time), 0))
+
+def main():
+    parser = ArgumentParser(description="Serve sfa_check results as Prometheus metrics")
+    parser.add_argument('-c', '--config', help="Path to configuration file", default=sfaCheck.defaultConfig)
+    parser.add_argument('-a', '--address', help="Address to listen on (default all)", default='')
+    parser.add_argument('-p', '--port', help="Port to serve /metrics on", type=int, default=LISTEN_PORT)
+    parser.add_argument('-i', '--interval', help="Seconds between rounds of checks", type=int, default=POLLING_INTERVAL)
+    parser.add_argument('-n', '--nprocs', help="Max number of subsystems checked at the same time", type=int, default=NPROCS)
+    parser.add_argument('--history', metavar='FILE', help="History file of the component values, '' to keep none", default=HISTORY_FILE)
+    parser.add_argument('--history-retention', metavar='DAYS', help="Days the values in the history file are kept", type=float, default=sfaCheck.defaultHistoryRetention / 86400)
+    try:
+        args = parser.parse_args()
+    except ArgumentError:
+        parser.print_help()
+        return 1
+
+    syslog.openlog(sys.argv[0],syslog.LOG_PID)
+    sfaCheck.lastGood.load(LAST_GOOD_FILE)
+    # skip the checks of unchanged components and report state changes
+    sfaCheck.stateStore = sfaCheck.ComponentStateStore()
+    if args.history:
+        sfaCheck.history = sfaCheck.HistoryStore(int(args.history_retention * 86400))
+        sfaCheck.history.load(args.history)
+
+    # the configuration is read again when it changes, or on SIGHUP
+    signal.signal(signal.SIGHUP, lambda signum, frame: sfaCheck.getConfigFile(args.config).reload())
+    # without interrupting the reads in progress
+    signal.siginterrupt(signal.SIGHUP, False)
+
+    cache = MetricsCache()
+    cache.render()
+    server = MetricsServer((args.address, args.port), MetricsHandler)
+    server.cache = cache
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+    syslog.syslog(syslog.LOG_INFO,"Serving sfa_check metrics on port %d"%args.port)
+
+    pool = sfaCheck.APIworkerPool(args.nprocs,MAX_WORKERS,SESSION_IDLE)
+    try:
+        checkLoop(cache, args.config, args.interval, args.nprocs, pool)
+    except KeyboardInterrupt:
+        pass
+    pool.close()
+    server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,156 +22,231 @@
 
 """
   sfa_api_check_pp_daemon.py
+
+  Started by snmpd as a pass_persist script, or with --agentx as an AgentX subagent
+  of a running snmpd (see sfa_check_agentx.py)
 """
 
-import snmp_passpersist as snmp
+try:
+    import snmp_passpersist as snmp
+except ImportError:
+    snmp = None
 import sfa_check as sfaCheck
-import syslog, sys, time, errno, re, socket, os
+import sfa_check_agentx as agentx
+from argparse import ArgumentParser
+import syslog, sys, time, errno, socket, os, signal
 
 # General stuff
-POLLING_INTERVAL=300	# Update timer, in second
+POLLING_INTERVAL=300	# Default interval between checks of a subsystem, in second
+UPDATE_TICK=5	# Interval between scheduler passes and publishing of results, in second
 MAX_RETRY=10	# Number of successive retries in case of error
 OID_BASE=".1.3.6.1.4.1.341.49.1"
+NPROCS=8	# Max number of subsystems checked at the same time
+MAX_WORKERS=64	# Max number of worker processes (and API sessions) kept between updates
+SESSION_IDLE=900	# Seconds an unused API session is kept open
+LAST_GOOD_FILE="/var/tmp/sfa_check_last_good"	# Controller of each subsystem that last answered
+HISTORY_FILE="/var/tmp/sfa_check_history"	# Component values of each check, see sfaCheck.HistoryStore
+HISTORY_RETENTION=7*86400	# Seconds the component values are kept in HISTORY_FILE
 
 # Global vars
 pp = None
+pool = None
+# subsystem -> time its next check is due
+next_run = {}
+# task id in the pool -> subsystem being checked
+in_flight = {}
+# controller -> last result, as { 'rc', 'output', 'time', 'timing' }, published with every commit
+table = {}
+# controller -> its OIDs, see controllerOIDs()
+oid_index = {}
 config_file = "/usr/local/etc/sfa_check.conf"
 
-def getSNMPstr(snmp_str):
-    ret_str = None
-   
-    if snmp_str == "NONE":
-        return None
-    s = re.search(".*STRING\\n(.*)",snmp_str)
-    if s:
-        ret_str=s.group(1)
+def getOID(string):
+    result=".".join([ str(ord(s)) for s in string ])
+    return "%s." % (len(string)) + result
 
-    return ret_str
+def controllerOIDs(con_name):
+    """ The OIDs of the return code, output and timestamp of a controller and the prefix
+        of its timing tree, computed once per controller. The timing is kept under .0,
+        out of the walk of the results in check_snmp_sfa.py --all """
+    global oid_index
 
-def getSNMPint(snmp_int):
+    if not con_name in oid_index:
+        oid = getOID(con_name)
+        oid_index[con_name] = ('0.' + oid, oid + '.1', oid + '.2', oid + '.3')
+    return oid_index[con_name]
 
-    ret_int = -1
-   
-    if snmp_int == "NONE":
-        return None
-    s = re.search(".*INTEGER\\n(\d+)",snmp_int)
-    if s:
-        try:
-            ret_int=int(s.group(1))
-        except TypeError:
-            ret_int = -1
+def publishController(con_name,entry,timeout,now):
+    """ Add the last result of a controller from the table to the next commit, marking
+        it as timed out if it is older than timeout seconds """
+    global pp
 
-    return ret_int
+    (timing_oid,rc_oid,output_oid,time_oid) = controllerOIDs(con_name)
+    rc = entry['rc']
+    output = entry['output']
+    if now > entry['time'] + timeout:
+        # it is an old entry
+        if rc == sfaCheck.NagiosStatus.OK:
+            # upgrade from OK to WARNING since there was a timeout
+            rc = sfaCheck.NagiosStatus.WARNING
+        output = "TIMED OUT. Last state: " + output
+
+    # every commit replaces all published values, so add them again
+    pp.add_int(rc_oid,rc)
+    pp.add_str(output_oid,output)
+    pp.add_str(time_oid,entry['time'])
+    if entry['timing']:
+        publishTiming(timing_oid,entry['timing'])
+
+def addTiming(oid,timing):
+    """ Add the wall time, API wait and evaluation time (in milliseconds), getAll() calls,
+        API fetches and objects of a check as consecutive integers under oid """
+    global pp
 
-def getOID(string):
-    result=".".join([ str(ord(s)) for s in string ])
-    return "%s." % (len(string)) + result
+    pp.add_int(oid + '.1',int(timing['wall'] * 1000))
+    pp.add_int(oid + '.2',int(timing['api_wait'] * 1000))
+    pp.add_int(oid + '.3',int(timing['eval'] * 1000))
+    pp.add_int(oid + '.4',timing['getall_calls'])
+    pp.add_int(oid + '.5',timing['api_fetches'])
+    pp.add_int(oid + '.6',timing['objects'])
 
-def checkForOldData(oid,timeout):
+def publishTiming(oid,timing):
+    """ Place the timing of the last check of a controller under its timing oid:
+        .1 the subsystem totals and .2.<n> the name (.2.<n>.0) and timing of each check """
     global pp
 
-    old_time_str = pp.get(oid + '.3')
-    old_time = getSNMPstr(old_time_str)
-    if old_time:
-        old_time = int(old_time)
-    else:
-        # if there is not a valid old_time, then we can't tell what we're looking at
-        # moving on...
-        return 0
+    addTiming(oid + '.1',timing)
+    for n,check_timing in enumerate(timing['checks']):
+        check_oid = "%s.2.%d"%(oid,n + 1)
+        pp.add_str(check_oid + '.0',check_timing['name'])
+        addTiming(check_oid,check_timing)
 
-    current_time = int(time.time())
-    if current_time > (old_time + timeout):
-        # it is an old entry
-        # get the return code first
-        old_rc_str = pp.get(oid + '.1')
-        # strip off the junk at the beginning and return an integer
-        old_rc = getSNMPint(old_rc_str)
-        print old_rc
-        if old_rc < 0:
-            # if rc could not be parsed from snmp string, status should be UNKNOWN (rc=3)
-            old_rc = 3
-        elif old_rc == 0:
-            # upgrade from OK to WARNING since there was a timeout
-            pp.add_int(oid + '.1',1)
-
-        # get the return string
-        old_str = pp.get(oid + '.2')
-        old_str = getSNMPstr(old_str)
-        # handle case if returned None
-        if not old_str:
-            old_str = "No string at this OID"
-            old_rc = 3
-
-        # Preserve the last state
-        if re.search("TIMED OUT",old_str):
-            m = re.search(".*state: (.*)",old_str)
-            if m:
-                old_str = m.group(1)
-            else:
-                old_str = ''
-        new_str = "TIMED OUT. Last state: " + old_str
-        pp.add_str(oid + '.2',new_str)
+def publish(sub_name,sub_rc,sub_ret_str,timing=None):
+    """ Store the result of a subsystem in the table under both its controllers """
+    global table
 
-    return 0
+    now = int(time.time())
+    for con_name in sub_name.split(","):
+        table[con_name] = { 'rc': sub_rc, 'output': sub_ret_str, 'time': now, 'timing': timing }
 
 def update_data():
-    """ Runs periodically and spawns APICheck threads """
+    """ Runs every UPDATE_TICK seconds. Hands the checks of the subsystems that are
+        due to the persistent worker pool and publishes the results that completed """
     global pp
+    global pool
+    global next_run
+    global in_flight
+    global table
 
     global config_file
 
-
-    # set to warning if socket times out
-    rc = sfaCheck.NagiosStatus.WARNING
-
     config = sfaCheck.readConfig(config_file)
   
-    fudge = 5
-    timeout = POLLING_INTERVAL + fudge
+    # forget the schedule and state of the subsystems removed from the configuration
+    for sub in next_run.keys():
+        if not sub in config.bySubName:
+            del next_run[sub]
+            if sfaCheck.stateStore is not None:
+                sfaCheck.stateStore.forget(sub)
 
-    for oid,sub,production,auth in config:
-        con_to_check = sub.split(",")[0]
-        oid_prefix = getOID(con_to_check)
-        checkForOldData(oid_prefix,timeout)
-      
     # this is a Nagios check, so behave as such
     verbose=False
     nagiosMode=True
     modules=sfaCheck.implementedModules
-    nprocs=8
-
-    # run the check and place the results in a list
-    results = sfaCheck.sfaAPICheck(config,modules,verbose,nagiosMode,nprocs)
-
-    # step through each result
-    for sub_name,sub_ret_str,sub_rc in results:
-        # place the result under oids trees for both controllers in subsystem
-        for con_name in sub_name.split(","):
-            #get the oid
-            my_oid = getOID(con_name)
-
-            # add the results within the correct portion of the mib
-            pp.add_int(my_oid + '.1',sub_rc)
-            pp.add_str(my_oid + '.2',sub_ret_str)
-            pp.add_str(my_oid + '.3',int(time.time()))
+
+    # the worker processes and their API sessions live as long as the daemon
+    if pool is None:
+        pool = sfaCheck.APIworkerPool(NPROCS,MAX_WORKERS,SESSION_IDLE)
+
+    now = time.time()
+    for idx,sub_config in enumerate(config):
+        (oid,sub,production,auth,options) = sub_config
+        interval = options.get('interval',POLLING_INTERVAL)
+        if not sub in next_run:
+            # spread the first checks of the subsystems evenly over their interval
+            next_run[sub] = now + (interval * idx) / len(config)
+        if now < next_run[sub] or sub in in_flight.values():
+            continue
+        next_run[sub] = now + interval
+
+        workers = sfaCheck.prepareWorkers([sub_config],modules,verbose,nagiosMode)
+        if not workers:
+            publish(sub,sfaCheck.NagiosStatus.UNKNOWN,"%s: UNKNOWN: Could not resolve controllers"%sub.split(",")[0])
+            continue
+        in_flight[pool.submit(workers[0])] = sub
+
+    # collect the checks that completed since the last pass without blocking
+    for (taskId,result) in pool.poll(0):
+        (sub_name,sub_ret_str,sub_rc) = result
+        if taskId in in_flight:
+            del in_flight[taskId]
+        publish(sub_name,sub_rc,sub_ret_str,result.timing)
+        if result.result:
+            for event in result.result.get('events',[]):
+                syslog.syslog(syslog.LOG_NOTICE,"%s: %s"%(sub_name,event['description']))
+        if sfaCheck.history is not None and result.metrics:
+            sfaCheck.history.record(sub_name,result.metrics)
+
+    # publish the table, marking the results that are overdue
+    fudge = 5
+    now = int(time.time())
+    for oid,sub,production,auth,options in config:
+        timeout = options.get('interval',POLLING_INTERVAL) + options.get('timeout',sfaCheck.defaultTimeout) + fudge
+        for con_name in sub.split(","):
+            if con_name in table:
+                publishController(con_name,table[con_name],timeout,now)
+    for con_name in table.keys():
+        if not con_name in config.byController:
+            del table[con_name]
     
     return 0
 
 def main():
   global pp
 
+  parser = ArgumentParser(description="Serve sfa_check results to snmpd")
+  parser.add_argument('--agentx', metavar='ADDRESS', nargs='?', const=agentx.defaultMaster,
+                      help="Run as an AgentX subagent of the master agent at ADDRESS, a unix socket or host:port (default %s) instead of a pass_persist script"%agentx.defaultMaster)
+  args = parser.parse_args()
+
   syslog.openlog(sys.argv[0],syslog.LOG_PID)
+  if not args.agentx and snmp is None:
+    syslog.syslog(syslog.LOG_ERR,"The snmp_passpersist module is needed without --agentx, aborting...")
+    sys.exit(1)
+
+  # the component values of the checks are kept across restarts
+  try:
+    sfaCheck.history = sfaCheck.HistoryStore(HISTORY_RETENTION)
+    sfaCheck.history.load(HISTORY_FILE)
+  except Exception, e:
+    syslog.syslog(syslog.LOG_WARNING,"Not keeping history in %s: %s: %s" % (HISTORY_FILE, e.__class__.__name__, e))
+    sfaCheck.history = None
+
+  # the configuration is read again when it changes, or on SIGHUP
+  signal.signal(signal.SIGHUP, lambda signum, frame: sfaCheck.getConfigFile(config_file).reload())
+  # without interrupting the reads in progress
+  signal.siginterrupt(signal.SIGHUP, False)
+
+  # skip the checks of unchanged components and report state changes. Kept across
+  # restarts of the subagent, like the worker pool
+  sfaCheck.stateStore = sfaCheck.ComponentStateStore()
 
   retry_timestamp=int(time.time())
   retry_counter=MAX_RETRY
   while retry_counter>0:
     try:
-      syslog.syslog(syslog.LOG_INFO,"Starting sfa_checkd pass_persist daemon...")
-
       # Load helpers
-      pp=snmp.PassPersist(OID_BASE)
+      if args.agentx:
+        syslog.syslog(syslog.LOG_INFO,"Starting sfa_checkd AgentX subagent of %s..." % args.agentx)
+        pp=agentx.Subagent(OID_BASE,args.agentx)
+      else:
+        syslog.syslog(syslog.LOG_INFO,"Starting sfa_checkd pass_persist daemon...")
+        pp=snmp.PassPersist(OID_BASE)
+
+      # try the controllers that answered before the restart first
+      sfaCheck.lastGood.load(LAST_GOOD_FILE)
 
-      pp.start(update_data,POLLING_INTERVAL) # Should'nt return (except if updater thread has died)
+      pp.start(update_data,UPDATE_TICK) # Should'nt return (except if updater thread has died)
 
     except KeyboardInterrupt:
       print "Exiting on user request."
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+sfa_check_sim.py
+
+An offline stand-in for the parts of the DDN SFA API (ddn.sfa.api) used by
+sfa_check.py. It generates a synthetic subsystem for every host that is
+connected to, with a configurable size, fault rate and API latency, so the
+checks can be run and measured without a real array.
+
+sfa_check.py imports this module instead of ddn.sfa.api when the
+SFA_CHECK_SIMULATOR environment variable is set. The simulated arrays can be
+sized with these environment variables, or with configure():
+
+  SFA_SIM_DISKS             disk drives per subsystem (default 600)
+  SFA_SIM_ENCLOSURES        disk enclosures per subsystem (default 10)
+  SFA_SIM_FAULT_RATE        probability that a component is faulted (default 0)
+  SFA_SIM_LATENCY           seconds added to every API call (default 0)
+  SFA_SIM_OBJECT_LATENCY    seconds added per object returned (default 0)
+  SFA_SIM_DOWN              comma-separated hosts that refuse connections
+  SFA_SIM_SEED              seed for the generated arrays (default 0)
+
+The same host and settings always produce the same array.
+"""
+
+import os
+import time
+import socket
+import errno
+import random
+
+settings = { 'disks': int(os.environ.get('SFA_SIM_DISKS',600)),
+             'enclosures': int(os.environ.get('SFA_SIM_ENCLOSURES',10)),
+             'fault_rate': float(os.environ.get('SFA_SIM_FAULT_RATE',0)),
+             'latency': float(os.environ.get('SFA_SIM_LATENCY',0)),
+             'object_latency': float(os.environ.get('SFA_SIM_OBJECT_LATENCY',0)),
+             'down': [ host for host in os.environ.get('SFA_SIM_DOWN','').split(',') if host ],
+             'seed': int(os.environ.get('SFA_SIM_SEED',0)) }
+
+# number of getAll()/get() calls per class made by this process
+calls = {}
+
+# host -> SimulatedArray, built on first connect
+arrays = {}
+
+# host of the current execution context
+context = { 'host': None }
+
+# Values of the SFAOS enums used by the generated objects (see sfa_check.py)
+HEALTH_OK = 1
+HEALTH_NON_CRITICAL = 2
+HEALTH_CRITICAL = 3
+SES_OK = 1
+SES_CRITICAL = 2
+LINK_UP = 1
+LINK_DOWN = 2
+CON_RUNNING = 2
+ICC_UP = 3
+IOC_IB_HCA = 4
+IB_PORT_ACTIVE = 4
+POOL_NORMAL = 0
+POOL_DEGRADED = 4
+VD_READY = 2
+VD_CRITICAL = 5
+DISK_READY = 0
+DISK_HEALTH_GOOD = 0
+DISK_HEALTH_FAILED = 1
+MEMBER_NORMAL = 0
+MEMBER_RBLD = 3
+MEMBER_FAILED = 5
+MIRROR_MEMBER = 1
+WARNING_NONE = 0
+
+def configure(**kwargs):
+    """ Change the simulator settings. Arrays already built are dropped """
+    for (key,value) in kwargs.items():
+        if not key in settings:
+            raise KeyError("Unknown simulator setting %s"%key)
+        settings[key] = value
+    arrays.clear()
+
+def resetCalls():
+    calls.clear()
+
+def apiWait(numObjects):
+    """ Account for the latency of an API round trip """
+    delay = settings['latency'] + settings['object_latency'] * numObjects
+    if delay > 0:
+        time.sleep(delay)
+
+class SimulatedObject (object):
+    """ A generated SFA object, holding only plain attributes """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class SimulatedArray (object):
+    """ The objects of one simulated subsystem, by SFA class name """
+    def __init__(self, host):
+        self.host = host
+        self.rng = random.Random("%s:%s"%(settings['seed'],host))
+        self.objects = {}
+        self.name = "sim-%s"%host
+        self.build()
+
+    def faulted(self):
+        return self.rng.random() < settings['fault_rate']
+
+    def add(self, className, **attributes):
+        objects = self.objects.setdefault(className,[])
+        attributes.setdefault('Index',len(objects))
+        attributes.setdefault('HealthState',HEALTH_OK)
+        attributes.setdefault('ChildHealthState',HEALTH_OK)
+        # an instance of the simulated class, like the API returns
+        obj = globals()[className](**attributes)
+        objects.append(obj)
+        return obj
+
+    def addEnclosureElement(self, className, enclosure, position, **attributes):
+        """ Add an enclosure component (fan, power supply, sensor, ...) with the
+            attributes they have in common. A faulted element is NON_CRITICAL """
+        obj = self.add(className, EnclosureIndex=enclosure, Position=position,
+                       Location="%s %d"%(className[3:].upper(),position),
+                       Present=True, PredictFailure=False, SESStatus=SES_OK, **attributes)
+        if self.faulted():
+            obj.HealthState = HEALTH_NON_CRITICAL
+            obj.SESStatus = SES_CRITICAL
+        return obj
+
+    def build(self):
+        numEnclosures = max(settings['enclosures'],1)
+        numDisks = settings['disks']
+
+        for con in range(2):
+            controller = self.add('SFAController', Name="%s-%d"%(self.name,con),
+                                  VendorEquipmentType='SFA12K-40', State=CON_RUNNING,
+                                  RestartPending=False, MIRReason=0, ICCState=ICC_UP,
+                                  ICCProtocolVersion=1)
+            if self.faulted():
+                controller.HealthState = HEALTH_NON_CRITICAL
+                controller.RestartPending = True
+            for disk in ('DISK A','DISK B'):
+                self.add('SFAInternalDiskDrive', EnclosureIndex=con, Name=disk, MirrorState=MIRROR_MEMBER,
+                         Present=True, PredictFailure=False, SESStatus=SES_OK)
+            for rp in range(2):
+                self.add('SFARAIDProcessor', ControllerIndex=con, IndexOnController=rp)
+            for slot in range(4):
+                self.add('SFAIOC', ControllerIndex=con, RPIndexOnController=slot % 2, Slot=slot, ChannelCount=2)
+            for port in range(8):
+                channel = self.add('SFADiskChannel', ControllerIndex=con, PortLocation="%d-%d"%(con + 1,port),
+                                   LinkState=LINK_UP, CurrentSpeed=6, AvailableSpeeds=[3,6],
+                                   CurrentWidth=4, ExpectedWidth=4, IOCPort=(port % 2) * 4,
+                                   PHYs=range((port % 2) * 4,(port % 2) * 4 + 4),
+                                   CurrentPosition=[con,port], ExpectedPosition=[con,port])
+                if self.faulted():
+                    channel.CurrentWidth = 2
+            for port in range(4):
+                self.add('SFAHostChannel', ControllerIndex=con, LinkState=LINK_UP, Speed=56, AvailableSpeeds=56)
+            self.add('SFAICLIOC', ControllerIndex=con)
+            for port in range(2):
+                icl = self.add('SFAICLChannel', ControllerIndex=con, LinkState=LINK_UP, CurrentSpeed=10000,
+                               ICLIOCType=IOC_IB_HCA, InfinibandCurrentWidth=4, InfinibandPortState=IB_PORT_ACTIVE,
+                               ErrorStatisticNames=['SymbolErrorCounter','LinkErrorRecoveryCounter','LinkDownedCounter'],
+                               ErrorStatisticCounts=[self.rng.randint(0,5),0,0])
+                if self.faulted():
+                    icl.ErrorStatisticCounts[0] = self.rng.randint(21,500)
+            self.add('SFAUPS', EnclosureIndex=con, Present=True, Enabled=True, ACFailure=False, UPSFailure=False,
+                     InterfaceFailure=False, PredictFailure=False, SESStatus=SES_OK, WarningStatus=WARNING_NONE)
+
+        for enclosure in range(numEnclosures):
+            for position in range(2):
+                self.addEnclosureElement('SFAExpander', enclosure, position)
+                self.addEnclosureElement('SFASEP', enclosure, position)
+                self.addEnclosureElement('SFAPowerSupply', enclosure, position, PowerState=True, ACFailure=False,
+                                         DCFailure=False, TemperatureFailure=False, TemperatureWarning=False)
+            for position in range(4):
+                self.addEnclosureElement('SFAFan', enclosure, position, PoweredOn=True)
+                self.addEnclosureElement('SFATemperatureSensor', enclosure, position, TemperatureFailure=False,
+                                         TemperatureWarning=False)
+                self.addEnclosureElement('SFAVoltageSensor', enclosure, position, OverVoltageFailure=False,
+                                         OverVoltageWarning=False, UnderVoltageFailure=False, UnderVoltageWarning=False)
+
+        disksPerEnclosure = (numDisks + numEnclosures - 1) / numEnclosures
+        for index in range(numDisks):
+            disk = self.add('SFADiskDrive', EnclosureIndex=index / disksPerEnclosure,
+                            DiskSlotNumber=index % disksPerEnclosure + 1,
+                            SerialNumber="SIM%08d%s"%(index,self.host.replace('.','')[-4:]),
+                            State=DISK_READY, MemberState=MEMBER_NORMAL, DiskHealthState=DISK_HEALTH_GOOD)
+            if self.faulted():
+                if self.rng.random() < 0.5:
+                    disk.HealthState = HEALTH_CRITICAL
+                    disk.MemberState = MEMBER_FAILED
+                    disk.DiskHealthState = DISK_HEALTH_FAILED
+                else:
+                    disk.MemberState = MEMBER_RBLD
+
+        # pools of 10 disks (8+2) with a virtual disk each
+        for index in range(numDisks / 10):
+            pool = self.add('SFAStoragePool', PoolState=POOL_NORMAL, HomeControllerIndex=index % 2,
+                            PreferredHomeControllerIndex=index % 2, HomeControllerRPIndex=0,
+                            PreferredHomeControllerRPIndex=0, AutoWriteLocked=False, Rebuilding=False,
+                            BadBlockCount=0, DirectProtect=1, ReACT=True, IORouting=True, CacheMirroring=0,
+                            ReadAheadCache=False, WriteBackCache=0, VerifyEnabled=True)
+            vd = self.add('SFAVirtualDisk', State=VD_READY, BadBlockCount=0)
+            if self.faulted():
+                pool.HealthState = HEALTH_NON_CRITICAL
+                pool.PoolState = POOL_DEGRADED
+                pool.Rebuilding = True
+                pool.BadBlockCount = vd.BadBlockCount = self.rng.randint(1,100)
+
+def currentArray():
+    if context['host'] is None:
+        raise Exception("No API context, call APIConnect() first")
+    return arrays[context['host']]
+
+def APIConnect(url, auth=None):
+    """ Open the execution context for the subsystem at url """
+    host = url.split('://')[-1]
+    apiWait(0)
+    if host in settings['down']:
+        raise socket.error(errno.ECONNREFUSED, "Connection refused")
+    if not host in arrays:
+        arrays[host] = SimulatedArray(host)
+    context['host'] = host
+    return arrays[host]
+
+def APIDisconnect():
+    context['host'] = None
+
+class SimulatedClass (SimulatedObject):
+    """ Base of the simulated SFA classes """
+    @classmethod
+    def getAll(cls):
+        name = cls.__name__
+        calls[name] = calls.get(name,0) + 1
+        objects = currentArray().objects.get(name,[])
+        apiWait(len(objects))
+        return list(objects)
+
+class SFAStorageSystem (SimulatedClass):
+    @classmethod
+    def get(cls):
+        calls['SFAStorageSystem'] = calls.get('SFAStorageSystem',0) + 1
+        array = currentArray()
+        apiWait(1)
+        return SimulatedObject(Name=array.name)
+
+class SFAController (SimulatedClass): pass
+class SFADiskChannel (SimulatedClass): pass
+class SFAHostChannel (SimulatedClass): pass
+class SFARAIDProcessor (SimulatedClass): pass
+class SFAICLIOC (SimulatedClass): pass
+class SFAICLChannel (SimulatedClass): pass
+class SFAStoragePool (SimulatedClass): pass
+class SFAVirtualDisk (SimulatedClass): pass
+class SFAInternalDiskDrive (SimulatedClass): pass
+class SFADiskDrive (SimulatedClass): pass
+class SFAExpander (SimulatedClass): pass
+class SFAFan (SimulatedClass): pass
+class SFAIOC (SimulatedClass): pass
+class SFAPowerSupply (SimulatedClass): pass
+class SFAUPS (SimulatedClass): pass
+class SFASEP (SimulatedClass): pass
+class SFATemperatureSensor (SimulatedClass): pass
+class SFAVoltageSensor (SimulatedClass): pass
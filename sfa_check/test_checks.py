@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+test_checks.py
+
+Tests of the output of the check modules of sfa_check.py on a simulated subsystem
+with a fixed seed, in Nagios and -x mode. The expected messages are the ones the
+check classes printed before they were rewritten as component rules and disk
+columns, so a change to the checks that changes what they report fails here.
+
+  python test_checks.py
+"""
+
+import os
+# must be set before sfa_check is imported
+os.environ['SFA_CHECK_SIMULATOR'] = '1'
+
+import sys
+import unittest
+from StringIO import StringIO
+import sfa_check as sfaCheck
+import sfa_check_sim as sim
+
+# the check modules evaluated from component rules, and the disk channels
+enclosureModules = ['expander','ioc','channel','fan','power','sep','temperature','ups','voltage']
+enclosureSettings = { 'seed': 3, 'fault_rate': 0.25, 'disks': 24, 'enclosures': 4 }
+
+# (exit code, output) of the checks of enclosureModules on enclosureSettings
+enclosureNagios = (1, """EXPANDER: 3 Checks WARNING ;; DISK CHANNEL Controller: 1 Port 2-3; Width:2 ExpectedWidth:4 ;; DISK CHANNEL Controller: 1 Port 2-4; Width:2 ExpectedWidth:4 ;; FAN: 2 Checks WARNING ;; POWER SUPPLY: WARNING ;; TEMPERATURE: 4 Checks WARNING ;; VOLTAGE: 2 Checks WARNING""")
+
+enclosureExtended = (1, """
+sim-127.0.0.1 Check Summary:
+-------------------------
+Messages from check VOLTAGE
+Messages from check TEMPERATURE
+Messages from check POWER SUPPLY
+Messages from check FAN
+Messages from check DISK CHANNEL
+Messages from check EXPANDER
+EXPANDER: 3 Checks WARNING
+EXPANDER Health: NON_CRITICAL  EnclosureIndex: 0 Position: 1 Location: EXPANDER 1 Index: 1
+EXPANDER Health: NON_CRITICAL  EnclosureIndex: 1 Position: 0 Location: EXPANDER 0 Index: 2
+EXPANDER Health: NON_CRITICAL  EnclosureIndex: 1 Position: 1 Location: EXPANDER 1 Index: 3
+
+
+DISK CHANNEL Controller: 1 Port 2-3; Width:2 ExpectedWidth:4
+DISK CHANNEL Controller: 1 Port 2-4; Width:2 ExpectedWidth:4
+DISK CHANNEL Controller: 1 Port 2-6; Width:2 ExpectedWidth:4
+
+
+FAN: 2 Checks WARNING
+FAN Health: NON_CRITICAL  EnclosureIndex: 1 Position: 0 Location: FAN 0 Index: 4
+FAN Health: NON_CRITICAL  EnclosureIndex: 2 Position: 3 Location: FAN 3 Index: 11
+
+
+POWER SUPPLY: 1 Check WARNING
+POWER SUPPLY Health: NON_CRITICAL  EnclosureIndex: 2 Location: POWERSUPPLY 0 Index: 4
+
+
+TEMPERATURE: 4 Checks WARNING
+TEMPERATURE Health: NON_CRITICAL  EnclosureIndex: 1 Position: 0 Location: TEMPERATURESENSOR 0 Index: 4
+TEMPERATURE Health: NON_CRITICAL  EnclosureIndex: 1 Position: 1 Location: TEMPERATURESENSOR 1 Index: 5
+TEMPERATURE Health: NON_CRITICAL  EnclosureIndex: 2 Position: 2 Location: TEMPERATURESENSOR 2 Index: 10
+TEMPERATURE Health: NON_CRITICAL  EnclosureIndex: 3 Position: 1 Location: TEMPERATURESENSOR 1 Index: 13
+
+
+VOLTAGE: 2 Checks WARNING
+VOLTAGE Health: NON_CRITICAL  EnclosureIndex: 1 Position: 0 Location: VOLTAGESENSOR 0 Index: 4
+VOLTAGE Health: NON_CRITICAL  EnclosureIndex: 3 Position: 1 Location: VOLTAGESENSOR 1 Index: 13
+
+
+Faults by enclosure for sim-127.0.0.1:
+Enclosure 0: WARNING, 1 fault(s) (EXPANDER 1) at Position 1; likely root: EXPANDER Index: 1 Position: 1 Location: EXPANDER 1
+Enclosure 1: WARNING, 6 fault(s) (EXPANDER 2, FAN 1, TEMPERATURE 2, VOLTAGE 1) at Position 0,1; likely root: EXPANDER Index: 2 Position: 0 Location: EXPANDER 0
+Enclosure 2: WARNING, 3 fault(s) (FAN 1, POWER SUPPLY 1, TEMPERATURE 1) at Position 0,2,3; likely root: POWER SUPPLY Index: 4 Position: 0 Location: POWERSUPPLY 0
+Enclosure 3: WARNING, 2 fault(s) (TEMPERATURE 1, VOLTAGE 1) at Position 1; likely root: TEMPERATURE Index: 13 Position: 1 Location: TEMPERATURESENSOR 1""")
+
+def runChecks(settings, modules, extended):
+    """ The output lines (without the timing) and exit code of sfa_check.py -m modules
+        on a simulated subsystem built with settings """
+    defaults = dict(sim.settings)
+    sim.configure(**settings)
+    (argv, stdout, stderr) = (sys.argv, sys.stdout, sys.stderr)
+    sys.argv = ['sfa_check.py','-m'] + modules + ['--','127.0.0.1,127.0.0.2']
+    if extended:
+        sys.argv.insert(1,'-x')
+    sys.stdout = StringIO()
+    sys.stderr = StringIO()
+    try:
+        rc = sfaCheck.main()
+        output = sys.stdout.getvalue()
+    finally:
+        (sys.argv, sys.stdout, sys.stderr) = (argv, stdout, stderr)
+        sim.configure(**defaults)
+    lines = [ line.rstrip() for line in output.splitlines()
+              if not (line.startswith('Check timing for') or line.startswith('Total: ') or 's (API ' in line) ]
+    return (rc, lines)
+
+# the disk check, evaluated from attribute columns
+diskSettings = { 'seed': 4, 'fault_rate': 0.1, 'disks': 48, 'enclosures': 4 }
+
+# (exit code, output) of the disk check on diskSettings
+diskNagios = (1, """DISK DRIVE: 5 Checks CRITICAL - Index 46 MemberState RBLD ;; DISK DRIVE Enclosure: 0 Slot: 7 Index: 6 SerialNumber: SIM000000067001; MemberState: FAILED; DiskHealthState: FAILED ;; DISK DRIVE Enclosure: 0 Slot: 8 Index: 7 SerialNumber: SIM000000077001; MemberState: FAILED; DiskHealthState: FAILED""")
+
+diskExtended = (1, """
+sim-127.0.0.1 Check Summary:
+-------------------------
+Messages from check DISK DRIVE
+DISK DRIVE: 5 Checks CRITICAL; 5 Checks WARNING
+DISK DRIVE Health: CRITICAL  EnclosureIndex: 0 DiskSlotNumber: 7 SerialNumber: SIM000000067001 Index: 6; State: READY
+DISK DRIVE Health: CRITICAL  EnclosureIndex: 0 DiskSlotNumber: 8 SerialNumber: SIM000000077001 Index: 7; State: READY
+DISK DRIVE Health: CRITICAL  EnclosureIndex: 1 DiskSlotNumber: 8 SerialNumber: SIM000000197001 Index: 19; State: READY
+DISK DRIVE Health: CRITICAL  EnclosureIndex: 1 DiskSlotNumber: 12 SerialNumber: SIM000000237001 Index: 23; State: READY
+DISK DRIVE Health: CRITICAL  EnclosureIndex: 2 DiskSlotNumber: 12 SerialNumber: SIM000000357001 Index: 35; State: READY
+DISK DRIVE Enclosure: 0 Slot: 7 Index: 6 SerialNumber: SIM000000067001; MemberState: FAILED; DiskHealthState: FAILED
+DISK DRIVE Enclosure: 0 Slot: 8 Index: 7 SerialNumber: SIM000000077001; MemberState: FAILED; DiskHealthState: FAILED
+DISK DRIVE Enclosure: 1 Slot: 8 Index: 19 SerialNumber: SIM000000197001; MemberState: FAILED; DiskHealthState: FAILED
+DISK DRIVE Enclosure: 1 Slot: 12 Index: 23 SerialNumber: SIM000000237001; MemberState: FAILED; DiskHealthState: FAILED
+DISK DRIVE Enclosure: 2 Slot: 1 Index: 24 SerialNumber: SIM000000247001; MemberState: RBLD
+DISK DRIVE Enclosure: 2 Slot: 11 Index: 34 SerialNumber: SIM000000347001; MemberState: RBLD
+DISK DRIVE Enclosure: 2 Slot: 12 Index: 35 SerialNumber: SIM000000357001; MemberState: FAILED; DiskHealthState: FAILED
+DISK DRIVE Enclosure: 3 Slot: 1 Index: 36 SerialNumber: SIM000000367001; MemberState: RBLD
+DISK DRIVE Enclosure: 3 Slot: 10 Index: 45 SerialNumber: SIM000000457001; MemberState: RBLD
+DISK DRIVE Enclosure: 3 Slot: 11 Index: 46 SerialNumber: SIM000000467001; MemberState: RBLD
+
+
+Faults by enclosure for sim-127.0.0.1:
+Enclosure 0: CRITICAL, 2 fault(s) (DISK DRIVE 2); likely root: DISK DRIVE Index: 6 DiskSlotNumber: 7 SerialNumber: SIM000000067001
+Enclosure 1: CRITICAL, 2 fault(s) (DISK DRIVE 2); likely root: DISK DRIVE Index: 19 DiskSlotNumber: 8 SerialNumber: SIM000000197001
+Enclosure 2: CRITICAL, 3 fault(s) (DISK DRIVE 3); likely root: DISK DRIVE Index: 35 DiskSlotNumber: 12 SerialNumber: SIM000000357001
+Enclosure 3: WARNING, 3 fault(s) (DISK DRIVE 3); likely root: DISK DRIVE Index: 36 DiskSlotNumber: 1 SerialNumber: SIM000000367001""")
+
+class ParityTest (unittest.TestCase):
+    def assertOutput(self, settings, modules, extended, expected):
+        (rc, lines) = runChecks(settings,modules,extended)
+        self.assertEqual(lines,expected[1].split("\n"))
+        self.assertEqual(rc,expected[0])
+    def testEnclosureNagios(self):
+        self.assertOutput(enclosureSettings,enclosureModules,False,enclosureNagios)
+    def testEnclosureExtended(self):
+        self.assertOutput(enclosureSettings,enclosureModules,True,enclosureExtended)
+    def testDiskNagios(self):
+        self.assertOutput(diskSettings,['disk'],False,diskNagios)
+    def testDiskExtended(self):
+        self.assertOutput(diskSettings,['disk'],True,diskExtended)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+test_config.py
+
+Tests of the parsing and validation of the lines of the sfa_check.conf
+configuration file.
+
+  python test_config.py
+"""
+
+import os
+# must be set before sfa_check is imported
+os.environ['SFA_CHECK_SIMULATOR'] = '1'
+
+import tempfile
+import unittest
+import sfa_check as sfaCheck
+
+# line -> (id, controllers, production, auth, options) of its SubsystemConfig
+validLines = [
+    ("1:sfa1a,sfa1b:1", ('1','sfa1a,sfa1b',True,('user','user'),{})),
+    ("2:sfa2a,sfa2b:0:admin,secret", ('2','sfa2a,sfa2b',False,('admin','secret'),{})),
+    ("3:sfa3a:1:timeout=120:interval=60 # comment", ('3','sfa3a',True,('user','user'),{ 'timeout': 120, 'interval': 60 })),
+    ("4:sfa4a,sfa4b:1:modules=disk,pool", ('4','sfa4a,sfa4b',True,('user','user'),{ 'modules': ['disk','pool'] })),
+    ("5:sfa5a,sfa5b:1:rate.SymbolErrorCounter=5:rate_interval=600",
+     ('5','sfa5a,sfa5b',True,('user','user'),{ 'rate.SymbolErrorCounter': 5.0, 'rate_interval': 600 })),
+    # username= and password= override the username,password field, wherever they are
+    ("6:sfa6a,sfa6b:1:username=monitor:admin,secret", ('6','sfa6a,sfa6b',True,('monitor','secret'),{})),
+    ("7:sfa7a,sfa7b:1:admin,secret:password=p4ss:username=monitor", ('7','sfa7a,sfa7b',True,('monitor','p4ss'),{})),
+    ("8:sfa8a,sfa8b:1:password=a=b", ('8','sfa8a,sfa8b',True,('user','a=b'),{})),
+]
+
+# line -> text of the ValueError it raises
+invalidLines = [
+    ("1:sfa1a,sfa1b", "expected index:controllers:production"),
+    (":sfa1a,sfa1b:1", "missing subsystem index"),
+    ("1::1", "bad controller pair"),
+    ("1:sfa1a,,sfa1b:1", "bad controller pair"),
+    ("1:sfa1a, sfa1b:1", "bad controller pair"),
+    ("1:sfa1a,sfa1b:yes", "production must be 0 or 1, not yes"),
+    ("1:sfa1a,sfa1b:2", "production must be 0 or 1, not 2"),
+    ("1:sfa1a,sfa1b:1:verbose=1", "unknown option verbose"),
+    ("1:sfa1a,sfa1b:1:modules=disk,nosuchmodule", "unknown module nosuchmodule"),
+    ("1:sfa1a,sfa1b:1:secret", "unknown field secret"),
+    ("1:sfa1a,sfa1b:1:a,b,c", "credentials must be username,password"),
+    ("1:sfa1a,sfa1b:1:timeout=0", "timeout must be positive"),
+    ("1:sfa1a,sfa1b:1:interval=-60", "interval must be positive"),
+    ("1:sfa1a,sfa1b:1:rate_interval=0", "rate_interval must be positive"),
+    ("1:sfa1a,sfa1b:1:timeout=fast", "timeout must be a number of seconds, not fast"),
+    ("1:sfa1a,sfa1b:1:rate.SymbolErrorCounter=many", "rate.SymbolErrorCounter must be a number, not many"),
+]
+
+class ParseLineTest (unittest.TestCase):
+    def testValid(self):
+        for (line, expected) in validLines:
+            entry = sfaCheck.parseConfigLine(line)
+            self.assertEqual((entry.oid, entry.sub_name, entry.production, entry.auth, entry.options),expected,line)
+    def testInvalid(self):
+        for (line, error) in invalidLines:
+            try:
+                sfaCheck.parseConfigLine(line)
+            except ValueError, err:
+                self.assertTrue(str(err).startswith(error),"%s: %s"%(line,err))
+            else:
+                self.fail("%s was accepted"%line)
+    def testBlank(self):
+        for line in ("", "   ", "# 1:sfa1a,sfa1b:1"):
+            self.assertEqual(sfaCheck.parseConfigLine(line),None)
+
+class ParseFileTest (unittest.TestCase):
+    def parse(self, lines):
+        (fd, path) = tempfile.mkstemp(prefix='sfa_check.conf.')
+        try:
+            os.write(fd,"\n".join(lines) + "\n")
+            os.close(fd)
+            return sfaCheck.parseConfig(path)
+        finally:
+            os.remove(path)
+    def testDuplicates(self):
+        config = self.parse([ "1:sfa1a,sfa1b:1",
+                              "1:sfa2a,sfa2b:1",
+                              "2:sfa1b,sfa3b:1",
+                              "3:sfa3a,sfa3b:0" ])
+        self.assertEqual([ entry.sub_name for entry in config ],['sfa1a,sfa1b','sfa3a,sfa3b'])
+        self.assertEqual(len(config.errors),2)
+        self.assertTrue(config.errors[0].endswith("line 2: subsystem id 1 is already used by sfa1a,sfa1b"),config.errors[0])
+        self.assertTrue(config.errors[1].endswith("line 3: controller sfa1b is already in subsystem sfa1a,sfa1b"),config.errors[1])
+    def testInvalidLineSkipped(self):
+        config = self.parse([ "1:sfa1a,sfa1b:maybe",
+                              "2:sfa2a,sfa2b:1:timeout=0",
+                              "3:sfa3a,sfa3b:1" ])
+        self.assertEqual([ entry.oid for entry in config ],['3'])
+        self.assertEqual(len(config.errors),2)
+        self.assertTrue(config.errors[0].endswith("line 1: production must be 0 or 1, not maybe"),config.errors[0])
+        self.assertTrue(config.errors[1].endswith("line 2: timeout must be positive"),config.errors[1])
+
+if __name__ == "__main__":
+    unittest.main()
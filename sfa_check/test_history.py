@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+test_history.py
+
+Tests of the history file of sfa_check.py: the varint and zigzag codec, reading
+back a file whose last record was cut short by a crash, and the increase of the
+error counters compared with their rate thresholds.
+
+  python test_history.py
+"""
+
+import os
+# must be set before sfa_check is imported
+os.environ['SFA_CHECK_SIMULATOR'] = '1'
+
+import tempfile
+import unittest
+import sfa_check as sfaCheck
+
+metric = ('pool_bad_blocks',{ 'index': 1 })
+other = ('pool_bad_blocks',{ 'index': 2 })
+
+class CodecTest (unittest.TestCase):
+    def testVarint(self):
+        for value in (0, 1, 127, 128, 300, 2 ** 31, 2 ** 53 + 1):
+            out = bytearray()
+            sfaCheck.encodeVarint(value,out)
+            self.assertEqual(sfaCheck.decodeVarint(out,0),(value,len(out)))
+    def testVarintCutShort(self):
+        out = bytearray()
+        sfaCheck.encodeVarint(300,out)
+        self.assertRaises(IndexError,sfaCheck.decodeVarint,out[:-1],0)
+    def testZigzag(self):
+        for value in (0, 1, -1, 63, -64, 2 ** 40, -2 ** 40):
+            self.assertTrue(sfaCheck.zigzag(value) >= 0)
+            self.assertEqual(sfaCheck.unzigzag(sfaCheck.zigzag(value)),value)
+
+class HistoryFileTest (unittest.TestCase):
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp(prefix='sfa_check_history.')
+        os.close(fd)
+        os.remove(self.path)
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+    def load(self):
+        history = sfaCheck.HistoryStore()
+        history.load(self.path)
+        return history
+    def values(self, history):
+        series = history.series.get(sfaCheck.seriesKey('a,b',metric[0],metric[1]))
+        if series is None:
+            return []
+        return list(series.values)
+    def record(self, history, value, now):
+        history.record('a,b',[ (metric[0],metric[1],value), (other[0],other[1],0) ],now)
+    def testReload(self):
+        now = int(sfaCheck.time.time())
+        history = self.load()
+        for (offset, value) in enumerate((100, 160, 90, 0.5, 7)):
+            self.record(history,value,now + offset)
+        history.close()
+        self.assertEqual(self.values(self.load()),[100.0, 160.0, 90.0, 0.5, 7.0])
+    def testTruncatedRecord(self):
+        now = int(sfaCheck.time.time())
+        history = self.load()
+        self.record(history,100,now)
+        history.close()
+        size = os.path.getsize(self.path)
+        history = self.load()
+        self.record(history,160,now + 1)
+        history.close()
+
+        # a crash in the middle of the values of the second run, after the first one
+        f = open(self.path,'r+b')
+        f.truncate(os.path.getsize(self.path) - 1)
+        f.close()
+        self.assertTrue(os.path.getsize(self.path) > size)
+        history = self.load()
+        self.assertEqual(self.values(history),[100.0])
+        self.assertEqual(os.path.getsize(self.path),size)
+
+        # the values written after the dropped record are deltas from 100, not 160
+        self.record(history,160,now + 2)
+        history.close()
+        self.assertEqual(self.values(self.load()),[100.0, 160.0])
+
+class CounterTest (unittest.TestCase):
+    labels = { 'controller': 0, 'counter': 'SymbolErrorCounter' }
+    def check(self, samples, controller=None):
+        """ An APICheck of a subsystem whose counter history has samples of the
+            icl_channel_errors_total series """
+        if controller is None:
+            controller = { 'production': True, 'ip': '127.0.0.1', 'auth': ('user','user'), 'sub_name': 'a,b' }
+        controller['counter_history'] = { sfaCheck.seriesKey(controller['sub_name'],'icl_channel_errors_total',self.labels): samples }
+        return sfaCheck.APICheck(sfaCheck.SFASystem(controller),'TEST',False,True)
+    def testIncrease(self):
+        self.assertEqual(sfaCheck.counterIncrease([100, 160]),60)
+        self.assertEqual(sfaCheck.counterIncrease([100]),0)
+    def testReset(self):
+        # 60 counted before the reset, then 5 since
+        self.assertEqual(sfaCheck.counterIncrease([100, 160, 5]),65)
+        self.assertEqual(sfaCheck.counterIncrease([100, 0, 0, 3]),3)
+    def testResetWithinWindow(self):
+        now = int(sfaCheck.time.time())
+        check = self.check(([now - 60, now - 30],[100.0, 160.0]))
+        (increase, seconds) = check.recordCounter('icl_channel_errors_total',5,**self.labels)
+        self.assertEqual(increase,65)
+        self.assertTrue(60 <= seconds <= 62)
+        self.assertTrue(check.counterRateExceeded('SymbolErrorCounter',(increase, seconds)))
+    def testSingleEarlierSample(self):
+        now = int(sfaCheck.time.time())
+        check = self.check(([now - 30],[100.0]))
+        increase = check.recordCounter('icl_channel_errors_total',110,**self.labels)
+        self.assertEqual(increase[0],10)
+        self.assertFalse(check.counterRateExceeded('SymbolErrorCounter',increase))
+    def testNoEarlierSample(self):
+        check = self.check(None)
+        self.assertEqual(check.recordCounter('icl_channel_errors_total',110,**self.labels),None)
+        self.assertFalse(check.counterRateExceeded('SymbolErrorCounter',None))
+        self.assertEqual(check.metrics,[ ('icl_channel_errors_total',self.labels,110) ])
+    def testRateOption(self):
+        entry = sfaCheck.parseConfigLine("1:127.0.0.1,127.0.0.2:1:rate.SymbolErrorCounter=5:rate.Other=0.5")
+        self.assertEqual(entry.options['rate.SymbolErrorCounter'],5.0)
+        workers = sfaCheck.prepareWorkers(sfaCheck.Config([entry]),sfaCheck.implementedModules,False,True)
+        counterRates = workers[0].controller['counter_rates']
+        self.assertEqual(counterRates['SymbolErrorCounter'],5.0)
+        self.assertEqual(counterRates['Other'],0.5)
+        # the other counters keep their default threshold
+        for (counter, threshold) in sfaCheck.counterRateThresholds.items():
+            if counter != 'SymbolErrorCounter':
+                self.assertEqual(counterRates[counter],threshold)
+
+        # an increase of 10 is above the threshold of 5, not the default one
+        now = int(sfaCheck.time.time())
+        check = self.check(([now - 30],[100.0]),dict(workers[0].controller))
+        increase = check.recordCounter('icl_channel_errors_total',110,**self.labels)
+        self.assertTrue(check.counterRateExceeded('SymbolErrorCounter',increase))
+        self.assertFalse(self.check(([now - 30],[100.0])).counterRateExceeded('SymbolErrorCounter',increase))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+#   This file is part of sfa_check
+#
+#   Copyright 2015 Blake Caldwell
+#   Oak Ridge National Laboratory
+#
+#   sfa_check is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   sfa_check is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this sfa_check.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+test_summary.py
+
+Tests of the --format summary output of sfa_check.py against the simulator: the
+progress lines, the table and the exit code when controllers don't resolve.
+
+  python test_summary.py
+"""
+
+import os
+# must be set before sfa_check is imported
+os.environ['SFA_CHECK_SIMULATOR'] = '1'
+
+import sys
+import unittest
+from StringIO import StringIO
+import sfa_check as sfaCheck
+
+class SummaryTest (unittest.TestCase):
+    def run_main(self, *args):
+        """ Returns (exit code, output lines) of sfa_check.py --format summary args """
+        (argv, stdout, stderr) = (sys.argv, sys.stdout, sys.stderr)
+        sys.argv = ['sfa_check.py','--format','summary'] + list(args)
+        sys.stdout = StringIO()
+        try:
+            rc = sfaCheck.main()
+            output = sys.stdout.getvalue()
+        finally:
+            (sys.argv, sys.stdout, sys.stderr) = (argv, stdout, stderr)
+        return (rc, output.splitlines())
+    def testNoneResolved(self):
+        (rc, lines) = self.run_main('bad1.invalid,bad2.invalid','bad3.invalid')
+        self.assertEqual(rc,sfaCheck.NagiosStatus.UNKNOWN)
+        self.assertEqual(lines[:2],[
+            "[1/2] bad1.invalid,bad2.invalid: UNKNOWN, none of the controllers could be resolved",
+            "[2/2] bad3.invalid: UNKNOWN, none of the controllers could be resolved" ])
+        self.assertTrue(lines[2].startswith("Fleet summary: 0/2 OK, 2 UNKNOWN, checked in "))
+        self.assertEqual(len(lines),6)
+        self.assertFalse([ line for line in lines if 'None' in line ])
+    def testUnresolvedCounted(self):
+        (rc, lines) = self.run_main('127.0.0.1,127.0.0.2','bad1.invalid')
+        self.assertEqual(rc,sfaCheck.NagiosStatus.UNKNOWN)
+        self.assertTrue(lines[0].startswith("[1/2] 127.0.0.1,127.0.0.2: OK after "))
+        self.assertEqual(lines[1],"[2/2] bad1.invalid: UNKNOWN, none of the controllers could be resolved")
+        self.assertTrue(lines[2].startswith("Fleet summary: 1/2 OK, 1 UNKNOWN, checked in "))
+
+if __name__ == "__main__":
+    unittest.main()